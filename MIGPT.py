@@ -10,20 +10,45 @@ from aiohttp import ClientSession
 from minaservice import MiNAService
 from miaccount import MiAccount
 from requests.utils import cookiejar_from_dict
-from V3 import Chatbot
+from V3 import ChatResult, StreamDeadlineExceeded
+from llm_gateway import build_chatbot
+from answer_cache import AnswerCache
+from semantic_cache import SemanticCache
+from ha_client import HomeAssistantClient, share_client
+from ha_state import HAStateCache
+from keyword_router import KeywordRouter, ROUTE_AI, ROUTE_HA_VOICE, ROUTE_HA_TEXT, GROUP_AI
+import metrics
 import traceback
 # 导入配置
 from config import config, LOG_LEVEL, MI_USER, MI_PASS, API_TYPE, API_KEY, API_BASE, MODEL_NAME, SOUND_TYPE, HARDWARE_COMMAND_DICT, LATEST_ASK_API, COOKIE_TEMPLATE, SWITCH, PROMPT
 
+# 关键词路由，配置保存后自动重建
+keyword_router = KeywordRouter(config)
+
+# 语音链路的运行指标，由API服务器的/metrics导出
+POLL_SECONDS = metrics.histogram(
+    "migpt_poll_seconds", "Latency of polling a device for its latest conversation", ["device"])
+DETECTION_LAG = metrics.histogram(
+    "migpt_detection_lag_seconds", "Delay between the user speaking and MiGPT detecting the question", ["device"],
+    buckets=(0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10, 30))
+TTS_SECONDS = metrics.histogram(
+    "migpt_tts_send_seconds", "Latency of sending text to a speaker for playback", ["device"])
+TTS_RETRIES = metrics.counter(
+    "migpt_tts_retries_total", "TTS sends retried after a failure", ["device"])
+CACHE_LOOKUPS = metrics.counter(
+    "migpt_answer_cache_total", "Answer cache lookups by cache and result", ["cache", "result"])
+QUEUE_DEPTH = metrics.gauge(
+    "migpt_device_queue_depth", "Questions waiting in each device queue", ["device"])
+QUEUE_DROPPED = metrics.counter(
+    "migpt_device_queue_dropped_total", "Questions dropped because the device queue was full", ["device"])
+
 # 判断是否应该使用AI助手来回答
 def should_use_ai(text):
     """
     判断是否应该使用AI助手来回答
     只有当用户输入包含特定关键词时，才使用AI助手回答
     """
-    # 使用多个关键词作为触发词
-    ai_keywords = config.get("ai_keywords", ["请", "帮我", "问一下", "AI"])
-    return any(keyword in text for keyword in ai_keywords)
+    return bool(keyword_router.matches(text, GROUP_AI))
 
 # 判断是否应该使用HomeAssistant来处理
 def should_use_ha(text):
@@ -31,22 +56,16 @@ def should_use_ha(text):
     判断是否应该使用HomeAssistant来处理
     只有当用户输入包含特定关键词时，才使用HomeAssistant处理
     """
-    # 从配置中获取HomeAssistant关键词
-    ha_config = config.get("homeassistant", {})
-    ha_ai_keywords = ha_config.get("ai_keywords", [])
-    ha_text_keywords = ha_config.get("text_keywords", [])
-    
-    # 检查是否包含任何HomeAssistant关键词
-    return any(keyword in text for keyword in ha_ai_keywords + ha_text_keywords)
+    return keyword_router.route(text).route in (ROUTE_HA_VOICE, ROUTE_HA_TEXT)
 
 # 去掉用户输入中的关键词
 def get_cleaned_input(text, keywords=None):
     """
     去掉用户输入中的关键词
     """
-    # 如果没有提供关键词，使用AI关键词
+    # 如果没有提供关键词，去掉AI关键词
     if keywords is None:
-        keywords = config.get("ai_keywords", ["请", "帮我", "问一下", "AI"])
+        return keyword_router.route(text, allow_ha=False).cleaned
     
     cleaned_text = text
     for keyword in keywords:
@@ -69,6 +88,28 @@ def optimize_answer(answer):
     
     return answer.strip()
 
+# 控制台输入使用的会话ID
+CONSOLE_CONVO_ID = "console"
+
+# 中英文句末标点
+SENTENCE_ENDINGS = "。！？；!?;…\n"
+
+# 按句末标点切分文本
+def split_sentences(text, min_chars=0):
+    """
+    按中英文句末标点切分文本，返回(完整句子列表, 剩余未完成部分)
+    英文句号后需跟空白才算句末，避免切断小数；不足min_chars的句子与下一句合并
+    """
+    sentences = []
+    start = 0
+    for i, ch in enumerate(text):
+        if ch in SENTENCE_ENDINGS or (ch == "." and i + 1 < len(text) and text[i + 1].isspace()):
+            sentence = text[start:i + 1].strip()
+            if len(sentence) >= min_chars:
+                sentences.append(sentence)
+                start = i + 1
+    return sentences, text[start:]
+
 # 事件循环
 loop = asyncio.get_event_loop()
 
@@ -92,6 +133,9 @@ class MiGPT:
         self.cookie_string = ""
         self.last_timestamps = {}  # 每个设备的最后时间戳
         self.session = None
+        self.ha_client = None
+        self.ha_state_cache = None  # HomeAssistant实体状态表
+        self.ha_state_task = None
         self.chatbot = None  # a little slow to init we move it after xiaomi init
         self.user_id = ""
         self.device_id = ""
@@ -103,15 +147,23 @@ class MiGPT:
         self.parent_id = None
         self.miboy_account = None
         self.mina_service = None
-        self.conversation_history = []  # 对话历史列表
+        self.conversation_history = {}  # 每个会话（设备或控制台）的对话历史
+        self.conversation_times = {}  # 每个会话最近一次提问的时间
+        self.conversation_idle_timeout = config.get("conversation_idle_timeout", 120)  # 对话上下文的有效时间（秒）
         self.selected_devices = []  # 已选择的设备列表
         self.device_cookies = {}  # 每个设备的cookie
         self.command_queue = asyncio.Queue()  # 命令队列
+        self.device_queues = {}  # 每个设备的待处理提问队列
+        self.device_workers = {}  # 每个设备的处理任务
+        self.device_queue_size = config.get("device_queue_size", 5)  # 设备队列容量
+        QUEUE_DEPTH.set_function(lambda: {(device_id,): q.qsize() for device_id, q in list(self.device_queues.items())})
         self.running = True  # 运行标志
         self.devices = []  # 设备列表
         self.auto_process = True  # 默认自动处理设备输入
         self.log_level = LOG_LEVEL  # 日志级别
         self.show_api_logs = False  # 是否显示API请求日志，默认不显示
+        self.stream_tts = config.get("stream_tts", True)  # 是否边生成边播放AI回答
+        self.stream_tts_min_chars = config.get("stream_tts_min_chars", 6)  # 每段播放文本的最少字数
         
     def log_debug(self, message):
         """输出调试级别日志"""
@@ -136,6 +188,13 @@ class MiGPT:
         初始化所有必要的数据，包括小米账号、小爱服务和聊天机器人
         """
         self.session = session
+        # HomeAssistant客户端复用同一个会话的连接
+        self.ha_client = HomeAssistantClient(session, config)
+        if config.get("ha_state_cache", {}).get("enabled", True):
+            self.ha_state_cache = HAStateCache(self.ha_client.intent_matcher)
+            self.ha_client.state_cache = self.ha_state_cache
+        # 同一进程中的API服务器也通过这个客户端调用HomeAssistant
+        share_client(self.ha_client, asyncio.get_running_loop())
         # 初始化小米账号
         self.miboy_account = MiAccount(session, MI_USER, MI_PASS, self.mi_token_home)
         # 强制登录刷新token
@@ -218,15 +277,48 @@ class MiGPT:
         print(f"API地址: {API_BASE}")
         print(f"模型: {MODEL_NAME}")
         
-        self.chatbot = Chatbot(
-            api_key=API_KEY,
-            engine=MODEL_NAME,
-            api_base=API_BASE,
-            api_type=API_TYPE,
+        # 流式时限、服务商熔断与故障转移、多服务商竞速/对冲请求按配置设置
+        self.chatbot = build_chatbot(
+            config, API_KEY, MODEL_NAME, API_BASE, API_TYPE,
+            echo_stream=self.log_level >= 2,  # 调试模式下在控制台回显流式输出
         )
+        if self.chatbot.failover_providers:
+            print(f"故障转移服务商: {', '.join(p.name for p in self.chatbot.failover_providers)}")
+        
+        if self.chatbot.backup_providers:
+            mode = "对冲" if self.chatbot.hedge_delay > 0 else "竞速"
+            print(f"已启用多服务商{mode}请求: {', '.join(p.name for p in self.chatbot.backup_providers)}")
         
         print("AI聊天机器人初始化完成！")
         
+        # 重复问题的回答缓存
+        cache_config = config.get("answer_cache", {})
+        self.answer_cache = None
+        if cache_config.get("enabled", True):
+            self.answer_cache = AnswerCache(
+                ttl=cache_config.get("ttl", 86400),
+                max_entries=cache_config.get("max_entries", 500),
+                max_bytes=cache_config.get("max_bytes", 1024 * 1024),
+                ttl_rules=cache_config.get("ttl_rules"),
+                path=cache_config.get("path") or None,
+            )
+            if self.answer_cache.load():
+                print(f"已加载 {len(self.answer_cache.entries)} 条缓存回答")
+        
+        # 语义回答缓存，匹配换了说法的重复问题，使用与回答缓存相同的缓存时间规则
+        semantic_config = config.get("semantic_cache", {})
+        self.semantic_cache = None
+        if semantic_config.get("enabled", False):
+            self.semantic_cache = SemanticCache(
+                capacity=semantic_config.get("capacity", 10000),
+                threshold=semantic_config.get("threshold", 0.7),
+                ttl=cache_config.get("ttl", 86400),
+                ttl_rules=cache_config.get("ttl_rules"),
+                path=semantic_config.get("path") or None,
+            )
+            if self.semantic_cache.load():
+                print(f"已加载 {len(self.semantic_cache)} 条语义缓存回答")
+        
         # 显示简洁的欢迎信息和使用说明
         self.log_important("MIGPT已启动 - 包含\"请\"、\"帮我\"、\"问一下\"、\"AI\"等关键词的问题将由AI回答")
         self.log_important("命令：help(帮助) | status(状态) | api_logs(切换API日志) | start/stop(启动/停止) | quiet/normal/debug(日志级别)")
@@ -290,6 +382,17 @@ class MiGPT:
                 timestamp, _ = self.get_last_timestamp_and_record(data)
                 self.last_timestamps[device_id] = timestamp
     
+    async def send_tts(self, device, text):
+        """
+        向一个设备发送一次播放请求，并记录发送耗时
+        """
+        with TTS_SECONDS.labels(device.get("deviceID")).time():
+            # 静默发送正常命令，只在日志级别>=2时输出详细信息
+            if self.log_level >= 2:
+                return await self.mina_service.send_message([device], 1, text)
+            # 使用静默版本，避免在控制台输出API请求信息
+            return await self.mina_service.text_to_speech_silent(device.get("deviceID"), text)
+
     async def do_tts(self, text, device_idx=None):
         """
         使用小爱音箱播放文本，支持指定设备
@@ -309,18 +412,13 @@ class MiGPT:
                     max_retries = 2
                     for retry in range(max_retries + 1):
                         try:
-                            # 静默发送正常命令，只在日志级别>=2时输出详细信息
-                            if self.log_level >= 2:
-                                result = await self.mina_service.send_message([device], 1, text)
-                            else:
-                                # 使用静默版本，避免在控制台输出API请求信息
-                                result = await self.mina_service.text_to_speech_silent(device.get("deviceID"), text)
-                                
+                            result = await self.send_tts(device, text)
                             if result:
                                 self.log_debug(f"设备 {device_name} 消息发送成功")
                                 return True
                             else:
                                 if retry < max_retries:
+                                    TTS_RETRIES.labels(device.get("deviceID")).inc()
                                     self.log_debug(f"设备 {device_name} 消息发送失败，尝试重试 ({retry+1}/{max_retries})...")
                                     await asyncio.sleep(0.5)  # 短暂延迟后重试
                                 else:
@@ -328,6 +426,7 @@ class MiGPT:
                                     return False
                         except Exception as retry_err:
                             if retry < max_retries and "ROM端未响应" in str(retry_err):
+                                TTS_RETRIES.labels(device.get("deviceID")).inc()
                                 self.log_debug(f"设备 {device_name} ROM端未响应，尝试重试 ({retry+1}/{max_retries})...")
                                 await asyncio.sleep(0.5)  # 短暂延迟后重试
                             else:
@@ -361,22 +460,18 @@ class MiGPT:
                         max_retries = 1
                         for retry in range(max_retries + 1):
                             try:
-                                # 静默发送正常命令，只在日志级别>=2时输出详细信息
-                                if self.log_level >= 2:
-                                    result = await self.mina_service.send_message([device], 1, text)
-                                else:
-                                    # 使用静默版本，避免在控制台输出API请求信息
-                                    result = await self.mina_service.text_to_speech_silent(device.get("deviceID"), text)
-                                    
+                                result = await self.send_tts(device, text)
                                 if result:
                                     success = True
                                     self.log_debug(f"设备 {device_name} 消息发送成功")
                                     break  # 成功发送后退出重试循环
                                 elif retry < max_retries:
+                                    TTS_RETRIES.labels(device.get("deviceID")).inc()
                                     self.log_debug(f"设备 {device_name} 消息发送失败，尝试重试...")
                                     await asyncio.sleep(0.5)  # 短暂延迟后重试
                             except Exception as retry_err:
                                 if retry < max_retries and "ROM端未响应" in str(retry_err):
+                                    TTS_RETRIES.labels(device.get("deviceID")).inc()
                                     self.log_debug(f"设备 {device_name} ROM端未响应，尝试重试...")
                                     await asyncio.sleep(0.5)  # 短暂延迟后重试
                                 else:
@@ -580,18 +675,191 @@ class MiGPT:
             self.log_debug(f"打断命令执行出错: {e}")
             return False
 
-    async def process_device_input(self, device_idx):
+    def get_convo_id(self, device_idx):
+        """
+        获取设备对应的会话ID，每个设备在聊天机器人中拥有独立的上下文
+        """
+        return "device:" + str(self.devices[device_idx].get("deviceID"))
+    
+    def build_ai_prompt(self, convo_id, cleaned_query):
+        """
+        将用户问题记录到该会话的对话历史，并构建带有历史上下文的提示
+        """
+        history = self.conversation_history.setdefault(convo_id, [])
+        now = time.time()
+        if history and now - self.conversation_times.get(convo_id, 0) > self.conversation_idle_timeout:
+            # 空闲超过上下文有效时间，之后的问题作为新话题
+            history.clear()
+            if self.chatbot is not None and convo_id in self.chatbot.conversation:
+                self.chatbot.reset(convo_id)
+        self.conversation_times[convo_id] = now
+        history.append({"role": "user", "content": cleaned_query})
+        # 保持历史记录在合理范围内
+        del history[:-10]
+        
+        # 构建带有历史上下文的提示
+        context_prompt = ""
+        if len(history) > 1:
+            context_prompt = "请根据我们之前的对话回答以下问题。\n"
+        return context_prompt + cleaned_query + f"\n{PROMPT}"
+    
+    def cache_query_for(self, convo_id, cleaned_query):
+        """
+        返回读写缓存使用的问题，上下文有效时间内已有之前的对话时返回None
+        有上文的问题（如问过天气后的"那明天呢"）的回答依赖上下文，不能用只按问题文本索引的缓存；
+        空闲超过conversation_idle_timeout后build_ai_prompt会清空对话历史，之后的问题重新使用缓存
+        """
+        if len(self.conversation_history.get(convo_id, [])) > 1:
+            return None
+        return cleaned_query
+    
+    def get_cached_answer(self, convo_id, cleaned_query, prompt):
+        """
+        查找重复问题的缓存回答，命中时把这一轮问答记入聊天机器人的会话
+        """
+        answer = None
+        if cleaned_query is None:
+            return None
+        if self.answer_cache is not None:
+            answer = self.answer_cache.get(cleaned_query, self.chatbot.engine, PROMPT)
+            CACHE_LOOKUPS.labels("exact", "miss" if answer is None else "hit").inc()
+        if answer is None and self.semantic_cache is not None:
+            answer = self.semantic_cache.get(cleaned_query, self.chatbot.engine, PROMPT)
+            CACHE_LOOKUPS.labels("semantic", "miss" if answer is None else "hit").inc()
+        if answer is not None:
+            self.chatbot.record_exchange(prompt, answer, convo_id)
+            self.log_info(f"使用缓存回答: {cleaned_query}")
+        return answer
+    
+    def cache_answer(self, cleaned_query, result):
+        """
+        缓存完整生成的回答，被打断或超时的部分回答不缓存
+        """
+        if cleaned_query is None:
+            return
+        if result.finished and not (result.stopped or result.deadline or result.error):
+            for cache in (self.answer_cache, self.semantic_cache):
+                if cache is not None:
+                    cache.put(cleaned_query, result.text, self.chatbot.engine, PROMPT)
+    
+    async def ask_ai(self, prompt, convo_id=CONSOLE_CONVO_ID, timeout=None, cache_query=None):
+        """
+        通过共享的aiohttp会话调用聊天机器人，等待期间不阻塞事件循环
+        时限由聊天机器人的流式时限控制，超过token间隔或总时长时返回已生成的部分回答
+        没有生成任何内容就超时时返回None，传入cache_query时缓存完整的回答
+        """
+        result = ChatResult(convo_id)
+        
+        async def collect():
+            async for _ in self.chatbot.ask_stream_async(prompt, self.session, convo_id=convo_id, result=result):
+                pass
+        
+        try:
+            await asyncio.wait_for(collect(), timeout)
+        except (asyncio.TimeoutError, StreamDeadlineExceeded):
+            return None
+        
+        self.cache_answer(cache_query, result)
+        return result.text
+
+    async def ask_ai_stream_tts(self, prompt, device_idx, convo_id, timeout=None, cache_query=None):
         """
-        处理指定设备的输入
+        边生成边播放：按句子切分AI回答，每句完整后立即发送到设备播放
+        生成与播放并行进行，播放节奏由设备的播放状态控制
+        返回完整回答，超时且没有播放任何内容时返回None，传入cache_query时缓存完整的回答
+        """
+        sentences = asyncio.Queue()
+        chunks = []
+        result = ChatResult(convo_id)
+        
+        async def produce():
+            buffer = ""
+            try:
+                async for content in self.chatbot.ask_stream_async(
+                    prompt, self.session, convo_id=convo_id, result=result
+                ):
+                    chunks.append(content)
+                    buffer += content
+                    ready, buffer = split_sentences(buffer, self.stream_tts_min_chars)
+                    for sentence in ready:
+                        sentences.put_nowait(sentence)
+                if buffer.strip():
+                    sentences.put_nowait(buffer.strip())
+            finally:
+                sentences.put_nowait(None)  # 结束标记
+        
+        producer = asyncio.create_task(asyncio.wait_for(produce(), timeout))
+        spoken = False
+        last_text = ""
+        sent_at = 0
+        try:
+            finished = False
+            while not finished:
+                pending = [await sentences.get()]
+                # 合并播放期间积压的句子，减少发送次数
+                while not sentences.empty():
+                    pending.append(sentences.get_nowait())
+                if None in pending:
+                    finished = True
+                    pending = pending[:pending.index(None)]
+                text = optimize_answer("".join(pending))
+                if not text:
+                    continue
+                
+                if spoken:
+                    await self.wait_for_playback(device_idx, last_text, sent_at)
+                sent_at = time.time()
+                await self.do_tts(text, device_idx)
+                spoken = True
+                last_text = text
+            
+            await producer
+            if result.deadline:
+                self.log_info("AI回答超时，已播放部分回答")
+            self.cache_answer(cache_query, result)
+        except (asyncio.TimeoutError, StreamDeadlineExceeded):
+            if not spoken:
+                return None
+            self.log_info("AI回答超时，已播放部分回答")
+        finally:
+            if not producer.done():
+                producer.cancel()
+        
+        return "".join(chunks)
+    
+    async def wait_for_playback(self, device_idx, text, sent_at):
+        """
+        等待设备播放完上一段文本，避免下一段打断正在播放的内容
+        无法获取播放状态时按文本长度估算播放时间
+        """
+        device_id = self.devices[device_idx].get("deviceID")
+        # 按语速估算的最长等待时间
+        deadline = sent_at + len(text) * 0.3 + 3
+        # 给设备留出开始播放的时间
+        await asyncio.sleep(max(0, sent_at + 0.5 - time.time()))
+        
+        while time.time() < deadline:
+            status = await self.mina_service.get_play_status(device_id)
+            if status is None:
+                # 获取状态失败，按估算的播放时间等待
+                await asyncio.sleep(max(0, sent_at + len(text) * 0.25 - time.time()))
+                return
+            if status != 1:
+                return
+            await asyncio.sleep(0.2)
+
+    async def detect_device_input(self, device_idx):
+        """
+        检测指定设备的新提问，只负责轮询并把新记录放入该设备的队列
         """
         try:
             device = self.devices[device_idx]
             device_id = device.get("deviceID")
             hardware = device.get("hardware", "")
-            device_name = device.get("name", "未命名")
             
             # 获取用户输入 - 直接获取最新数据，不需要额外延迟
-            data = await self.get_latest_ask_from_xiaoai(device_id, hardware)
+            with POLL_SECONDS.labels(device_id).time():
+                data = await self.get_latest_ask_from_xiaoai(device_id, hardware)
             if not data:
                 return
                 
@@ -605,9 +873,70 @@ class MiGPT:
             # 更新时间戳
             self.last_timestamps[device_id] = timestamp
             
-            if not record:
+            if not record or not record.get("query", ""):
                 return
-                
+            # 记录中的时间为毫秒时间戳
+            DETECTION_LAG.labels(device_id).observe(max(0.0, time.time() - timestamp / 1000))
+            
+            queue = self.device_queues.get(device_id)
+            if queue is None:
+                return
+            if queue.full():
+                # 队列已满时丢弃最旧的提问，优先处理最新的提问
+                _, dropped = queue.get_nowait()
+                queue.task_done()
+                QUEUE_DROPPED.labels(device_id).inc()
+                self.log_info(f"设备 {device.get('name', '未命名')} 待处理提问过多，已丢弃: {dropped.get('query', '')}")
+            queue.put_nowait((device_idx, record))
+        except Exception as e:
+            self.log_info(f"检测设备输入时出错: {e}")
+    
+    async def device_worker(self, device_id):
+        """
+        设备处理任务，依次处理该设备队列中的提问
+        """
+        queue = self.device_queues[device_id]
+        while True:
+            device_idx, record = await queue.get()
+            try:
+                await self.process_device_input(device_idx, record)
+            finally:
+                queue.task_done()
+    
+    def ensure_device_workers(self):
+        """
+        确保每个选中的设备都有自己的队列和处理任务，并停止已取消选择设备的任务
+        """
+        selected_ids = set()
+        for device_idx in self.selected_devices:
+            device_id = self.devices[device_idx].get("deviceID")
+            selected_ids.add(device_id)
+            if device_id not in self.device_workers:
+                self.device_queues[device_id] = asyncio.Queue(maxsize=self.device_queue_size)
+                self.device_workers[device_id] = asyncio.create_task(self.device_worker(device_id))
+        
+        for device_id in list(self.device_workers):
+            if device_id not in selected_ids:
+                self.device_workers.pop(device_id).cancel()
+                self.device_queues.pop(device_id, None)
+    
+    async def stop_device_workers(self):
+        """
+        停止所有设备处理任务
+        """
+        workers = list(self.device_workers.values())
+        for task in workers:
+            task.cancel()
+        if workers:
+            await asyncio.gather(*workers, return_exceptions=True)
+        self.device_workers = {}
+        self.device_queues = {}
+    
+    async def process_device_input(self, device_idx, record):
+        """
+        处理指定设备的一条提问记录
+        """
+        try:
             query = record.get("query", "")
             if not query:
                 return
@@ -620,29 +949,26 @@ class MiGPT:
                 print(f"原始记录: {json.dumps(record, ensure_ascii=False, indent=2)}")
                 print(f"提取的回复: {xiaomi_answer}")
             
+            # 一次扫描确定处理方式，并去掉命中的关键词
+            route = keyword_router.route(query)
+            
             # 判断是否使用HomeAssistant处理
-            if should_use_ha(query):
+            if route.route in (ROUTE_HA_VOICE, ROUTE_HA_TEXT):
                 if self.log_level >= 1:
                     print(f"HomeAssistant模式: {query}")  # 简化前缀
-                # 处理用户输入，去掉可能的关键词
-                ha_config = config.get("homeassistant", {})
-                ha_keywords = ha_config.get("ai_keywords", []) + ha_config.get("text_keywords", [])
-                cleaned_query = get_cleaned_input(query, ha_keywords)
+                cleaned_query = route.cleaned
                 
                 try:
                     # 立即发送打断命令，防止小爱自己回复
                     await self.send_stop_command(device_idx)
                     
-                    # 导入api_server模块
-                    import api_server
-                    
-                    # 判断是使用语音指令还是文本指令
-                    if any(keyword in query for keyword in ha_config.get("ai_keywords", [])):
+                    # 判断是使用语音指令还是文本指令，请求期间不阻塞其他设备的轮询
+                    if route.route == ROUTE_HA_VOICE:
                         # 使用语音指令
-                        answer = api_server.send_ha_voice_command(cleaned_query)
+                        answer = await self.ha_client.send_voice_command(cleaned_query)
                     else:
                         # 使用文本指令
-                        answer = api_server.send_ha_command(cleaned_query)
+                        answer = await self.ha_client.send_command(cleaned_query)
                     
                     # 只在日志级别>=1时输出回答，避免重复输出
                     if self.log_level >= 1:
@@ -680,77 +1006,63 @@ class MiGPT:
                     return  # 处理完成，返回
             
             # 判断是否使用AI助手回答
-            if should_use_ai(query) and SWITCH:
+            if route.route == ROUTE_AI and SWITCH:
                 if self.log_level >= 1:
                     print(f"AI模式: {query}")  # 简化前缀
-                # 处理用户输入，去掉可能的关键词
-                cleaned_query = get_cleaned_input(query)
+                cleaned_query = route.cleaned
                 
                 # 立即发送打断命令，防止小爱自己回复
                 await self.send_stop_command(device_idx)
                 
-                # 将用户问题添加到对话历史
-                self.conversation_history.append({"role": "user", "content": cleaned_query})
-                # 保持历史记录在合理范围内
-                if len(self.conversation_history) > 10:
-                    self.conversation_history = self.conversation_history[-10:]
-                
-                # 构建带有历史上下文的提示
-                context_prompt = ""
-                if len(self.conversation_history) > 1:
-                    context_prompt = "请根据我们之前的对话回答以下问题。\n"
+                # 每个设备使用独立的会话，多个设备可同时提问
+                convo_id = self.get_convo_id(device_idx)
+                prompt = self.build_ai_prompt(convo_id, cleaned_query)
+                cache_query = self.cache_query_for(convo_id, cleaned_query)
                 
                 try:
-                    # 使用AI模型回答
-                    lock = threading.Lock()
-                    stop_event = threading.Event()
-                    t = threading.Thread(
-                        target=self.chatbot.ask_stream,
-                        args=(
-                            context_prompt + cleaned_query + f"\n{PROMPT}",
-                            lock,
-                            stop_event,
-                        ),
-                    )
-                    t.start()
-                    t.join(timeout=30)
+                    # 使用AI模型回答，生成期间事件循环继续处理其他设备
+                    spoken = False
+                    answer = self.get_cached_answer(convo_id, cache_query, prompt)
+                    if answer is not None:
+                        pass
+                    elif self.stream_tts:
+                        # 流式播放模式下回答已在生成过程中逐句发送到设备
+                        answer = await self.ask_ai_stream_tts(prompt, device_idx, convo_id, cache_query=cache_query)
+                        spoken = answer is not None
+                    else:
+                        answer = await self.ask_ai(prompt, convo_id, cache_query=cache_query)
                     
-                    if t.is_alive():
+                    if answer is None:
                         self.log_info("AI回答超时")
-                        stop_event.set()  # 通知线程停止
-                        t.join()
                         answer = "抱歉，AI回答超时，请稍后再试。"
                     else:
-                        # 获取回答并发送
-                        answer = self.chatbot.sentence
-                        self.chatbot.sentence = ""
-                        
                         # 对回答进行后处理，使其更自然
                         answer = optimize_answer(answer)
                     
                     # 将AI回答添加到对话历史
-                    self.conversation_history.append({"role": "assistant", "content": answer})
+                    self.conversation_history[convo_id].append({"role": "assistant", "content": answer})
                     
                     # 只在日志级别>=1时输出回答，避免重复输出
                     if self.log_level >= 1:
                         print(f"AI回答: {answer}")
                     
                     # 向发出请求的设备回复，捕获可能的错误
-                    try:
-                        await self.do_tts(answer, device_idx)
-                    except Exception as e:
-                        self.log_info(f"AI回复发送失败: {e}")
-                        # 尝试发送到其他设备
-                        if device_idx in self.selected_devices and len(self.selected_devices) > 1:
-                            other_devices = [idx for idx in self.selected_devices if idx != device_idx]
-                            self.log_info(f"尝试发送到其他设备...")
-                            for other_idx in other_devices:
-                                try:
-                                    if await self.do_tts(answer, other_idx):
-                                        self.log_info(f"成功通过备用设备发送回复")
-                                        break
-                                except Exception:
-                                    continue
+                    if not spoken:
+                        try:
+                            await self.do_tts(answer, device_idx)
+                        except Exception as e:
+                            self.log_info(f"AI回复发送失败: {e}")
+                            # 尝试发送到其他设备
+                            if device_idx in self.selected_devices and len(self.selected_devices) > 1:
+                                other_devices = [idx for idx in self.selected_devices if idx != device_idx]
+                                self.log_info(f"尝试发送到其他设备...")
+                                for other_idx in other_devices:
+                                    try:
+                                        if await self.do_tts(answer, other_idx):
+                                            self.log_info(f"成功通过备用设备发送回复")
+                                            break
+                                    except Exception:
+                                        continue
                 except Exception as e:
                     self.log_info(f"AI回答出错: {e}")
                     # 准备错误消息
@@ -784,12 +1096,14 @@ class MiGPT:
     
     async def process_all_devices(self):
         """
-        处理所有选中设备的输入
+        轮询所有选中设备的输入，新提问交给各设备的处理任务，不在这里等待回答
         """
+        self.ensure_device_workers()
+        
         # 静默处理，不输出任务创建信息
         tasks = []
         for device_idx in self.selected_devices:
-            task = asyncio.create_task(self.process_device_input(device_idx))
+            task = asyncio.create_task(self.detect_device_input(device_idx))
             tasks.append(task)
         
         # 等待所有任务完成
@@ -857,6 +1171,18 @@ class MiGPT:
                     self.log_important(f"日志级别: {self.log_level} ({'详细' if self.log_level == 2 else '普通' if self.log_level == 1 else '安静'})")
                     self.log_important(f"API请求日志: {'显示' if self.show_api_logs else '隐藏'}")
                     self.log_important(f"选中设备: {', '.join([self.devices[idx].get('name', '未命名') for idx in self.selected_devices])}")
+                    if self.answer_cache is not None:
+                        stats = self.answer_cache.stats()
+                        self.log_important(
+                            f"回答缓存: {stats['entries']}条，命中{stats['hits']}次，"
+                            f"未命中{stats['misses']}次，命中率{stats['hit_rate']:.0%}"
+                        )
+                    if self.semantic_cache is not None:
+                        stats = self.semantic_cache.stats()
+                        self.log_important(
+                            f"语义缓存: {stats['entries']}条，命中{stats['hits']}次，"
+                            f"未命中{stats['misses']}次，命中率{stats['hit_rate']:.0%}"
+                        )
                     self.log_important("====================\n")
                 elif command.lower() == 'exit' or command.lower() == '退出':
                     self.log_important("程序即将退出...")
@@ -880,54 +1206,32 @@ class MiGPT:
                 elif command:
                     # 如果是其他命令，尝试向设备发送消息
                     if self.selected_devices:
-                        # 判断是否使用AI助手回答
-                        if should_use_ai(command) and SWITCH:
+                        # 判断是否使用AI助手回答，控制台输入不走HomeAssistant
+                        route = keyword_router.route(command, allow_ha=False)
+                        if route.route == ROUTE_AI and SWITCH:
                             if self.log_level >= 1:
                                 print(f"AI模式: {command}")
-                            # 处理用户输入，去掉可能的关键词
-                            cleaned_query = get_cleaned_input(command)
-                            
-                            # 将用户问题添加到对话历史
-                            self.conversation_history.append({"role": "user", "content": cleaned_query})
+                            cleaned_query = route.cleaned
                             
-                            # 保持历史记录在合理范围内
-                            if len(self.conversation_history) > 10:
-                                self.conversation_history = self.conversation_history[-10:]
-                            
-                            # 构建带有历史上下文的提示
-                            context_prompt = ""
-                            if len(self.conversation_history) > 1:
-                                context_prompt = "请根据我们之前的对话回答以下问题。\n"
+                            # 控制台使用独立的会话
+                            prompt = self.build_ai_prompt(CONSOLE_CONVO_ID, cleaned_query)
+                            cache_query = self.cache_query_for(CONSOLE_CONVO_ID, cleaned_query)
                             
                             try:
-                                # 使用AI回答
-                                lock = threading.Lock()
-                                stop_event = threading.Event()
-                                t = threading.Thread(
-                                    target=self.chatbot.ask_stream,
-                                    args=(
-                                        context_prompt + cleaned_query + f"\n{PROMPT}",
-                                        lock,
-                                        stop_event,
-                                    ),
-                                )
-                                t.start()
-                                t.join(timeout=30)
+                                # 使用AI回答，重复问题直接使用缓存回答
+                                answer = self.get_cached_answer(CONSOLE_CONVO_ID, cache_query, prompt)
+                                if answer is None:
+                                    answer = await self.ask_ai(prompt, CONSOLE_CONVO_ID, cache_query=cache_query)
                                 
-                                if t.is_alive():
+                                if answer is None:
                                     self.log_info("AI回答超时")
-                                    stop_event.set()
-                                    t.join()
                                     answer = "抱歉，AI回答超时，请稍后再试。"
                                 else:
-                                    answer = self.chatbot.sentence
-                                    self.chatbot.sentence = ""
-                                    
                                     # 对回答进行后处理
                                     answer = optimize_answer(answer)
                                 
                                 # 将AI回答添加到对话历史
-                                self.conversation_history.append({"role": "assistant", "content": answer})
+                                self.conversation_history[CONSOLE_CONVO_ID].append({"role": "assistant", "content": answer})
                                 
                                 if self.log_level >= 1:
                                     print(f"以下是AI的回答: {answer}")
@@ -967,6 +1271,10 @@ class MiGPT:
         # 启动命令处理任务
         command_task = asyncio.create_task(self.command_handler())
         
+        # 启动HomeAssistant状态订阅任务
+        if self.ha_state_cache is not None:
+            self.ha_state_task = asyncio.create_task(self.ha_state_cache.run(self.session, self.ha_client))
+        
         # 定义轮询间隔（秒）
         polling_interval = 0.05  # 减少轮询间隔以提高响应速度
         
@@ -996,14 +1304,26 @@ class MiGPT:
                 import traceback
                 traceback.print_exc()
         finally:
-            # 等待命令处理任务完成
-            command_task.cancel()
-            try:
-                await command_task
-            except asyncio.CancelledError:
-                pass
+            # 停止设备处理任务
+            await self.stop_device_workers()
+            
+            # 保存回答缓存
+            for cache in (self.answer_cache, self.semantic_cache):
+                if cache is not None:
+                    cache.save()
+            
+            # 等待命令处理任务和状态订阅任务完成
+            for task in (command_task, self.ha_state_task):
+                if task is None:
+                    continue
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
             
             # 关闭会话
+            share_client(None, None)
             if self.session:
                 await self.session.close()
             
@@ -1,10 +1,566 @@
 """
 A simple wrapper for the official ChatGPT API and BigModel API
 """
+import asyncio
 import json
+import os
+import sys
+import aiohttp
 import requests
 import tiktoken
 import threading  # 添加这一行导入threading模块
+import time
+
+import metrics
+
+# tiktoken编码文件的本地缓存目录，首次联网加载后离线环境也能直接使用
+TIKTOKEN_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "tiktoken")
+
+_encodings: dict = {}
+_encoding_lock = threading.Lock()
+
+LLM_FIRST_TOKEN = metrics.histogram(
+    "migpt_llm_first_token_seconds", "Time from request to the first answer token", ["provider"])
+LLM_TOTAL = metrics.histogram(
+    "migpt_llm_total_seconds", "Time from request to the end of a streamed answer", ["provider"])
+LLM_RESULTS = metrics.counter(
+    "migpt_llm_requests_total", "Provider requests by outcome (success / failure)", ["provider", "result"])
+LLM_BREAKER_OPENS = metrics.counter(
+    "migpt_llm_breaker_opens_total", "Times a provider's circuit breaker opened", ["provider"])
+
+
+def _load_encoding(name: str) -> None:
+    """
+    Load a tiktoken encoding from the local cache (downloading it if needed)
+    """
+    os.makedirs(os.environ["TIKTOKEN_CACHE_DIR"], exist_ok=True)
+    try:
+        _encodings[name] = tiktoken.get_encoding(name)
+    except Exception as e:
+        print(f"加载tiktoken编码 {name} 失败，使用字符数估算token: {e}")
+        _encodings[name] = None
+
+
+def get_encoding(name: str):
+    """
+    Get a memoised tiktoken encoding, loading it lazily in the background
+    Returns None until the encoding is available, so callers never block on it
+    """
+    if name in _encodings:
+        return _encodings[name]
+    with _encoding_lock:
+        if name not in _encodings:
+            os.environ.setdefault("TIKTOKEN_CACHE_DIR", TIKTOKEN_CACHE_DIR)
+            # 标记为加载中，避免重复启动加载线程
+            _encodings[name] = None
+            threading.Thread(target=_load_encoding, args=(name,), daemon=True).start()
+    return _encodings[name]
+
+
+class TiktokenCounter:
+    """
+    Count tokens with a tiktoken BPE encoding
+    """
+
+    def __init__(self, encoding_name: str) -> None:
+        self.encoding_name = encoding_name
+        # 提前开始加载编码
+        get_encoding(encoding_name)
+
+    def __call__(self, text: str) -> int:
+        encoding = get_encoding(self.encoding_name)
+        if encoding is None:
+            return len(text) // 4  # 编码未就绪时回退到简单估算
+        return len(encoding.encode(text, disallowed_special=()))
+
+
+class CharRatioCounter:
+    """
+    Estimate tokens from the character count
+    """
+
+    def __init__(self, chars_per_token: int) -> None:
+        self.chars_per_token = chars_per_token
+
+    def __call__(self, text: str) -> int:
+        return len(text) // self.chars_per_token
+
+
+def encoding_name_for_model(engine: str, default: str = "cl100k_base") -> str:
+    """
+    Look up the tiktoken encoding name of a model, falling back to the default
+    tiktoken<0.6 has no encoding_name_for_model, so read its model tables directly
+    """
+    try:
+        import tiktoken.model as tiktoken_model
+
+        lookup = getattr(tiktoken_model, "encoding_name_for_model", None)
+        if lookup is not None:
+            return lookup(engine)
+        if engine in tiktoken_model.MODEL_TO_ENCODING:
+            return tiktoken_model.MODEL_TO_ENCODING[engine]
+        for prefix, name in tiktoken_model.MODEL_PREFIX_TO_ENCODING.items():
+            if engine.startswith(prefix):
+                return name
+    except Exception:
+        pass
+    return default
+
+
+# https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+def resolve_token_counter(engine: str, api_type: str):
+    """
+    Resolve the token counting strategy of an engine once
+    """
+    engine = engine or ""
+    # DeepSeek、方舟、Siliconflow QwQ-32B、百度千帆、智谱AI等模型，简单估算中文约为2个字符一个token
+    if (
+            engine in ("deepseek-chat", "glm-4-flash", "ai-virtual-mate")
+            or "ark-model" in engine
+            or "QwQ-32B" in engine
+            or engine.startswith("ernie-")
+            or api_type == "bigmodel"
+    ):
+        return CharRatioCounter(2)
+    # OpenAI模型使用tiktoken精确计数
+    if engine.startswith("gpt-3.5-turbo") or engine.startswith("gpt-4") or engine == "text-davinci-002-render-sha":
+        return TiktokenCounter(encoding_name_for_model(engine))
+    # 默认处理方式，简单估算，大多数模型
+    return CharRatioCounter(3)
+
+
+# 方舟平台常见模型名称到正确模型ID的映射
+VOLCENGINE_MODEL_MAP = {
+    "DeepSeek-R1": "deepseek-r1-250120",   # 添加版本号
+    "deepseek-r1": "deepseek-r1-250120",   # 添加版本号
+    "DeepSeek-V3": "deepseek-v3-250324",   # 添加最新推荐版本号
+    "deepseek-v3": "deepseek-v3-250324",   # 添加最新推荐版本号
+    "deepseek-v3-250324": "deepseek-v3-250324", # 完整ID直接保留
+    "deepseek-v3-241226": "deepseek-v3-241226", # 完整ID直接保留
+    "ark-model": "doubao-1.5-pro-32k-250115"    # 默认使用推荐模型
+}
+
+
+class ProviderProfile:
+    """
+    Provider specific request settings, resolved once per configuration
+    The hot path only merges the messages and the token budget into the template
+    """
+
+    def __init__(
+            self,
+            name: str,
+            api_url: str,
+            headers: dict,
+            payload_template: dict,
+            max_tokens_key: str = "max_tokens",
+            max_tokens_cap: int = None,
+            send_user: bool = False,
+    ) -> None:
+        self.name = name
+        self.api_url = api_url
+        self.headers = headers
+        self.payload_template = payload_template
+        self.stream = payload_template.get("stream", True)
+        self.max_tokens_key = max_tokens_key
+        self.max_tokens_cap = max_tokens_cap
+        self.send_user = send_user
+
+    def build_payload(self, messages: list, max_tokens: int, role: str = "user") -> dict:
+        """
+        Merge the messages and the remaining token budget into the payload template
+        """
+        payload = dict(self.payload_template)
+        payload["messages"] = messages
+        if self.max_tokens_key:
+            if self.max_tokens_cap is not None:
+                max_tokens = min(self.max_tokens_cap, max_tokens)
+            payload[self.max_tokens_key] = max_tokens
+        if self.send_user:
+            payload["user"] = role
+        return payload
+
+
+def build_provider_profile(
+        api_type: str,
+        api_base: str,
+        engine: str,
+        api_key: str,
+        temperature: float = 0.5,
+        top_p: float = 1.0,
+        presence_penalty: float = 0.0,
+        frequency_penalty: float = 0.0,
+        reply_count: int = 1,
+        name: str = None,
+) -> ProviderProfile:
+    """
+    Resolve URL, headers and payload template for a provider
+    """
+    api_base = api_base or ""
+    engine = engine or ""
+    # 清理API密钥，移除可能的换行符和空白字符
+    clean_api_key = api_key.strip() if api_key else ""
+    
+    # 统一的请求头，所有API类型（包括千帆的bce-v3格式密钥）都使用标准Bearer令牌认证
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {clean_api_key}",
+    }
+    
+    # 基础payload
+    payload = {
+        "model": engine,
+        "stream": True,
+        "temperature": temperature,
+        "top_p": top_p,
+    }
+    max_tokens_key = "max_tokens"
+    max_tokens_cap = None
+    send_user = False
+    
+    # 根据API类型添加特定参数
+    if api_type == "openai":
+        kind = "openai"
+        payload.update({
+            "presence_penalty": presence_penalty,
+            "frequency_penalty": frequency_penalty,
+            "n": reply_count,
+        })
+        send_user = True
+        api_url = f"{api_base or 'https://api.openai.com/v1'}/chat/completions"
+    elif api_type == "bigmodel":
+        # 智谱AI特定参数
+        kind = "bigmodel"
+        max_tokens_key = None
+        api_url = f"{api_base}/chat/completions"
+    elif engine == "deepseek-chat":
+        # DeepSeek API特殊处理，确保API基础URL正确
+        kind = "deepseek"
+        base_url = api_base
+        if base_url.endswith('/v1'):
+            base_url = base_url[:-3]  # 移除尾部的 /v1
+        if not base_url:
+            base_url = "https://api.deepseek.com"
+        api_url = f"{base_url}/chat/completions"
+        print(f"使用DeepSeek API: {api_url}")
+    elif "ark-model" in engine or "DeepSeek" in engine or "volces.com" in api_base:
+        # Volcengine (方舟平台) API特殊处理，模型ID可能需要修正
+        kind = "volcengine"
+        model_name = VOLCENGINE_MODEL_MAP.get(engine, engine)
+        if model_name != engine:
+            print(f"方舟平台模型名称已映射: {engine} -> {model_name}")
+        payload["model"] = model_name
+        api_url = f"{api_base}/chat/completions"
+        print(f"使用方舟API: {api_url}，模型: {model_name}")
+        # 添加模型访问检查提示
+        print("注意: 请确认您的API密钥有权限访问此模型，并且模型ID格式正确")
+        print("方舟平台支持的模型可在控制台-模型列表中查看")
+    elif "QwQ-32B" in engine or "Qwen/" in engine:
+        # Siliconflow API特殊处理
+        kind = "siliconflow"
+        max_tokens_cap = 512
+        payload.update({
+            "frequency_penalty": 0.5,  # Siliconflow特定默认值
+            "top_k": 50,               # Siliconflow特定参数
+            "response_format": {"type": "text"}, # 指定返回格式
+            # 尝试非流式请求，Siliconflow可能与流式请求有兼容性问题
+            "stream": False,
+        })
+        api_url = f"{api_base}/chat/completions"
+        print(f"使用Siliconflow API: {api_url}")
+    elif engine.startswith("ernie-"):
+        # 百度千帆API特殊处理，不支持presence_penalty和frequency_penalty
+        kind = "qianfan"
+        max_tokens_key = "max_completion_tokens"
+        # 确保使用正确的ernie模型ID格式
+        if engine == "ernie-3.5":
+            payload["model"] = "ernie-3.5-8k"
+            print(f"已修正模型名称为: {payload['model']}")
+        api_url = f"{api_base}/chat/completions"
+        print(f"使用百度千帆API: {api_url}")
+        print("模型: " + payload["model"])
+    else:
+        # 通用第三方API（custom类型）
+        # 大多数第三方API都兼容OpenAI格式，但可能不支持所有参数
+        kind = "custom"
+        api_url = f"{api_base}/chat/completions"
+    
+    # 特别针对千帆API的调试信息
+    if "qianfan" in api_base:
+        print(f"千帆API请求URL: {api_url}")
+        print(f"千帆API认证头: {headers['Authorization'][:15]}...")
+        print(f"千帆API请求模型: {payload['model']}")
+    
+    return ProviderProfile(
+        name or kind,
+        api_url,
+        headers,
+        payload,
+        max_tokens_key=max_tokens_key,
+        max_tokens_cap=max_tokens_cap,
+        send_user=send_user,
+    )
+
+
+# 流式响应结束标记
+SSE_DONE = object()
+
+
+def parse_sse_line(line: bytes):
+    """
+    Parse one server-sent event line of a chat completion stream, working on bytes
+    Returns (role, content), SSE_DONE for the end marker, or None for lines to skip
+    """
+    # aiohttp返回的行带有换行符，requests的iter_lines则没有
+    if line.endswith(b"\n"):
+        line = line.rstrip(b"\r\n")
+    if not line:
+        return None
+    if line.startswith(b"data:"):
+        line = line[6:] if line[5:6] == b" " else line[5:]
+        if line == b"[DONE]":
+            return SSE_DONE
+    elif line[:1] != b"{":
+        # event:、id:、注释等其他SSE字段
+        return None
+    try:
+        resp: dict = json.loads(line)
+    except ValueError:
+        print(f"Failed to parse JSON: {line[:200]!r}")
+        return None
+    choices = resp.get("choices")
+    if not choices:
+        return None
+    # 对于Siliconflow等一些API，可能直接返回完整消息
+    delta = choices[0].get("delta") or choices[0].get("message")
+    if not delta:
+        return None
+    return delta.get("role"), delta.get("content")
+
+
+class StreamEcho:
+    """
+    Optional console echo of streamed deltas, written in batches
+    """
+
+    def __init__(self, enabled: bool, flush_chars: int = 64) -> None:
+        self.enabled = enabled
+        self.flush_chars = flush_chars
+        self.buffer = []
+        self.size = 0
+
+    def write(self, content: str) -> None:
+        if not self.enabled:
+            return
+        self.buffer.append(content)
+        self.size += len(content)
+        if self.size >= self.flush_chars or "\n" in content:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.buffer:
+            sys.stdout.write("".join(self.buffer))
+            sys.stdout.flush()
+            self.buffer = []
+            self.size = 0
+
+    def close(self) -> None:
+        if self.enabled:
+            self.flush()
+            sys.stdout.write("\n")
+            sys.stdout.flush()
+
+
+class ChatResult:
+    """
+    Result of a single ask call, so concurrent calls never share answer state
+    """
+
+    def __init__(self, convo_id: str = "default") -> None:
+        self.convo_id = convo_id
+        self.role = "assistant"
+        self.chunks = []
+        self.text = ""
+        self.error = None
+        self.stopped = False
+        self.finished = False
+        # 回答因时限提前结束时的时限名称（inter_token / total）
+        self.deadline = None
+
+    def append(self, content: str) -> None:
+        """
+        Collect an answer delta
+        """
+        self.chunks.append(content)
+
+    def finish(self) -> None:
+        """
+        Join the collected deltas into the final text
+        """
+        self.text = "".join(self.chunks)
+        self.finished = True
+
+    def fail(self, error: str) -> None:
+        """
+        Record an error, the error message becomes the answer text
+        """
+        self.error = error
+        self.text = error
+        self.finished = True
+
+
+class ProviderError(Exception):
+    """
+    A provider request failed, status is the HTTP status code if there was a response
+    """
+
+    def __init__(self, message: str, status: int = None) -> None:
+        super().__init__(message)
+        self.status = status
+
+
+class StreamDeadlineExceeded(ProviderError):
+    """
+    A provider missed the connect or first-token deadline before producing any content
+    """
+    NAMES = {"connect": "连接", "first_token": "首个token", "inter_token": "token间隔", "total": "总时长"}
+
+    def __init__(self, deadline: str) -> None:
+        super().__init__(f"AI服务商超过{self.NAMES.get(deadline, deadline)}时限未响应")
+        self.deadline = deadline
+
+
+class StreamDeadlines:
+    """
+    Deadlines in seconds for one streamed answer, None disables a deadline
+    connect bounds the TCP connect, first_token the wait for the first content token,
+    inter_token the gap between content tokens and total the whole generation
+    """
+
+    def __init__(
+            self,
+            connect: float = 10.0,
+            first_token: float = 30.0,
+            inter_token: float = 30.0,
+            total: float = None,
+    ) -> None:
+        self.connect = connect
+        self.first_token = first_token
+        self.inter_token = inter_token
+        self.total = total
+
+    def read_timeout(self):
+        """
+        Socket read timeout used as a backstop, the longest of the token deadlines
+        """
+        timeouts = [t for t in (self.first_token, self.inter_token) if t is not None]
+        return max(timeouts) if timeouts else None
+
+    def next_wait(self, started: float, last_token_at: float = None):
+        """
+        Seconds until the nearest deadline and its name, (None, None) when unbounded
+        """
+        candidates = []
+        if last_token_at is None:
+            if self.first_token is not None:
+                candidates.append((started + self.first_token, "first_token"))
+        elif self.inter_token is not None:
+            candidates.append((last_token_at + self.inter_token, "inter_token"))
+        if self.total is not None:
+            candidates.append((started + self.total, "total"))
+        if not candidates:
+            return None, None
+        at, name = min(candidates)
+        return max(0.0, at - time.monotonic()), name
+
+
+class ProviderHealth:
+    """
+    Health of one provider: first-token latency, error counters and a circuit breaker
+    The circuit opens after failure_threshold consecutive failures (at once on 429)
+    and after cooldown seconds lets a single half-open probe request through
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 3, cooldown: float = 30.0) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.successes = 0
+        self.failures = 0
+        self.last_status = None
+        self.latency = None  # 首个token延迟的指数移动平均（秒）
+        self.opened_at = 0.0
+        self.probe_started = 0.0
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        """
+        Whether a request may be sent now, claims the half-open probe when due
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if self.state == self.OPEN and now - self.opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+                self.probe_started = now
+                return True
+            if self.state == self.HALF_OPEN and now - self.probe_started >= self.cooldown:
+                # 上一个试探请求没有结果，再放行一个
+                self.probe_started = now
+                return True
+            return False
+
+    def record_success(self, latency: float) -> None:
+        LLM_FIRST_TOKEN.labels(self.name).observe(latency)
+        LLM_RESULTS.labels(self.name, "success").inc()
+        with self._lock:
+            self.successes += 1
+            self.consecutive_failures = 0
+            self.latency = latency if self.latency is None else self.latency * 0.7 + latency * 0.3
+            if self.state != self.CLOSED:
+                print(f"服务商 {self.name} 已恢复")
+                self.state = self.CLOSED
+
+    def record_failure(self, status: int = None) -> None:
+        LLM_RESULTS.labels(self.name, "failure").inc()
+        with self._lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            self.last_status = status
+            if (
+                self.state == self.HALF_OPEN
+                or status == 429
+                or self.consecutive_failures >= self.failure_threshold
+            ):
+                if self.state != self.OPEN:
+                    LLM_BREAKER_OPENS.labels(self.name).inc()
+                    print(f"服务商 {self.name} 暂时不可用，{self.cooldown:g}秒后重试")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def release(self) -> None:
+        """
+        Give back a half-open probe that was cancelled before it produced a result
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state,
+                "latency": self.latency,
+                "successes": self.successes,
+                "failures": self.failures,
+                "last_status": self.last_status,
+            }
 
 
 class Chatbot:
@@ -26,6 +582,8 @@ class Chatbot:
             system_prompt: str = "You are ChatGPT, a large language model trained by OpenAI. Respond conversationally",
             api_base: str = None,
             api_type: str = "openai",  # 新增参数，用于区分API类型
+            truncate_limit: int = None,
+            echo_stream: bool = False,
     ) -> None:
         """
         Initialize Chatbot with API key
@@ -39,15 +597,27 @@ class Chatbot:
 
         self.system_prompt = system_prompt
         self.max_tokens = max_tokens
+        # 对话历史的token上限，剩余部分留给回答
+        self.truncate_limit = truncate_limit or max(max_tokens // 2, max_tokens - 1000)
         self.temperature = temperature
         self.top_p = top_p
         self.presence_penalty = presence_penalty
         self.frequency_penalty = frequency_penalty
         self.reply_count = reply_count
-
-        self.sentence = ""
-        self.temp = ""  # 确保初始化为空字符串
-        self.has_printed = False
+        # 是否在控制台回显流式输出
+        self.echo_stream = echo_stream
+        # 竞速/对冲请求使用的备用服务商，见configure_race
+        self.backup_providers = []
+        self.hedge_delay = 0.0
+        # 故障转移服务商及各服务商的健康状态，见configure_failover
+        self.failover_providers = []
+        self.health: dict = {}
+        self.failure_threshold = 3
+        self.breaker_cooldown = 30.0
+        # 流式回答的各项时限，见configure_deadlines
+        self.deadlines = StreamDeadlines()
+        # 解析一次服务商请求配置和token计数方式
+        self._configure_provider()
 
         if self.proxy:
             proxies = {
@@ -55,18 +625,15 @@ class Chatbot:
                 "https": self.proxy,
             }
             self.session.proxies = proxies
-        self.conversation: dict = {
-            "default": [
-                {
-                    "role": "system",
-                    "content": system_prompt,
-                },
-            ],
-        }
+        self.conversation: dict = {}
+        # 每条消息的token数（与conversation中的消息一一对应）及每个会话的token总数
+        self.conversation_tokens: dict = {}
+        self.conversation_token_total: dict = {}
+        self.reset(convo_id="default", system_prompt=system_prompt)
         if max_tokens > 4000:
             raise Exception("Max tokens cannot be greater than 4000")
 
-        if self.get_token_count("default") > self.max_tokens:
+        if self.conversation_token_total["default"] > self.max_tokens:
             raise Exception("System prompt is too long")
 
     def add_to_conversation(
@@ -76,409 +643,711 @@ class Chatbot:
             convo_id: str = "default",
     ) -> None:
         """
-        Add a message to the conversation
+        Add a message to the conversation, its token count is computed once here
         """
+        tokens = self.get_token_count(message)
         self.conversation[convo_id].append({"role": role, "content": message})
+        self.conversation_tokens[convo_id].append(tokens)
+        self.conversation_token_total[convo_id] += tokens
+
+    def _recount_conversation(self, convo_id: str) -> None:
+        """
+        Rebuild the cached token counts of a conversation
+        """
+        tokens = [self.get_token_count(msg.get("content") or "") for msg in self.conversation[convo_id]]
+        self.conversation_tokens[convo_id] = tokens
+        self.conversation_token_total[convo_id] = sum(tokens)
 
     def __truncate_conversation(self, convo_id: str = "default") -> None:
         """
         Truncate the conversation
         """
-        while True:
-            if (
-                    self.get_token_count(convo_id) > self.max_tokens
-                    and len(self.conversation[convo_id]) > 1
-            ):
-                # Don't remove the first message
-                self.conversation[convo_id].pop(1)
-            else:
-                break
+        messages = self.conversation[convo_id]
+        tokens = self.conversation_tokens[convo_id]
+        while (
+                self.conversation_token_total[convo_id] > self.truncate_limit
+                and len(messages) > 1
+        ):
+            # Don't remove the first message
+            messages.pop(1)
+            self.conversation_token_total[convo_id] -= tokens.pop(1)
 
-    # https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-    def get_token_count(self, prompt):
+    def get_token_count(self, prompt) -> int:
         """
         Get token count for different models
         """
-        # 为特定模型设置token计数方法
-        if self.engine == "deepseek-chat":
-            # DeepSeek 使用类似GPT-3.5的token计数方式，但简化处理
-            return len(prompt) // 2  # 简单估算中文约为2个字符一个token
-            
-        # Volcengine (方舟平台)特定处理
-        if "ark-model" in self.engine:
-            return len(prompt) // 2  # 简单估算
-        
-        # Siliconflow QwQ-32B特定处理  
-        if "QwQ-32B" in self.engine:
-            return len(prompt) // 2  # 简单估算
-            
-        # 百度千帆平台特定处理
-        if self.engine.startswith("ernie-"):
-            return len(prompt) // 2  # 简单估算中文约为2个字符一个token
-        
-        # For BigModel API
-        if self.api_type == "bigmodel":
-            # 对于智谱AI的模型，使用默认的token计数方法
-            return len(prompt) // 2  # 简单估算中文约为2个字符一个token
-        
-        # For OpenAI models
-        if self.engine.startswith("gpt-3.5-turbo"):
-            try:
-                encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-                if isinstance(prompt, str):
-                    return len(encoding.encode(prompt))
-                elif isinstance(prompt, list):
-                    return sum(len(encoding.encode(msg["content"])) for msg in prompt)
-                elif isinstance(prompt, dict):
-                    return sum(len(encoding.encode(str(val))) for val in prompt.values())
-                else:
-                    return len(prompt) // 4  # 回退到简单估算
-            except Exception:
-                return len(prompt) // 4  # 出错时回退到简单估算
-        elif self.engine.startswith("gpt-4"):
-            try:
-                encoding = tiktoken.encoding_for_model("gpt-4")
-                if isinstance(prompt, str):
-                    return len(encoding.encode(prompt))
-                elif isinstance(prompt, list):
-                    return sum(len(encoding.encode(msg["content"])) for msg in prompt)
-                elif isinstance(prompt, dict):
-                    return sum(len(encoding.encode(str(val))) for val in prompt.values())
-                else:
-                    return len(prompt) // 4  # 回退到简单估算
-            except Exception:
-                return len(prompt) // 4  # 出错时回退到简单估算
-        elif self.engine == "text-davinci-002-render-sha":
-            try:
-                encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
-                if isinstance(prompt, str):
-                    return len(encoding.encode(prompt))
-                else:
-                    return len(prompt) // 4  # 回退到简单估算
-            except Exception:
-                return len(prompt) // 4  # 出错时回退到简单估算
-        elif self.engine == "glm-4-flash":
-            # 添加对glm-4-flash的支持，使用简单的token估算
-            return len(prompt) // 2  # 简单估算中文约为2个字符一个token
-        elif self.engine == "ai-virtual-mate":
-            # 添加对ai-virtual-mate的支持，使用简单的token估算
-            return len(prompt) // 2  # 简单估算中文约为2个字符一个token
-        else:
-            # 默认处理方式
-            return len(prompt) // 3  # 简单估算，大多数模型
+        if isinstance(prompt, str):
+            return self._count_tokens(prompt)
+        elif isinstance(prompt, list):
+            return sum(self._count_tokens(msg.get("content") or "") for msg in prompt)
+        elif isinstance(prompt, dict):
+            return sum(self._count_tokens(str(val)) for val in prompt.values())
+        return len(prompt) // 4  # 回退到简单估算
 
     def get_max_tokens(self, convo_id: str) -> int:
         """
         Get max tokens
         """
-        return self.max_tokens - self.get_token_count(convo_id)
+        return self.max_tokens - self.conversation_token_total[convo_id]
 
-    def ask_stream(
-            self,
-            prompt: str,
-            lock: threading.Lock,
-            stop_event: threading.Event,
-            role: str = "user",
-            convo_id: str = "default",
-    ) -> None:
-        """Ask a question"""
-        self.has_printed = False
-        # 确保初始化为空字符串
-        self.sentence = ""
-        self.temp = ""
-        
+    def _prepare_conversation(self, prompt: str, convo_id: str) -> None:
+        """
+        Append the prompt to the conversation and truncate it
+        """
         # Make conversation if it doesn't exist
         if convo_id not in self.conversation:
             self.reset(convo_id=convo_id, system_prompt=self.system_prompt)
         self.add_to_conversation(prompt, "user", convo_id=convo_id)
         self.__truncate_conversation(convo_id=convo_id)
-        
-        # 清理API密钥，移除可能的换行符和空白字符
-        clean_api_key = self.api_key.strip() if self.api_key else ""
-        
-        # 统一的请求头
-        headers = {
-            "Content-Type": "application/json"
-        }
-        
-        # 设置Bearer令牌认证，针对不同API类型进行特殊处理
-        if self.api_type == "custom" and "qianfan" in self.api_base:
-            # 千帆API特殊处理，使用Bearer令牌格式
-            if not clean_api_key.startswith("bce-v3"):
-                # 如果不是bce-v3格式，尝试使用标准Bearer格式
-                headers["Authorization"] = f"Bearer {clean_api_key}"
-            else:
-                # 如果是bce-v3格式，千帆要求直接使用此格式
-                headers["Authorization"] = f"Bearer {clean_api_key}"
-                
-            # 添加可能需要的额外头部
-            headers["Content-Type"] = "application/json"
-        else:
-            # 其他API类型使用标准Authorization头
-            headers["Authorization"] = f"Bearer {clean_api_key}"
-        
-        # 基础payload
-        payload = {
-            "model": self.engine,
-            "messages": self.conversation[convo_id],
-            "stream": True,
-            "temperature": self.temperature,
-            "top_p": self.top_p,
-        }
-        
-        # 根据API类型添加特定参数
-        if self.api_type == "openai":
-            payload.update({
-                "presence_penalty": self.presence_penalty,
-                "frequency_penalty": self.frequency_penalty,
-                "n": self.reply_count,
-                "user": role,
-                "max_tokens": self.get_max_tokens(convo_id=convo_id),
-            })
-            api_url = f"{self.api_base or 'https://api.openai.com/v1'}/chat/completions"
-        elif self.api_type == "bigmodel":
-            # 智谱AI特定参数
-            api_url = f"{self.api_base}/chat/completions"
-        elif self.engine == "deepseek-chat":
-            # DeepSeek API特殊处理
-            payload.update({
-                "max_tokens": self.get_max_tokens(convo_id=convo_id),
-            })
-            # 确保API基础URL正确
-            base_url = self.api_base
-            if base_url.endswith('/v1'):
-                base_url = base_url[:-3]  # 移除尾部的 /v1
-            if not base_url:
-                base_url = "https://api.deepseek.com"
-                
-            api_url = f"{base_url}/chat/completions"
-            print(f"使用DeepSeek API: {api_url}")
-        elif "ark-model" in self.engine or "DeepSeek" in self.engine or self.api_base and "volces.com" in self.api_base:
-            # Volcengine (方舟平台) API特殊处理
-            # 方舟平台模型ID可能需要修正
-            # 根据文档，需要使用正确的Model ID
-            
-            # 从常见模型名称映射到方舟平台的正确模型ID
-            volcengine_model_map = {
-                "DeepSeek-R1": "deepseek-r1-250120",   # 添加版本号
-                "deepseek-r1": "deepseek-r1-250120",   # 添加版本号
-                "DeepSeek-V3": "deepseek-v3-250324",   # 添加最新推荐版本号
-                "deepseek-v3": "deepseek-v3-250324",   # 添加最新推荐版本号
-                "deepseek-v3-250324": "deepseek-v3-250324", # 完整ID直接保留
-                "deepseek-v3-241226": "deepseek-v3-241226", # 完整ID直接保留
-                "ark-model": "doubao-1.5-pro-32k-250115"    # 默认使用推荐模型
-            }
-            
-            # 检查是否需要替换模型名称
-            model_name = self.engine
-            if model_name in volcengine_model_map:
-                model_name = volcengine_model_map[model_name]
-                print(f"方舟平台模型名称已映射: {self.engine} -> {model_name}")
-            
-            payload.update({
-                "model": model_name,
-                "max_tokens": self.get_max_tokens(convo_id=convo_id),
-            })
-            api_url = f"{self.api_base}/chat/completions"
-            print(f"使用方舟API: {api_url}，模型: {model_name}")
-            
-            # 添加模型访问检查提示
-            print("注意: 请确认您的API密钥有权限访问此模型，并且模型ID格式正确")
-            print("方舟平台支持的模型可在控制台-模型列表中查看")
-        elif "QwQ-32B" in self.engine or "Qwen/" in self.engine:
-            # Siliconflow API特殊处理
-            payload.update({
-                "max_tokens": min(512, self.get_max_tokens(convo_id=convo_id)),
-                "temperature": self.temperature,
-                "top_p": self.top_p,
-                "frequency_penalty": 0.5,  # Siliconflow特定默认值
-                "top_k": 50,               # Siliconflow特定参数
-                "response_format": {"type": "text"} # 指定返回格式
-            })
-            # 移除不支持的参数
-            if "enable_thinking" in payload:
-                del payload["enable_thinking"]
-                
-            # 尝试非流式请求，Siliconflow可能与流式请求有兼容性问题
-            payload["stream"] = False
-                
-            api_url = f"{self.api_base}/chat/completions"
-            print(f"使用Siliconflow API: {api_url}")
-        elif self.engine.startswith("ernie-"):
-            # 百度千帆API特殊处理
-            payload.update({
-                "max_completion_tokens": self.get_max_tokens(convo_id=convo_id),
-                "stream": True
-            })
-            # 移除千帆API不支持的参数
-            if "presence_penalty" in payload:
-                del payload["presence_penalty"]
-            if "frequency_penalty" in payload:
-                del payload["frequency_penalty"]
-                
-            # 确保使用正确的ernie模型ID格式
-            if self.engine == "ernie-3.5":
-                self.engine = "ernie-3.5-8k"
-                print(f"已修正模型名称为: {self.engine}")
-                payload["model"] = self.engine
-                
-            api_url = f"{self.api_base}/chat/completions"
-            print(f"使用百度千帆API: {api_url}")
-            print("模型: " + self.engine)
-        else:
-            # 通用第三方API（custom类型）
-            # 大多数第三方API都兼容OpenAI格式，但可能不支持所有参数
-            payload.update({
-                "max_tokens": self.get_max_tokens(convo_id=convo_id),
-            })
-            api_url = f"{self.api_base}/chat/completions"
-        
-        # 发送请求
+
+    def _configure_provider(self) -> None:
+        """
+        Resolve the provider profile and the token counter for the current settings
+        """
+        self.provider = build_provider_profile(
+            self.api_type,
+            self.api_base,
+            self.engine,
+            self.api_key,
+            temperature=self.temperature,
+            top_p=self.top_p,
+            presence_penalty=self.presence_penalty,
+            frequency_penalty=self.frequency_penalty,
+            reply_count=self.reply_count,
+        )
+        # 按模型确定一次token计数方式
+        self._count_tokens = resolve_token_counter(self.engine, self.api_type)
+
+    def _build_request(self, role: str, convo_id: str):
+        """
+        Build the request from the provider profile, returns (api_url, headers, payload)
+        """
+        provider = self.provider
+        payload = provider.build_payload(self.conversation[convo_id], self.get_max_tokens(convo_id), role)
+        return provider.api_url, provider.headers, payload
+
+    @staticmethod
+    def _format_api_error(status_code, reason, body: str) -> str:
+        """
+        Build a readable error message from a failed API response
+        """
+        # 增强错误信息
+        error_msg = f"错误状态码: {status_code} {reason}"
         try:
-            # 特别针对千帆API的调试信息
-            if self.api_base and "qianfan" in self.api_base:
-                print(f"千帆API请求URL: {api_url}")
-                print(f"千帆API认证头: {headers['Authorization'][:15]}..." if 'Authorization' in headers else "无认证头")
-                print(f"千帆API请求模型: {self.engine}")
-                
-            response = self.session.post(
-                api_url,
-                headers=headers,
-                json=payload,
-                stream=True,
-                timeout=30,  # 添加超时设置
-            )
-                
-            if response.status_code != 200:
-                # 增强错误信息
-                error_msg = f"错误状态码: {response.status_code} {response.reason}"
-                try:
-                    error_data = response.json()
-                    if isinstance(error_data, dict):
-                        if "error" in error_data:
-                            error_detail = error_data["error"]
-                            error_msg += f"\n错误详情: {error_detail.get('message', '')}"
-                            error_msg += f"\n错误码: {error_detail.get('code', '')}"
-                            error_msg += f"\n错误类型: {error_detail.get('type', '')}"
-                            
-                            # 针对特定错误提供解决方案
-                            if "invalid_appId" in error_msg or "No permission" in error_msg:
-                                error_msg += "\n\n可能的解决方案:"
-                                error_msg += "\n1. 请确认您的API Key格式正确且未过期"
-                                error_msg += "\n2. 请在千帆控制台(https://console.bce.baidu.com/qianfan)确认您有权限访问所选模型"
-                                error_msg += "\n3. 尝试在控制台创建新的API Key并更新config.json"
-                                error_msg += "\n4. 如果使用长效API Key，请尝试获取短期API Key"
-                except:
-                    error_msg += f"\n原始响应: {response.text}"
+            error_data = json.loads(body)
+            if isinstance(error_data, dict):
+                if "error" in error_data:
+                    error_detail = error_data["error"]
+                    error_msg += f"\n错误详情: {error_detail.get('message', '')}"
+                    error_msg += f"\n错误码: {error_detail.get('code', '')}"
+                    error_msg += f"\n错误类型: {error_detail.get('type', '')}"
                     
-                raise Exception(f"API请求失败: {error_msg}")
-                
-            response_role: str = None
-            full_response: str = ""
+                    # 针对特定错误提供解决方案
+                    if "invalid_appId" in error_msg or "No permission" in error_msg:
+                        error_msg += "\n\n可能的解决方案:"
+                        error_msg += "\n1. 请确认您的API Key格式正确且未过期"
+                        error_msg += "\n2. 请在千帆控制台(https://console.bce.baidu.com/qianfan)确认您有权限访问所选模型"
+                        error_msg += "\n3. 尝试在控制台创建新的API Key并更新config.json"
+                        error_msg += "\n4. 如果使用长效API Key，请尝试获取短期API Key"
+        except:
+            error_msg += f"\n原始响应: {body}"
+        return error_msg
+
+    def _provider_health(self, provider: ProviderProfile) -> ProviderHealth:
+        health = self.health.get(provider.name)
+        if health is None:
+            health = self.health[provider.name] = ProviderHealth(
+                provider.name, self.failure_threshold, self.breaker_cooldown
+            )
+        return health
 
+    def _stream_provider_sync(
+            self,
+            provider: ProviderProfile,
+            payload: dict,
+            stop_event,
+            state: "ChatResult",
+    ):
+        """
+        Blocking counterpart of _stream_provider over the requests session
+        Token deadlines can only be checked between lines here, a stalled
+        socket is bounded by the read timeout
+        """
+        health = self._provider_health(provider)
+        deadlines = self.deadlines
+        started = time.monotonic()
+        produced = False
+        try:
+            try:
+                response = self.session.post(
+                    provider.api_url,
+                    headers=provider.headers,
+                    json=payload,
+                    stream=True,
+                    timeout=(deadlines.connect, deadlines.read_timeout()),
+                )
+            except requests.exceptions.ConnectTimeout:
+                raise StreamDeadlineExceeded("connect")
+            except requests.exceptions.ReadTimeout:
+                raise StreamDeadlineExceeded("first_token")
+            if response.status_code != 200:
+                error_msg = self._format_api_error(response.status_code, response.reason, response.text)
+                raise ProviderError(f"API请求失败: {error_msg}", response.status_code)
+            
             # 特殊处理非流式响应
-            if not payload.get("stream", True):
-                try:
-                    resp_json = response.json()
-                    if "choices" in resp_json and resp_json["choices"]:
-                        message = resp_json["choices"][0].get("message", {})
-                        if message and "content" in message:
-                            content = message.get("content", "")
-                            role = message.get("role", "assistant")
-                            if content:  # 确保content不为None
-                                self.sentence = content
-                                print(content)
-                                full_response = content
-                                self.has_printed = True
-                                self.add_to_conversation(full_response, role, convo_id=convo_id)
-                                return
-                except Exception as e:
-                    print(f"\n处理非流式响应时出错: {str(e)}")
-                    self.sentence = f"API响应解析错误: {str(e)}"
-                    self.has_printed = True
-                    return
+            if not provider.stream:
+                resp_json = response.json()
+                if "choices" in resp_json and resp_json["choices"]:
+                    message = resp_json["choices"][0].get("message", {})
+                    content = message.get("content") if message else None
+                    if content:  # 确保content不为None
+                        state.role = message.get("role", "assistant")
+                        health.record_success(time.monotonic() - started)
+                        produced = True
+                        yield content
+                return
             
             # 流式响应处理
-            for line in response.iter_lines():
-                if stop_event.is_set():
-                    self.temp = ""
+            last_token_at = None
+            lines = response.iter_lines()
+            while True:
+                try:
+                    line = next(lines, None)
+                except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+                    # 流式读取中的读超时会以ConnectionError抛出
+                    if not produced:
+                        raise StreamDeadlineExceeded("first_token")
+                    self._cut_stream(health, state, "inter_token")
+                    return
+                if line is None:
+                    break
+                if stop_event is not None and stop_event.is_set():
+                    state.stopped = True
                     return
-                if not line:
+                wait, deadline = deadlines.next_wait(started, last_token_at)
+                if wait == 0:
+                    if not produced:
+                        raise StreamDeadlineExceeded(deadline)
+                    self._cut_stream(health, state, deadline)
+                    return
+                event = parse_sse_line(line)
+                if event is None:
                     continue
-                # Remove "data: "
-                line = line.decode("utf-8")
-                if line.startswith("data: "):
-                    line = line[6:]
-                if line == "[DONE]":
+                if event is SSE_DONE:
                     break
+                delta_role, content = event
+                if delta_role:
+                    state.role = delta_role
+                if content:
+                    last_token_at = time.monotonic()
+                    if not produced:
+                        health.record_success(last_token_at - started)
+                        produced = True
+                    yield content
+            if not produced:
+                health.record_success(time.monotonic() - started)
+        except GeneratorExit:
+            if not produced:
+                health.release()
+            raise
+        except Exception as e:
+            health.record_failure(getattr(e, "status", None))
+            raise
+        finally:
+            if produced:
+                LLM_TOTAL.labels(provider.name).observe(time.monotonic() - started)
+
+    def ask_stream(
+            self,
+            prompt: str,
+            stop_event: threading.Event = None,
+            role: str = "user",
+            convo_id: str = "default",
+            result: "ChatResult" = None,
+    ) -> "ChatResult":
+        """Ask a question, the answer is collected into a per-call ChatResult"""
+        if result is None:
+            result = ChatResult(convo_id)
+        
+        self._prepare_conversation(prompt, convo_id)
+        messages = self.conversation[convo_id]
+        max_tokens = self.get_max_tokens(convo_id)
+        
+        # 依次尝试主服务商和故障转移服务商，跳过熔断中的服务商
+        providers = [self.provider] + self.failover_providers
+        last_error = None
+        attempted = False
+        echo = StreamEcho(self.echo_stream)
+        for index, provider in enumerate(providers):
+            if not self._provider_health(provider).allow_request():
+                continue
+            attempted = True
+            payload = provider.build_payload(messages, max_tokens, role)
+            produced = False
+            try:
+                for content in self._stream_provider_sync(provider, payload, stop_event, result):
+                    produced = True
+                    echo.write(content)
+                    result.append(content)
+                last_error = None
+                break
+            except Exception as e:
+                last_error = e
+                if produced:
+                    break
+                if index < len(providers) - 1:
+                    print(f"服务商 {provider.name} 请求失败: {e}")
+        echo.close()
+        
+        if not attempted:
+            last_error = ProviderError("所有AI服务商暂时不可用，请稍后再试")
+        if isinstance(last_error, requests.exceptions.RequestException):
+            print(f"\nAPI请求错误: {str(last_error)}")
+            result.fail(f"API请求错误: {str(last_error)}")
+            return result
+        if isinstance(last_error, ValueError):
+            print(f"\n处理非流式响应时出错: {str(last_error)}")
+            result.fail(f"API响应解析错误: {str(last_error)}")
+            return result
+        if last_error is not None:
+            raise last_error
+        
+        result.finish()
+        if not result.stopped:
+            self.add_to_conversation(result.text, result.role, convo_id=convo_id)
+        return result
+
+    async def _stream_provider(
+            self,
+            session: aiohttp.ClientSession,
+            provider: ProviderProfile,
+            payload: dict,
+            stop_event,
+            state: "ChatResult",
+    ):
+        """
+        Stream one request to one provider and yield the content deltas
+        The response role and stop flag are recorded in state, latency and
+        failures in the provider's health
+        """
+        health = self._provider_health(provider)
+        deadlines = self.deadlines
+        started = time.monotonic()
+        produced = False
+        try:
+            try:
+                # 响应头也要在首个token时限内到达
+                response = await asyncio.wait_for(
+                    session.post(
+                        provider.api_url,
+                        headers=provider.headers,
+                        json=payload,
+                        proxy=self.proxy,
+                        timeout=aiohttp.ClientTimeout(
+                            sock_connect=deadlines.connect,
+                            sock_read=deadlines.read_timeout(),
+                        ),
+                    ),
+                    deadlines.next_wait(started)[0],
+                )
+            except asyncio.TimeoutError as e:
+                # 读超时不短于首个token时限，aiohttp自身的超时只会来自连接阶段
+                raise StreamDeadlineExceeded("connect" if isinstance(e, aiohttp.ServerTimeoutError) else "first_token")
+            async with response:
+                if response.status != 200:
+                    error_msg = self._format_api_error(response.status, response.reason, await response.text())
+                    raise ProviderError(f"API请求失败: {error_msg}", response.status)
+                
+                # 特殊处理非流式响应
+                if not provider.stream:
+                    resp_json = await response.json(content_type=None)
+                    if "choices" in resp_json and resp_json["choices"]:
+                        message = resp_json["choices"][0].get("message", {})
+                        content = message.get("content") if message else None
+                        if content:
+                            state.role = message.get("role", "assistant")
+                            health.record_success(time.monotonic() - started)
+                            produced = True
+                            yield content
+                    return
+                
+                # 流式响应处理
+                echo = StreamEcho(self.echo_stream)
+                last_token_at = None
                 try:
-                    resp: dict = json.loads(line)
-                    choices = resp.get("choices")
-                    if not choices:
+                    while True:
+                        wait, deadline = deadlines.next_wait(started, last_token_at)
+                        try:
+                            line = await asyncio.wait_for(response.content.readline(), wait)
+                        except asyncio.TimeoutError:
+                            if not produced:
+                                raise StreamDeadlineExceeded(deadline)
+                            self._cut_stream(health, state, deadline)
+                            return
+                        if not line:
+                            break
+                        if stop_event is not None and stop_event.is_set():
+                            state.stopped = True
+                            return
+                        event = parse_sse_line(line)
+                        if event is None:
+                            continue
+                        if event is SSE_DONE:
+                            break
+                        delta_role, content = event
+                        if delta_role:
+                            state.role = delta_role
+                        if content:
+                            last_token_at = time.monotonic()
+                            if not produced:
+                                health.record_success(last_token_at - started)
+                                produced = True
+                            echo.write(content)
+                            yield content
+                finally:
+                    echo.close()
+            if not produced:
+                health.record_success(time.monotonic() - started)
+        except (asyncio.CancelledError, GeneratorExit):
+            # 被取消（如竞速落败）不计为失败
+            if not produced:
+                health.release()
+            raise
+        except Exception as e:
+            health.record_failure(getattr(e, "status", None))
+            raise
+        finally:
+            if produced:
+                LLM_TOTAL.labels(provider.name).observe(time.monotonic() - started)
+
+    @staticmethod
+    def _cut_stream(health: ProviderHealth, state: "ChatResult", deadline: str) -> None:
+        """
+        End a stream that missed a deadline after producing content, keeping the partial answer
+        """
+        state.deadline = deadline
+        if deadline == "inter_token":
+            # 生成中途卡住也说明服务商状态不佳
+            health.record_failure()
+        print(f"\nAI回答超过{StreamDeadlineExceeded.NAMES[deadline]}时限，已提前结束")
+
+    async def _failover_providers(
+            self,
+            session: aiohttp.ClientSession,
+            providers: list,
+            messages: list,
+            max_tokens: int,
+            role: str,
+            stop_event,
+            state: "ChatResult",
+    ):
+        """
+        Stream from the first provider that answers, skipping providers whose
+        circuit is open and moving on when one fails before its first token
+        """
+        last_error = None
+        attempted = False
+        for index, provider in enumerate(providers):
+            if not self._provider_health(provider).allow_request():
+                continue
+            attempted = True
+            payload = provider.build_payload(messages, max_tokens, role)
+            produced = False
+            try:
+                async for content in self._stream_provider(session, provider, payload, stop_event, state):
+                    produced = True
+                    yield content
+                return
+            except Exception as e:
+                if produced:
+                    raise
+                last_error = e
+                if index < len(providers) - 1:
+                    print(f"服务商 {provider.name} 请求失败: {e}")
+        if not attempted:
+            raise ProviderError("所有AI服务商暂时不可用，请稍后再试")
+        if last_error is not None:
+            raise last_error
+
+    async def _race_providers(
+            self,
+            session: aiohttp.ClientSession,
+            providers: list,
+            messages: list,
+            max_tokens: int,
+            role: str,
+            stop_event,
+            state: "ChatResult",
+    ):
+        """
+        Fire the same messages at several providers, stream from the first one
+        that produces a token and cancel the rest
+        With hedge_delay > 0 the backups are only fired if the primary has not
+        produced a token within that delay (or has failed)
+        """
+        pending = {}  # 等待首个token的任务 -> (服务商, 生成器, 状态)
+        
+        attempted = False
+        
+        def launch(provider):
+            nonlocal attempted
+            if not self._provider_health(provider).allow_request():
+                return False
+            attempted = True
+            racer_state = ChatResult(state.convo_id)
+            payload = provider.build_payload(messages, max_tokens, role)
+            gen = self._stream_provider(session, provider, payload, stop_event, racer_state)
+            pending[asyncio.ensure_future(gen.__anext__())] = (provider, gen, racer_state)
+            return True
+        
+        loop = asyncio.get_running_loop()
+        hedge_at = loop.time() + self.hedge_delay
+        primary_started = launch(providers[0])
+        backups = list(providers[1:])
+        if self.hedge_delay <= 0 or not primary_started:
+            for provider in backups:
+                launch(provider)
+            backups = []
+        
+        winner = None
+        losers = []
+        last_error = None
+        try:
+            while pending and winner is None:
+                timeout = max(0.0, hedge_at - loop.time()) if backups else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # 主服务商在对冲延迟内没有返回首个token，发出备用请求
+                    for provider in backups:
+                        launch(provider)
+                    backups = []
+                    continue
+                for task in done:
+                    provider, gen, racer_state = pending.pop(task)
+                    try:
+                        first = task.result()
+                    except StopAsyncIteration:
                         continue
-                    delta = choices[0].get("delta")
-                    if not delta:
-                        # 对于Siliconflow等一些API，可能直接返回完整消息
-                        message = choices[0].get("message")
-                        if message and message.get("content"):
-                            content = message.get("content")
-                            # 确保content不为None
-                            if content is not None:
-                                success = lock.acquire(blocking=False)
-                                if success:
-                                    try:
-                                        # 确保self.temp是字符串
-                                        temp_str = self.temp if self.temp is not None else ""
-                                        content_str = content if content is not None else ""
-                                        self.sentence += temp_str + content_str
-                                        self.temp = ""
-                                    finally:
-                                        lock.release()
-                                else:
-                                    # 确保self.temp是字符串
-                                    self.temp = (self.temp or "") + (content or "")
-                                print(content, end="")
-                                # 确保content不为None后再拼接
-                                full_response = (full_response or "") + (content or "")
+                    except Exception as e:
+                        last_error = e
+                        print(f"服务商 {provider.name} 请求失败: {e}")
                         continue
-                    if "role" in delta:
-                        response_role = delta["role"]
-                    if "content" in delta:
-                        content = delta["content"]
-                        # 确保content不为None
-                        if content is not None:
-                            success = lock.acquire(blocking=False)
-                            if success:
-                                try:
-                                    # 确保所有变量都是字符串，防止None连接错误
-                                    temp_str = self.temp if self.temp is not None else ""
-                                    content_str = content if content is not None else ""
-                                    self.sentence += temp_str + content_str
-                                    self.temp = ""
-                                finally:
-                                    lock.release()
-                            else:
-                                # 确保self.temp始终是字符串
-                                self.temp = (self.temp or "") + (content or "")
-                            print(content, end="")
-                            # 确保content不为None后再拼接
-                            full_response = (full_response or "") + (content or "")
-                except json.JSONDecodeError:
-                    print(f"Failed to parse JSON: {line}")
-                    continue
-                    
-            print()
-            self.has_printed = True
-            # 确保full_response不为None
-            if full_response:
-                self.add_to_conversation(full_response, response_role or "assistant", convo_id=convo_id)
-            else:
-                self.add_to_conversation("", response_role or "assistant", convo_id=convo_id)
-                
-        except requests.exceptions.RequestException as e:
-            print(f"\nAPI请求错误: {str(e)}")
-            self.sentence = f"API请求错误: {str(e)}"
-            self.has_printed = True
+                    if winner is None:
+                        winner = (provider, gen, racer_state, first)
+                    else:
+                        losers.append(gen)
+                if winner is None and not pending and backups:
+                    # 主服务商已失败，立即发出备用请求
+                    for provider in backups:
+                        launch(provider)
+                    backups = []
+        finally:
+            # 取消其余请求
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+            for _, gen, _ in pending.values():
+                await gen.aclose()
+            for gen in losers:
+                await gen.aclose()
+        
+        if winner is None:
+            if last_error is not None:
+                raise last_error
+            if not attempted:
+                raise ProviderError("所有AI服务商暂时不可用，请稍后再试")
+            return
+        
+        provider, gen, racer_state, first = winner
+        try:
+            yield first
+            async for content in gen:
+                yield content
+        finally:
+            await gen.aclose()
+            state.role = racer_state.role
+            state.stopped = racer_state.stopped
+            state.deadline = racer_state.deadline
+
+    async def _race_then_failover(
+            self,
+            session: aiohttp.ClientSession,
+            messages: list,
+            max_tokens: int,
+            role: str,
+            stop_event,
+            state: "ChatResult",
+    ):
+        """
+        Race the primary and the race backups (skipping open circuits), then fall back
+        in llm_failover order to the failover presets that were not part of the race
+        if every racer failed before producing a token
+        """
+        racers = [self.provider] + self.backup_providers
+        raced = {provider.name for provider in racers}
+        fallback = [provider for provider in self.failover_providers if provider.name not in raced]
+        produced = False
+        try:
+            async for content in self._race_providers(session, racers, messages, max_tokens, role, stop_event, state):
+                produced = True
+                yield content
+            return
+        except Exception as e:
+            if produced or not fallback:
+                raise
+            print(f"竞速的服务商都不可用({e})，按故障转移顺序继续尝试")
+        async for content in self._failover_providers(
+                session, fallback, messages, max_tokens, role, stop_event, state):
+            yield content
+
+    def configure_race(self, presets: dict, names: list, hedge_delay: float = 0.0) -> None:
+        """
+        Race (hedge_delay == 0) or hedge (hedge_delay > 0) requests across api_presets
+        The configured provider stays the primary, the named presets are the backups
+        """
+        self.backup_providers = self._preset_profiles(presets, names)
+        self.hedge_delay = hedge_delay
+
+    def configure_deadlines(
+            self,
+            connect: float = None,
+            first_token: float = None,
+            inter_token: float = None,
+            total: float = None,
+    ) -> None:
+        """
+        Set the streaming deadlines in seconds, None disables a deadline
+        """
+        self.deadlines = StreamDeadlines(connect, first_token, inter_token, total)
+
+    def configure_failover(
+            self,
+            presets: dict,
+            names: list,
+            failure_threshold: int = 3,
+            cooldown: float = 30.0,
+    ) -> None:
+        """
+        Fail over to the named api_presets, in order, when the primary fails or its circuit is open
+        """
+        self.failover_providers = self._preset_profiles(presets, names)
+        self.failure_threshold = failure_threshold
+        self.breaker_cooldown = cooldown
+        for health in self.health.values():
+            health.failure_threshold = failure_threshold
+            health.cooldown = cooldown
+
+    def _preset_profiles(self, presets: dict, names: list) -> list:
+        """
+        Build provider profiles for the named api_presets, a preset may carry its own api_key
+        """
+        profiles = []
+        for name in names:
+            preset = presets.get(name)
+            if not preset:
+                print(f"未找到API预设: {name}，已跳过")
+                continue
+            profiles.append(build_provider_profile(
+                preset.get("api_type", "custom"),
+                preset.get("api_base"),
+                preset.get("model"),
+                preset.get("api_key") or self.api_key,
+                temperature=preset.get("temperature", self.temperature),
+                top_p=preset.get("top_p", self.top_p),
+                presence_penalty=preset.get("presence_penalty", self.presence_penalty),
+                frequency_penalty=preset.get("frequency_penalty", self.frequency_penalty),
+                reply_count=self.reply_count,
+                name=name,
+            ))
+        return profiles
+
+    async def ask_stream_async(
+            self,
+            prompt: str,
+            session: aiohttp.ClientSession,
+            stop_event=None,
+            role: str = "user",
+            convo_id: str = "default",
+            result: "ChatResult" = None,
+    ):
+        """
+        Ask a question through an aiohttp session and yield the answer deltas
+        The final answer is also collected into the optional per-call ChatResult
+        """
+        if result is None:
+            result = ChatResult(convo_id)
+        
+        self._prepare_conversation(prompt, convo_id)
+        messages = self.conversation[convo_id]
+        max_tokens = self.get_max_tokens(convo_id)
+        
+        async for content in self._stream_messages(session, messages, max_tokens, role, stop_event, result):
+            yield content
+        
+        if not result.stopped:
+            self.add_to_conversation(result.text, result.role, convo_id=convo_id)
+
+    async def ask_messages_async(
+            self,
+            messages: list,
+            session: aiohttp.ClientSession,
+            stop_event=None,
+            result: "ChatResult" = None,
+    ):
+        """
+        Stream an answer for a complete message list (e.g. from an OpenAI-compatible
+        client) without touching the stored conversations
+        The system prompt is prepended when the list has none, and the oldest
+        non-system messages are dropped to fit the truncate limit
+        """
+        if result is None:
+            result = ChatResult()
+        
+        messages = [{"role": msg.get("role", "user"), "content": msg.get("content") or ""} for msg in messages]
+        if not messages or messages[0]["role"] != "system":
+            messages.insert(0, {"role": "system", "content": self.system_prompt})
+        tokens = [self.get_token_count(msg["content"]) for msg in messages]
+        total = sum(tokens)
+        while total > self.truncate_limit and len(messages) > 2:
+            messages.pop(1)
+            total -= tokens.pop(1)
+        
+        async for content in self._stream_messages(
+                session, messages, self.max_tokens - total, "user", stop_event, result):
+            yield content
+
+    async def _stream_messages(
+            self,
+            session: aiohttp.ClientSession,
+            messages: list,
+            max_tokens: int,
+            role: str,
+            stop_event,
+            result: "ChatResult",
+    ):
+        """
+        Stream the answer from the configured providers (racing or failover) into result
+        """
+        if self.backup_providers:
+            stream = self._race_then_failover(session, messages, max_tokens, role, stop_event, result)
+        else:
+            stream = self._failover_providers(
+                session, [self.provider] + self.failover_providers, messages, max_tokens, role, stop_event, result
+            )
+        
+        async for content in stream:
+            result.append(content)
+            yield content
+        
+        result.finish()
+
+    def record_exchange(self, prompt: str, answer: str, convo_id: str = "default") -> None:
+        """
+        Add a question answered without the API (e.g. from a cache) to the conversation
+        """
+        self._prepare_conversation(prompt, convo_id)
+        self.add_to_conversation(answer, "assistant", convo_id=convo_id)
 
     def rollback(self, n: int = 1, convo_id: str = "default") -> None:
         """
@@ -486,14 +1355,16 @@ class Chatbot:
         """
         for _ in range(n):
             self.conversation[convo_id].pop()
+            self.conversation_token_total[convo_id] -= self.conversation_tokens[convo_id].pop()
 
     def reset(self, convo_id: str = "default", system_prompt: str = None) -> None:
         """
         Reset the conversation
         """
-        self.conversation[convo_id] = [
-            {"role": "system", "content": system_prompt or self.system_prompt},
-        ]
+        self.conversation[convo_id] = []
+        self.conversation_tokens[convo_id] = []
+        self.conversation_token_total[convo_id] = 0
+        self.add_to_conversation(system_prompt or self.system_prompt, "system", convo_id=convo_id)
 
     def save(self, file: str, *convo_ids: str) -> bool:
         """
@@ -520,7 +1391,11 @@ class Chatbot:
                     convos = json.load(f)
                     self.conversation.update({k: convos[k] for k in convo_ids})
                 else:
-                    self.conversation = json.load(f)
+                    convos = self.conversation = json.load(f)
+                    self.conversation_tokens = {}
+                    self.conversation_token_total = {}
+            for convo_id in convo_ids or convos:
+                self._recount_conversation(convo_id)
         except (FileNotFoundError, KeyError, json.decoder.JSONDecodeError):
             return False
         return True
@@ -578,7 +1453,14 @@ class Chatbot:
                             config.get("frequency_penalty") or self.frequency_penalty
                     )
                     self.reply_count = config.get("reply_count") or self.reply_count
+                    
+                    # 配置可能已变化，重新解析服务商请求配置并重新计数
+                    self._configure_provider()
+                    for convo_id in self.conversation:
+                        self._recount_conversation(convo_id)
+                    
                     self.max_tokens = config.get("max_tokens") or self.max_tokens
+                    self.truncate_limit = config.get("truncate_limit") or self.truncate_limit
 
                     if config.get("system_prompt") is not None:
                         self.system_prompt = (
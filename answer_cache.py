@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+回答缓存模块 - 缓存重复问题的AI回答，相同问题直接复用，不再请求AI服务商
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+# 指向之前对话的说法，包含这些词的追问不使用缓存
+# 代词、"为什么"等在独立问题中也很常见（如"为什么天是蓝的"），不在此列；
+# 上下文有效时间内的连续提问由MiGPT按会话判断
+FOLLOW_UP_MARKERS = (
+    "刚才", "刚刚", "上一个", "上一条", "继续", "接着说", "然后呢", "还有呢",
+    "再说一遍", "再来一个", "换一个", "另一个",
+)
+
+# 每个缓存条目除问题和回答之外的大致内存开销（字节）
+ENTRY_OVERHEAD = 200
+
+
+def normalize_query(query):
+    """
+    统一问题的写法：全角转半角、小写，去掉空白和标点
+    """
+    query = unicodedata.normalize("NFKC", query).lower()
+    return "".join(
+        ch for ch in query
+        if not ch.isspace() and not unicodedata.category(ch).startswith("P")
+    )
+
+
+def is_follow_up(query):
+    """
+    判断是否是依赖上下文的追问
+    """
+    return any(marker in query for marker in FOLLOW_UP_MARKERS)
+
+
+def resolve_ttl(query, default_ttl, ttl_rules):
+    """
+    按关键词规则确定问题的缓存时间（秒），0表示不缓存
+    """
+    for rule in ttl_rules or []:
+        if any(keyword in query for keyword in rule.get("keywords", [])):
+            return rule.get("ttl", default_ttl)
+    return default_ttl
+
+
+class AnswerCache:
+    """
+    按问题精确匹配的回答缓存，带过期时间和LRU淘汰
+    键由规范化后的问题、模型和提示词组成，超出条目数或内存上限时淘汰最久未使用的回答
+    """
+
+    def __init__(self, ttl=86400, max_entries=500, max_bytes=1024 * 1024, ttl_rules=None, path=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # 按关键词设置过期时间，如时间类问题不缓存、天气类问题短时间缓存
+        self.ttl_rules = ttl_rules or []
+        self.path = path
+        self.entries = OrderedDict()  # 键 -> (回答, 过期时间, 占用字节)
+        self.size = 0
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(query, model="", prompt=""):
+        raw = "\0".join((model or "", prompt or "", normalize_query(query)))
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def ttl_for(self, query):
+        """
+        问题的过期时间（秒），0表示不缓存
+        """
+        return resolve_ttl(query, self.ttl, self.ttl_rules)
+
+    def cacheable(self, query):
+        return bool(normalize_query(query)) and not is_follow_up(query) and self.ttl_for(query) > 0
+
+    def get(self, query, model="", prompt=""):
+        """
+        返回缓存的回答，未命中、已过期或不可缓存时返回None
+        """
+        if not self.cacheable(query):
+            with self._lock:
+                self.bypassed += 1
+            return None
+        key = self.make_key(query, model, prompt)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            answer, expires_at, _ = entry
+            if expires_at <= time.time():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return answer
+
+    def put(self, query, answer, model="", prompt=""):
+        """
+        缓存问题的回答，追问和不可缓存的问题会被忽略
+        """
+        if not answer or not self.cacheable(query):
+            return
+        key = self.make_key(query, model, prompt)
+        size = len(key) + len(answer.encode("utf-8")) + ENTRY_OVERHEAD
+        with self._lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (answer, time.time() + self.ttl_for(query), size)
+            self.size += size
+            self.dirty = True
+            self._evict()
+
+    def _remove(self, key):
+        _, _, size = self.entries.pop(key)
+        self.size -= size
+        self.dirty = True
+
+    def _evict(self):
+        while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+            _, (_, _, size) = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.size = 0
+            self.dirty = True
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def load(self):
+        """
+        从文件加载缓存，跳过已过期的条目
+        """
+        if not self.path or not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"加载回答缓存失败: {e}")
+            return False
+        now = time.time()
+        with self._lock:
+            for key, answer, expires_at in data.get("entries", []):
+                if expires_at > now:
+                    size = len(key) + len(answer.encode("utf-8")) + ENTRY_OVERHEAD
+                    self.entries[key] = (answer, expires_at, size)
+                    self.size += size
+            self._evict()
+            self.dirty = False
+        return True
+
+    def save(self):
+        """
+        有改动时保存缓存到文件，先写临时文件再替换，避免写到一半的文件
+        """
+        if not self.path:
+            return False
+        with self._lock:
+            if not self.dirty:
+                return True
+            now = time.time()
+            entries = [
+                [key, answer, expires_at]
+                for key, (answer, expires_at, _) in self.entries.items()
+                if expires_at > now
+            ]
+            self.dirty = False
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"entries": entries}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            return True
+        except Exception as e:
+            print(f"保存回答缓存失败: {e}")
+            return False
@@ -11,12 +11,22 @@ import threading
 import asyncio
 import traceback
 import re
-import requests
-from requests.exceptions import RequestException, Timeout, ConnectionError
+import io
+import atexit
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from werkzeug.wsgi import LimitedStream
 
 # 导入MIGPT相关模块
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from config import config, MI_USER, MI_PASS, API_TYPE, API_KEY, API_BASE, MODEL_NAME, PROMPT
+from keyword_router import KeywordRouter, ROUTE_AI, ROUTE_HA_VOICE, ROUTE_HA_TEXT
+from llm_gateway import LLMGateway
+from history_writer import HistoryWriter
+from rate_limiter import TokenBucketLimiter
+import ha_client
+import metrics
 
 # 初始化Flask应用
 app = Flask(__name__)
@@ -25,176 +35,57 @@ CORS(app)  # 启用CORS支持
 # 全局变量
 conversation_history = []  # 对话历史
 mate_name = config.get("mate_name", "AI助手")  # 助手名称
+ha_config_cache = ha_client.HAConfigCache(config)  # HomeAssistant配置快照
+ha_bridge = ha_client.HomeAssistantBridge(config)  # 与MiGPT共用的HomeAssistant客户端
+rate_limiter = None  # 聊天接口的速率限制，由run_api_server创建
+keyword_router = KeywordRouter(config)  # 与MiGPT相同的关键词路由
+llm_gateway = LLMGateway(config, API_KEY, MODEL_NAME, API_BASE, API_TYPE)  # 所有请求共用的AI客户端
+history_config = config.get("chat_history", {}) or {}
+history_writer = HistoryWriter(  # 后台批量写入的聊天记录
+    history_config.get("path", "data/history/api_chat_history.jsonl"),
+    queue_size=int(history_config.get("queue_size", 1000)),
+    batch_size=int(history_config.get("batch_size", 100)),
+    flush_interval=float(history_config.get("flush_interval", 1)),
+    max_bytes=int(history_config.get("max_bytes", 10 * 1024 * 1024)),
+    backups=int(history_config.get("backups", 5)),
+    compress=bool(history_config.get("compress", True)),
+)
+atexit.register(history_writer.close)
+
+# 聊天接口的运行指标
+API_REQUESTS = metrics.counter(
+    "migpt_api_requests_total", "Chat completion requests by route", ["route"])
+API_RESPONSE_SECONDS = metrics.histogram(
+    "migpt_api_response_seconds", "Time to produce a full chat completion, by route", ["route"])
+API_RATE_LIMITED = metrics.counter(
+    "migpt_api_rate_limited_total", "Chat completion requests rejected by the rate limiter", ["kind"])
+metrics.gauge("migpt_history_queue_depth", "Chat history records waiting to be written").set_function(
+    history_writer.queue.qsize)
 
 # 加载HomeAssistant配置
 def load_ha_config():
-    """加载HomeAssistant配置"""
-    try:
-        # 从config模块加载配置
-        from config import config
-        ha_config = config.get("homeassistant", {})
-        
-        # 如果配置为空，尝试从more_set.json加载（兼容旧版本）
-        if not ha_config:
-            more_set_file = 'data/set/more_set.json'
-            if os.path.exists(more_set_file):
-                try:
-                    with open(more_set_file, 'r', encoding='utf-8') as f:
-                        more_config = json.load(f)
-                        ha_config = {
-                            "url": more_config.get("HomeAssistant服务器IP", ""),
-                            "token": more_config.get("HomeAssistant Token", ""),
-                            "text_entity_id": more_config.get("文本指令实体ID", ""),
-                            "voice_agent_id": more_config.get("语音API实体ID", "")
-                        }
-                except Exception as e:
-                    print(f"加载HomeAssistant配置文件失败: {str(e)}")
-        
-        return ha_config
-    except Exception as e:
-        print(f"加载HomeAssistant配置失败: {str(e)}")
-        return {}
+    """获取HomeAssistant配置的只读快照，配置变化时才重新加载"""
+    return ha_config_cache.get()
 
 # 向HomeAssistant发送文本指令
 def send_ha_command(command):
-    """向HomeAssistant发送文本指令"""
-    max_retries = 3  # 最大重试次数
-    retry_delay = 1  # 初始重试延迟（秒）
-    
-    for retry in range(max_retries + 1):
-        try:
-            ha_config = load_ha_config()
-            
-            if not ha_config.get('url'):
-                return "错误：HomeAssistant URL未配置"
-            if not ha_config.get('token'):
-                return "错误：HomeAssistant Token未配置"
-            if not ha_config.get('text_entity_id'):
-                return "错误：文本实体ID未配置"
-            
-            response = requests.post(
-                f"{ha_config['url']}/api/services/text/set_value",
-                headers={"Authorization": f"Bearer {ha_config['token']}"},
-                json={"entity_id": ha_config["text_entity_id"], "value": command},
-                timeout=10
-            )
-
-            response.raise_for_status()  # 如果状态码不是200，抛出异常
-            
-            result_list = response.json()
-            if isinstance(result_list, list) and len(result_list) > 0:
-                result = f"执行成功：{result_list[0].get('state', '操作完成')}".replace("{lv=stt}", command)
-            else:
-                result = "指令已执行"
-                
-            return result
-            
-        except Timeout:
-            # 超时错误处理
-            if retry < max_retries:
-                wait_time = retry_delay * (2 ** retry)  # 指数增长等待时间
-                print(f"请求超时，{wait_time}秒后重试... ({retry+1}/{max_retries})")
-                time.sleep(wait_time)
-                continue
-            else:
-                return "请求HomeAssistant超时，请检查网络连接"
-                
-        except ConnectionError:
-            # 连接错误
-            if retry < max_retries:
-                wait_time = retry_delay * (2 ** retry)
-                print(f"连接错误，{wait_time}秒后重试... ({retry+1}/{max_retries})")
-                time.sleep(wait_time)
-                continue
-            else:
-                return "无法连接到HomeAssistant，请检查网络连接和服务器地址"
-                
-        except RequestException as e:
-            # 其他请求错误
-            if retry < max_retries:
-                wait_time = retry_delay * (2 ** retry)
-                print(f"请求错误({str(e)})，{wait_time}秒后重试... ({retry+1}/{max_retries})")
-                time.sleep(wait_time)
-                continue
-            else:
-                return f"操作异常: {str(e)}"
-                
-        except Exception as e:
-            return f"操作异常：{str(e)}"
+    """向HomeAssistant发送文本指令，与MiGPT使用同一个客户端和重试策略"""
+    try:
+        return ha_bridge.call("send_command", command)
+    except Exception as e:
+        return f"操作异常: {str(e)}"
 
 # 向HomeAssistant发送语音指令
 def send_ha_voice_command(text):
-    """向HomeAssistant发送语音指令"""
-    max_retries = 3  # 最大重试次数
-    retry_delay = 1  # 初始重试延迟（秒）
-    
-    for retry in range(max_retries + 1):
-        try:
-            ha_config = load_ha_config()
-            
-            # 检查必要的配置是否存在
-            if not ha_config.get("url"):
-                return "语音指令失败: 缺少HomeAssistant服务器URL配置"
-            if not ha_config.get("token"):
-                return "语音指令失败: 缺少HomeAssistant Token配置"
-            if not ha_config.get("voice_agent_id"):
-                return "语音指令失败: 缺少语音Agent ID配置"
-            
-            response = requests.post(
-                f"{ha_config['url']}/api/conversation/process",
-                headers={"Authorization": f"Bearer {ha_config['token']}"},
-                json={"agent_id": ha_config["voice_agent_id"], "text": text, "language": "zh-CN"},
-                timeout=20
-            )
-            
-            response.raise_for_status()  # 如果状态码不是200，抛出异常
-            response_json = response.json()
-            
-            # 检查响应中是否包含我们期望的字段
-            if ('response' in response_json and 
-                'speech' in response_json['response'] and 
-                'plain' in response_json['response']['speech'] and
-                'speech' in response_json['response']['speech']['plain']):
-                return response_json['response']['speech']['plain']['speech']
-            else:
-                return "处理成功，但返回格式不符合预期"
-
-        except Timeout:
-            # 超时错误处理
-            if retry < max_retries:
-                wait_time = retry_delay * (2 ** retry)  # 指数增长等待时间
-                print(f"语音请求超时，{wait_time}秒后重试... ({retry+1}/{max_retries})")
-                time.sleep(wait_time)
-                continue
-            else:
-                return "请求HomeAssistant语音接口超时，请检查网络连接"
-                
-        except ConnectionError:
-            # 连接错误
-            if retry < max_retries:
-                wait_time = retry_delay * (2 ** retry)
-                print(f"语音连接错误，{wait_time}秒后重试... ({retry+1}/{max_retries})")
-                time.sleep(wait_time)
-                continue
-            else:
-                return "无法连接到HomeAssistant语音接口，请检查网络连接和服务器地址"
-                
-        except RequestException as e:
-            # 其他请求错误
-            if retry < max_retries:
-                wait_time = retry_delay * (2 ** retry)
-                print(f"语音请求错误({str(e)})，{wait_time}秒后重试... ({retry+1}/{max_retries})")
-                time.sleep(wait_time)
-                continue
-            else:
-                return f"语音指令失败: {str(e)}"
-
-        except Exception as e:
-            return f"语音指令失败: {str(e)}"
+    """向HomeAssistant发送语音指令，常见指令和状态查询由共用的客户端在本地识别"""
+    try:
+        return ha_bridge.call("send_voice_command", text)
+    except Exception as e:
+        return f"语音指令失败: {str(e)}"
 
 # 验证API密钥（使用HomeAssistant Token）
-def verify_api_key():
-    """验证API密钥"""
+def get_api_key():
+    """获取请求中的API密钥"""
     # 从请求头获取API密钥
     api_key = request.headers.get('Authorization')
     if api_key:
@@ -204,6 +95,11 @@ def verify_api_key():
     # 如果请求头中没有，则从查询参数获取
     if not api_key:
         api_key = request.args.get('api_key')
+    return api_key
+
+def verify_api_key():
+    """验证API密钥"""
+    api_key = get_api_key()
     
     # 验证密钥
     if not api_key:
@@ -218,16 +114,39 @@ def verify_api_key():
     
     return False, "无效的API密钥"
 
+def check_rate_limit(kind, key):
+    """按令牌桶限制请求速率，超出限制时返回OpenAI格式的429响应，否则返回None"""
+    limiter = rate_limiter
+    if limiter is None:
+        return None
+    wait = limiter.acquire((kind, key))
+    if not wait:
+        return None
+    API_RATE_LIMITED.labels(kind).inc()
+    retry_after = TokenBucketLimiter.retry_after(wait)
+    print(f"请求过于频繁({kind})，{retry_after}秒后可重试")
+    response = jsonify({
+        "error": {
+            "message": f"请求过于频繁，请{retry_after}秒后重试",
+            "type": "requests",
+            "param": None,
+            "code": "rate_limit_exceeded"
+        }
+    })
+    response.status_code = 429
+    response.headers["Retry-After"] = retry_after
+    return response
+
 # 保存对话历史
 def save_chat_history(username, user_message, bot_name, bot_response):
-    """保存对话历史到文件"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    history_dir = 'data/history'
-    os.makedirs(history_dir, exist_ok=True)
-    
-    with open(f'{history_dir}/api_chat_history.txt', 'a', encoding='utf-8') as f:
-        f.write(f"[{timestamp}] {username}: {user_message}\n")
-        f.write(f"[{timestamp}] {bot_name}: {bot_response}\n\n")
+    """把一轮对话交给后台写入，不等待磁盘"""
+    history_writer.write({
+        "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "username": username,
+        "message": user_message,
+        "bot_name": bot_name,
+        "response": bot_response
+    })
 
 def clean_user_message(message):
     """清理用户消息中的时间戳和前缀"""
@@ -241,11 +160,22 @@ def index():
     """API服务根路径"""
     return "HomeAssistant OpenAI兼容API服务正在运行"
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus格式的运行指标"""
+    return Response(metrics.REGISTRY.expose(), mimetype="text/plain; version=0.0.4")
+
 @app.route('/v1/chat/completions', methods=['POST'])
 def openai_chat_completions():
     """OpenAI兼容的聊天API接口"""
     print("收到OpenAI格式的聊天请求")
     
+    # 按客户端IP限制速率，验证失败的请求同样计数
+    # 所有客户端共用同一个API密钥（HomeAssistant Token），按密钥计数会变成全局限制，因此不按密钥限制
+    limited = check_rate_limit("ip", request.remote_addr)
+    if limited is not None:
+        return limited
+    
     # 验证API密钥
     is_valid, error_msg = verify_api_key()
     if not is_valid:
@@ -286,208 +216,283 @@ def openai_chat_completions():
         # 检查是否请求流式响应
         stream_mode = data.get('stream', False)
         
-        # 加载配置文件
-        more_set_file = 'data/set/more_set.json'
-        if os.path.exists(more_set_file):
-            with open(more_set_file, 'r', encoding='utf-8') as f:
-                more_config = json.load(f)
+        # 与MiGPT相同的关键词路由：HAAI关键词发送语音指令，HA文本指令关键词发送文本指令，其余交给AI
+        route = keyword_router.route(user_message)
+        route_name = route.route
+        if route.route == ROUTE_HA_VOICE:
+            deltas, model = upstream_deltas(send_ha_voice_command, route.cleaned), "homeassistant-ai"
+        elif route.route == ROUTE_HA_TEXT:
+            deltas, model = upstream_deltas(send_ha_command, route.cleaned), "homeassistant-ai"
+        elif llm_gateway.available:
+            route_name = ROUTE_AI
+            messages = [dict(msg) for msg in data['messages']]
+            for msg in reversed(messages):
+                if msg.get('role') == 'user':
+                    msg['content'] = user_message
+                    break
+            deltas, model = llm_gateway.stream(messages), llm_gateway.model
         else:
-            more_config = {}
-        
-        # 语音指令关键词读取
-        VOICE_KEYWORDS = more_config.get("HAAI关键词", [])
-        for kw in VOICE_KEYWORDS:
-            if kw in user_message:
-                command = user_message.replace(kw, "", 1).strip()
-                bot_response = send_ha_voice_command(command)
-                
-                # 记录对话历史
-                save_chat_history(username, user_message, mate_name, bot_response)
-                
-                # 如果是流式响应模式
-                if stream_mode:
-                    return Response(generate_stream_response_with_text(bot_response), 
-                                  mimetype='text/event-stream')
-                
-                # 生成OpenAI格式的响应
-                response_data = {
-                    "id": f"chatcmpl-{str(uuid.uuid4())[:10]}",
-                    "object": "chat.completion",
-                    "created": int(time.time()),
-                    "model": "homeassistant-ai",
-                    "choices": [{
-                        "index": 0,
-                        "message": {
-                            "role": "assistant",
-                            "content": bot_response
-                        },
-                        "finish_reason": "stop"
-                    }],
-                    "usage": {
-                        "prompt_tokens": len(user_message),
-                        "completion_tokens": len(bot_response),
-                        "total_tokens": len(user_message) + len(bot_response)
-                    }
-                }
-                
-                return jsonify(response_data)
-                
-        # 文本指令关键词读取
-        for kw in more_config.get("HA文本指令关键词", []):
-            if kw in user_message:
-                command = user_message.replace(kw, "", 1).strip()
-                bot_response = send_ha_command(command)
-                
-                # 记录对话历史
-                save_chat_history(username, user_message, mate_name, bot_response)
-                
-                # 如果是流式响应模式
-                if stream_mode:
-                    return Response(generate_stream_response_with_text(bot_response), 
-                                  mimetype='text/event-stream')
-                
-                # 生成OpenAI格式的响应
-                response_data = {
-                    "id": f"chatcmpl-{str(uuid.uuid4())[:10]}",
-                    "object": "chat.completion",
-                    "created": int(time.time()),
-                    "model": "homeassistant-ai",
-                    "choices": [{
-                        "index": 0,
-                        "message": {
-                            "role": "assistant",
-                            "content": bot_response
-                        },
-                        "finish_reason": "stop"
-                    }],
-                    "usage": {
-                        "prompt_tokens": len(user_message),
-                        "completion_tokens": len(bot_response),
-                        "total_tokens": len(user_message) + len(bot_response)
-                    }
-                }
-                
-                return jsonify(response_data)
-        
-        # 直接发送到HomeAssistant语音助手
-        try:
-            bot_response = send_ha_voice_command(user_message)
-            
-            # 记录对话历史
-            save_chat_history(username, user_message, mate_name, bot_response)
-            
-            # 如果是流式响应模式
-            if stream_mode:
-                return Response(generate_stream_response_with_text(bot_response), 
-                              mimetype='text/event-stream')
-            
-            # 生成OpenAI格式的响应
-            response_data = {
-                "id": f"chatcmpl-{str(uuid.uuid4())[:10]}",
-                "object": "chat.completion",
-                "created": int(time.time()),
-                "model": "homeassistant-ai",
-                "choices": [{
-                    "index": 0,
-                    "message": {
-                        "role": "assistant",
-                        "content": bot_response
-                    },
-                    "finish_reason": "stop"
-                }],
-                "usage": {
-                    "prompt_tokens": len(user_message),
-                    "completion_tokens": len(bot_response),
-                    "total_tokens": len(user_message) + len(bot_response)
-                }
-            }
-            
-            return jsonify(response_data)
-            
-        except Exception as e:
-            print(f"API出错: {str(e)}")
-            return jsonify({"error": {"message": str(e), "type": "server_error"}}), 500
+            # 未配置AI时直接发送到HomeAssistant语音助手
+            route_name = ROUTE_HA_VOICE
+            deltas, model = upstream_deltas(send_ha_voice_command, user_message), "homeassistant-ai"
+        API_REQUESTS.labels(route_name).inc()
+        deltas = timed_deltas(deltas, route_name)
+        return chat_completion_response(username, user_message, deltas, stream_mode, model)
     
     except Exception as e:
         print(f"处理请求时出错: {str(e)}")
         traceback.print_exc()
         return jsonify({"error": {"message": str(e), "type": "server_error"}}), 500
 
-def generate_stream_response_with_text(predefined_text):
-    """生成带有预定义文本的流式响应"""
-    # 生成唯一ID
-    response_id = f"chatcmpl-{str(uuid.uuid4())[:10]}"
-    created_time = int(time.time())
+def upstream_deltas(func, *args):
+    """把一次性返回完整回答的上游调用包装为回答片段的迭代器，调用在开始迭代时才执行"""
+    yield func(*args)
+
+def timed_deltas(deltas, route_name):
+    """转发回答片段，迭代结束时记录从开始到最后一个片段的耗时"""
+    started = time.monotonic()
+    try:
+        yield from deltas
+    finally:
+        API_RESPONSE_SECONDS.labels(route_name).observe(time.monotonic() - started)
+
+def chat_completion_response(username, user_message, deltas, stream_mode, model="homeassistant-ai"):
+    """
+    把上游的回答片段组装为OpenAI格式的响应
+    流式模式下收到一个片段就转发一个，上游在响应头发出之后才开始调用
+    """
+    if stream_mode:
+        return Response(generate_stream_response(username, user_message, deltas, model),
+                        mimetype='text/event-stream',
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
     
-    # 使用预定义的文本
-    bot_response = predefined_text
+    bot_response = "".join(deltas)
     
-    # 发送开始事件
-    start_data = {
-        'id': response_id,
-        'object': 'chat.completion.chunk',
-        'created': created_time,
-        'model': 'homeassistant-ai',
-        'choices': [{
-            'index': 0,
-            'delta': {
-                'role': 'assistant'
+    # 记录对话历史
+    save_chat_history(username, user_message, mate_name, bot_response)
+    
+    # 生成OpenAI格式的响应
+    response_data = {
+        "id": f"chatcmpl-{str(uuid.uuid4())[:10]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {
+                "role": "assistant",
+                "content": bot_response
             },
-            'finish_reason': None
-        }]
+            "finish_reason": "stop"
+        }],
+        "usage": {
+            "prompt_tokens": len(user_message),
+            "completion_tokens": len(bot_response),
+            "total_tokens": len(user_message) + len(bot_response)
+        }
     }
-    yield f"data: {json.dumps(start_data)}\n\n"
     
-    # 分块发送内容部分（每次发送10个字符）
-    for i in range(0, len(bot_response), 10):
-        chunk = bot_response[i:i+10]
-        content_data = {
-            'id': response_id, 
-            'object': 'chat.completion.chunk', 
-            'created': created_time, 
-            'model': 'homeassistant-ai', 
-            'choices': [{
-                'index': 0, 
-                'delta': {'content': chunk}, 
-                'finish_reason': None
-            }]
-        }
-        yield f"data: {json.dumps(content_data)}\n\n"
-        time.sleep(0.05)  # 添加延迟模拟打字效果
+    return jsonify(response_data)
+
+class SSEFrames:
+    """
+    一次流式响应的SSE帧模板
+    id、object、created、model等固定字段只序列化一次，每个片段只需序列化片段文本
+    """
+    DONE = "data: [DONE]\n\n"
+
+    def __init__(self, model):
+        head = json.dumps({
+            "id": f"chatcmpl-{str(uuid.uuid4())[:10]}",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model
+        }, ensure_ascii=False)
+        prefix = "data: " + head[:-1] + ', "choices": [{"index": 0, "delta": '
+        self.role = prefix + '{"role": "assistant"}, "finish_reason": null}]}\n\n'
+        self.stop = prefix + '{}, "finish_reason": "stop"}]}\n\n'
+        self.content_prefix = prefix + '{"content": '
+        self.content_suffix = '}, "finish_reason": null}]}\n\n'
+
+    def content(self, text):
+        return self.content_prefix + json.dumps(text, ensure_ascii=False) + self.content_suffix
+
+    @staticmethod
+    def error(message):
+        return "data: " + json.dumps({"error": {"message": message, "type": "server_error"}}, ensure_ascii=False) + "\n\n"
+
+def generate_stream_response(username, user_message, deltas, model="homeassistant-ai"):
+    """逐个转发上游的回答片段，结束后记录对话历史"""
+    frames = SSEFrames(model)
     
-    # 发送结束事件部分
-    end_data = {
-        'id': response_id, 
-        'object': 'chat.completion.chunk', 
-        'created': created_time, 
-        'model': 'homeassistant-ai', 
-        'choices': [{
-            'index': 0, 
-            'delta': {}, 
-            'finish_reason': 'stop'
-        }]
-    }
-    yield f"data: {json.dumps(end_data)}\n\n"
+    # 发送开始事件
+    yield frames.role
+    
+    parts = []
+    try:
+        for delta in deltas:
+            if delta:
+                parts.append(delta)
+                yield frames.content(delta)
+    except Exception as e:
+        print(f"API出错: {str(e)}")
+        yield frames.error(str(e))
+        yield frames.DONE
+        return
+    
+    # 记录对话历史
+    save_chat_history(username, user_message, mate_name, "".join(parts))
     
-    # 发送[DONE]标记，表示流结束
-    yield "data: [DONE]\n\n"
+    # 发送结束事件和[DONE]标记，表示流结束
+    yield frames.stop
+    yield frames.DONE
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """
+    支持HTTP/1.1保持连接的请求处理器（werkzeug默认每个请求后关闭连接）
+    空闲超过keep_alive秒的连接会被关闭，服务器停止时处理完当前请求即关闭连接
+    """
+
+    def setup(self):
+        self.timeout = self.server.keep_alive
+        self.reuse_connection = False
+        super().setup()
+
+    def handle_one_request(self):
+        self.reuse_connection = False
+        if not self.server.mark_idle(self.connection, True):
+            self.close_connection = True
+            return
+        try:
+            super().handle_one_request()
+        finally:
+            self.server.mark_idle(self.connection, False)
+        if self.server.draining:
+            self.close_connection = True
+
+    def parse_request(self):
+        # 已收到请求行，连接不再空闲
+        self.server.mark_idle(self.connection, False)
+        return super().parse_request()
+
+    def make_environ(self):
+        environ = super().make_environ()
+        # 分块上传的请求体无法确定长度，这类请求处理后仍关闭连接
+        self.reuse_connection = not environ.get("wsgi.input_terminated") and not self.server.draining
+        if self.reuse_connection:
+            self.request_body = LimitedStream(self.rfile, int(environ.get("CONTENT_LENGTH") or 0))
+            environ["wsgi.input"] = self.request_body
+            # werkzeug在响应后会读掉套接字中剩余的数据（它假定连接总会关闭），这会吞掉同一连接上的下一个请求，
+            # 处理期间换成空流，请求体只通过上面的LimitedStream读取
+            self.socket_rfile, self.rfile = self.rfile, io.BytesIO()
+        return environ
+
+    def run_wsgi(self):
+        try:
+            super().run_wsgi()
+        finally:
+            if self.reuse_connection:
+                self.rfile = self.socket_rfile
+        if self.reuse_connection and not self.close_connection:
+            # 读完应用没有读取的请求体，下一个请求才能从正确的位置开始解析
+            self.request_body.exhaust()
+
+    def send_header(self, keyword, value):
+        if keyword.lower() == "connection" and self.reuse_connection:
+            value = "keep-alive"
+        super().send_header(keyword, value)
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    线程池WSGI服务器，最多workers个连接同时处理，一个慢请求不会阻塞其他客户端
+    """
+    multithread = True
+
+    def __init__(self, host, port, app, workers=8, keep_alive=5):
+        self.keep_alive = keep_alive
+        self.draining = False
+        self.active = 0  # 正在处理的连接数
+        self.idle_connections = set()  # 等待下一个请求的保持连接
+        self._idle = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="api-worker")
+        super().__init__(host, port, app, handler=KeepAliveRequestHandler)
+
+    def process_request(self, request, client_address):
+        with self._idle:
+            self.active += 1
+        future = self.executor.submit(self._process_request, request, client_address)
+        future.add_done_callback(lambda f: f.cancelled() and self._close_request(request))
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self._close_request(request)
+
+    def _close_request(self, request):
+        """
+        关闭连接；线程池停止时还在排队、没有被处理的连接也由这里关闭
+        """
+        self.shutdown_request(request)
+        with self._idle:
+            self.active -= 1
+            if self.active == 0:
+                self._idle.notify_all()
+
+    def mark_idle(self, connection, idle):
+        """
+        记录连接是否在等待下一个请求，服务器停止后返回False
+        """
+        with self._idle:
+            if not idle:
+                self.idle_connections.discard(connection)
+                return True
+            if self.draining:
+                return False
+            self.idle_connections.add(connection)
+            return True
+
+    def drain(self, timeout):
+        """
+        关闭空闲的保持连接，等待正在处理的请求完成（最多timeout秒），然后关闭线程池和监听套接字
+        """
+        with self._idle:
+            self.draining = True
+            for connection in self.idle_connections:
+                try:
+                    connection.shutdown(socket.SHUT_RD)
+                except OSError:
+                    pass
+            self.idle_connections.clear()
+            finished = self._idle.wait_for(lambda: self.active == 0, timeout)
+        if not finished:
+            print(f"API服务器停止时仍有{self.active}个请求未完成")
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.server_close()
+        return finished
+
 
 # 全局变量用于控制服务器运行状态
 server_running = True
 server_thread = None
+api_server = None  # 正在运行的PooledWSGIServer
 
 # 运行API服务器的函数
 def run_api_server(host='0.0.0.0', port=5001, enable_cors=True, rate_limit=60):
     """运行API服务器"""
-    global server_running, server_thread
+    global server_running, server_thread, api_server, rate_limiter
     
     try:
         # 设置CORS
         if enable_cors:
             CORS(app)
         
-        # 设置速率限制
-        # 这里可以添加速率限制的代码
+        # 设置速率限制，每个客户端IP分别计数
+        burst = (config.get("api_rate_limit", {}) or {}).get("burst")
+        rate_limiter = TokenBucketLimiter(float(rate_limit), burst) if float(rate_limit) > 0 else None
         print(f"速率限制设置为: {rate_limit}次/分钟")
         
         print(f"正在启动HomeAssistant OpenAI兼容API服务器，地址: {host}:{port}...")
@@ -500,15 +505,27 @@ def run_api_server(host='0.0.0.0', port=5001, enable_cors=True, rate_limit=60):
         if not ha_config.get("token"):
             print("警告: 未配置HomeAssistant访问令牌，API服务器可能无法正常工作")
             
-        # 使用线程安全的方式运行Flask
+        # 使用线程池并发处理请求，stop_api_server可以立即停止接受新连接
+        pool_config = config.get("api_server_pool", {}) or {}
         try:
-            from werkzeug.serving import make_server
-            server = make_server(host, port, app)
+            server = PooledWSGIServer(
+                host, port, app,
+                workers=int(pool_config.get("workers", 8)),
+                keep_alive=float(pool_config.get("keep_alive", 5)),
+            )
+            api_server = server
             server_running = True
+            server_thread = threading.current_thread()
             
-            # 在循环中运行服务器，允许外部停止
-            while server_running:
-                server.handle_request()
+            try:
+                server.serve_forever(poll_interval=0.2)
+            finally:
+                server_running = False
+                api_server = None
+                server.drain(float(pool_config.get("drain_timeout", 10)))
+                llm_gateway.close()
+                ha_bridge.close()
+                history_writer.close()
         except Exception as e:
             print(f"API服务器运行出错: {e}")
             server_running = False
@@ -523,9 +540,12 @@ def run_api_server(host='0.0.0.0', port=5001, enable_cors=True, rate_limit=60):
     return True
 
 def stop_api_server():
-    """停止API服务器"""
+    """停止API服务器，不再接受新连接，正在处理的请求完成后关闭"""
     global server_running
     server_running = False
+    server = api_server
+    if server is not None:
+        server.shutdown()
     print("HomeAssistant OpenAI兼容API服务器已停止")
 
 # 如果直接运行此文件
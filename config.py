@@ -2,6 +2,7 @@
 """
 配置管理模块 - 负责加载、保存和管理MIGPT配置
 """
+import copy
 import json
 import os
 from pathlib import Path
@@ -100,6 +101,60 @@ DEFAULT_CONFIG = {
         }
     },
     
+    # 多服务商竞速/对冲请求
+    "llm_race": {
+        "enabled": False,
+        # 参与的预设名称（api_presets中的键），当前配置的服务商总是主服务商
+        # 预设中可以单独设置api_key，未设置时使用主配置的api_key
+        "presets": [],
+        # 0表示同时发出请求并使用最先返回token的服务商（竞速）
+        # 大于0表示主服务商在该秒数内没有返回首个token时才发出备用请求（对冲）
+        # 与llm_failover共用熔断状态：已熔断的服务商不参与竞速；参与竞速的服务商都失败时，
+        # 再按llm_failover.presets的顺序尝试其中未参与竞速的预设
+        "hedge_delay": 0
+    },
+    
+    # 流式回答时限（秒），超过token间隔或总时长时提前结束并使用已生成的部分回答
+    "llm_deadlines": {
+        "connect": 5,        # 建立连接
+        "first_token": 15,   # 等待首个token，推理模型可适当调大
+        "inter_token": 3,    # 两个token之间的最长间隔，卡住的回答约3秒后结束
+        "total": 60          # 整个回答的生成时长
+    },
+    
+    # 服务商熔断与故障转移
+    "llm_failover": {
+        # 主服务商失败或熔断时依次尝试的预设名称（api_presets中的键）
+        "presets": [],
+        # 连续失败多少次后暂停使用该服务商，收到429时立即暂停
+        "failure_threshold": 3,
+        # 暂停多少秒后放行一个试探请求，成功则恢复使用
+        "cooldown": 30
+    },
+    
+    # 重复问题的回答缓存，追问（如"刚才""继续"）不使用缓存
+    "answer_cache": {
+        "enabled": True,
+        "ttl": 86400,                       # 默认缓存时间（秒）
+        "max_entries": 500,                 # 最多缓存的回答数
+        "max_bytes": 1048576,               # 缓存占用的内存上限（字节）
+        "path": "data/answer_cache.json",   # 缓存保存位置，留空则不保存到磁盘
+        # 按关键词设置缓存时间，ttl为0表示不缓存
+        "ttl_rules": [
+            {"keywords": ["几点", "时间", "日期", "几号", "星期", "现在"], "ttl": 0},
+            {"keywords": ["天气", "气温", "温度", "下雨", "下雪"], "ttl": 1800},
+            {"keywords": ["笑话", "故事"], "ttl": 600}
+        ]
+    },
+    
+    # 语义回答缓存，匹配换了说法的重复问题（如"帮我讲个笑话"和"讲个笑话吧"）
+    "semantic_cache": {
+        "enabled": False,
+        "threshold": 0.7,                     # 相似度阈值，越高越严格
+        "capacity": 10000,                    # 最多缓存的回答数
+        "path": "data/semantic_cache.npz"     # 缓存保存位置，留空则不保存到磁盘
+    },
+    
     # 音箱型号
     "sound_type": "LX06",
     
@@ -109,10 +164,64 @@ DEFAULT_CONFIG = {
     # 默认设备编号
     "device_numbers": "",
     
+    # 每个设备待处理提问队列的容量，超出时丢弃最旧的提问
+    "device_queue_size": 5,
+    
+    # 对话上下文的有效时间（秒）：超过这个时间没有新提问时清空该设备的对话历史，
+    # 之后的问题作为新话题，可以使用回答缓存；在这个时间内的连续提问可能是追问，不使用缓存
+    "conversation_idle_timeout": 120,
+    
     # 全局变量
     "switch": True,  # 是否开启chatgpt回答
     "prompt": "请用自然、友好的语气回答，像朋友一样交流，避免过于机械的回复",  # 提示词
     
+    # 流式播放：按句子切分AI回答，每句生成完整后立即发送到音箱播放
+    "stream_tts": True,
+    "stream_tts_min_chars": 6,  # 每段播放文本的最少字数，过短的句子会与下一句合并
+    
+    # HomeAssistant本地意图匹配：开关、亮度、温度、场景等常见指令直接调用服务，不经过对话代理
+    "ha_intent": {
+        "enabled": True,
+        "entity_refresh": 300,  # 实体列表刷新间隔（秒）
+        "aliases": {}           # 设备别名，如 {"大灯": "light.living_room"}
+    },
+    
+    # HomeAssistant状态缓存：通过websocket订阅实体状态变化，"客厅温度多少""门锁了吗"等查询在本地直接回答
+    "ha_state_cache": {
+        "enabled": True
+    },
+    
+    # HomeAssistant请求：所有重试都在deadline秒内完成，超时、连接错误和5xx时按指数退避重试
+    "ha_client": {
+        "deadline": 10,          # 一条指令的总时限（秒）
+        "attempt_timeout": 5,    # 单次请求的超时（秒）
+        "max_retries": 3,
+        "retry_delay": 0.5       # 首次重试前的等待（秒），之后每次加倍
+    },
+    
+    # API服务器线程池：最多workers个连接同时处理，停止时最多等待drain_timeout秒让正在处理的请求完成
+    "api_server_pool": {
+        "workers": 8,
+        "keep_alive": 5,       # 空闲连接保持时间（秒）
+        "drain_timeout": 10
+    },
+    
+    # API服务器速率限制：速率使用homeassistant.api_server.rate_limit（次/分钟），burst为允许连续发送的请求数
+    "api_rate_limit": {
+        "burst": 10
+    },
+    
+    # API服务器聊天记录：JSONL格式，后台批量写入，文件超过max_bytes后轮转，保留backups个旧文件
+    "chat_history": {
+        "path": "data/history/api_chat_history.jsonl",
+        "queue_size": 1000,    # 待写入记录的上限，超出时丢弃
+        "batch_size": 100,
+        "flush_interval": 1,   # 最长写入间隔（秒）
+        "max_bytes": 10485760,
+        "backups": 5,
+        "compress": True       # 轮转出的旧文件压缩为.gz
+    },
+    
     # HomeAssistant配置
     "homeassistant": {
         "url": "",  # HomeAssistant服务器地址
@@ -144,6 +253,11 @@ class Config:
         """
         self.config_file = config_file
         self.config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), config_file)
+        # 配置版本号，每次保存或从文件重新加载后加一，依赖配置的缓存据此判断是否需要重建
+        self.version = 0
+        # 配置变化时调用的回调函数，见add_listener
+        self.listeners = []
+        self.mtime = None
         self.config = self.load_config()
         
         # 应用预设配置
@@ -156,6 +270,7 @@ class Config:
         """加载配置文件，如果不存在则创建默认配置"""
         try:
             if os.path.exists(self.config_path):
+                self.mtime = os.path.getmtime(self.config_path)
                 with open(self.config_path, 'r', encoding='utf-8') as f:
                     user_config = json.load(f)
                     # 递归合并配置（保留用户配置的同时确保所有默认配置字段存在）
@@ -183,6 +298,7 @@ class Config:
         """保存配置到文件"""
         if config is None:
             config = self.config
+        self.version += 1
         
         try:
             # 确保配置文件目录存在
@@ -190,11 +306,48 @@ class Config:
             
             with open(self.config_path, 'w', encoding='utf-8') as f:
                 json.dump(config, f, ensure_ascii=False, indent=4)
+            self.mtime = os.path.getmtime(self.config_path)
             logger.info(f"配置已保存到 {self.config_path}")
             return True
         except Exception as e:
             logger.error(f"保存配置文件出错: {e}")
             return False
+        finally:
+            self._notify()
+    
+    def add_listener(self, callback):
+        """注册配置变化时调用的回调函数（无参数），在保存或重新加载配置的线程中调用"""
+        self.listeners.append(callback)
+    
+    def _notify(self):
+        for callback in list(self.listeners):
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"配置变化回调出错: {e}")
+    
+    def reload_if_changed(self):
+        """配置文件被其他进程修改（修改时间变化）时重新加载，返回是否重新加载"""
+        try:
+            mtime = os.path.getmtime(self.config_path)
+        except OSError:
+            return False
+        if mtime == self.mtime:
+            return False
+        try:
+            with open(self.config_path, 'r', encoding='utf-8') as f:
+                user_config = json.load(f)
+        except Exception as e:
+            # 文件可能正在被写入，保留当前配置，下次检查时再试
+            logger.error(f"重新加载配置文件出错: {e}")
+            return False
+        self.mtime = mtime
+        self.config = self._recursive_update(copy.deepcopy(DEFAULT_CONFIG), user_config)
+        self.apply_preset()
+        self.version += 1
+        self._notify()
+        logger.info(f"配置文件已修改，已重新加载：{self.config_path}")
+        return True
     
     def apply_preset(self):
         """应用预设配置"""
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+HomeAssistant异步客户端模块 - 在MiGPT的aiohttp会话上发送HomeAssistant指令
+复用连接，配置只在保存后重新读取，重试使用非阻塞等待并受整体时限约束
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from types import MappingProxyType
+
+import aiohttp
+
+from ha_intent import HAIntentMatcher
+
+
+def load_ha_config(config):
+    """加载HomeAssistant配置，配置为空时尝试从more_set.json加载（兼容旧版本）"""
+    try:
+        ha_config = config.get("homeassistant", {})
+
+        if not ha_config:
+            more_set_file = 'data/set/more_set.json'
+            if os.path.exists(more_set_file):
+                try:
+                    with open(more_set_file, 'r', encoding='utf-8') as f:
+                        more_config = json.load(f)
+                        ha_config = {
+                            "url": more_config.get("HomeAssistant服务器IP", ""),
+                            "token": more_config.get("HomeAssistant Token", ""),
+                            "text_entity_id": more_config.get("文本指令实体ID", ""),
+                            "voice_agent_id": more_config.get("语音API实体ID", "")
+                        }
+                except Exception as e:
+                    print(f"加载HomeAssistant配置文件失败: {str(e)}")
+
+        return ha_config
+    except Exception as e:
+        print(f"加载HomeAssistant配置失败: {str(e)}")
+        return {}
+
+
+class HAConfigCache:
+    """
+    HomeAssistant配置的只读快照，供多个请求线程共用
+    Config保存（包括Config.set）时推送失效；配置文件或more_set.json的修改时间变化时，
+    最多每check_interval秒检查一次并重新加载，其余时间获取快照不读文件
+    """
+    MORE_SET_FILE = 'data/set/more_set.json'
+
+    def __init__(self, config, check_interval=1.0):
+        self.config = config
+        self.check_interval = check_interval
+        self._snapshot = None
+        self._next_check = 0.0
+        self._more_set_mtime = None
+        self._lock = threading.Lock()
+        if hasattr(config, "add_listener"):
+            config.add_listener(self.invalidate)
+
+    def invalidate(self):
+        self._snapshot = None
+
+    def _more_set_changed(self):
+        try:
+            mtime = os.path.getmtime(self.MORE_SET_FILE)
+        except OSError:
+            mtime = None
+        changed = mtime != self._more_set_mtime
+        self._more_set_mtime = mtime
+        return changed
+
+    def get(self):
+        """
+        返回当前的配置快照（只读映射）
+        """
+        snapshot = self._snapshot
+        now = time.monotonic()
+        if snapshot is not None and now < self._next_check:
+            return snapshot
+        with self._lock:
+            if now >= self._next_check:
+                self._next_check = now + self.check_interval
+                if hasattr(self.config, "reload_if_changed"):
+                    self.config.reload_if_changed()
+                if self._more_set_changed():
+                    self._snapshot = None
+            if self._snapshot is None:
+                self._snapshot = MappingProxyType(dict(load_ha_config(self.config)))
+            return self._snapshot
+
+
+class HomeAssistantClient:
+    """
+    HomeAssistant异步客户端
+    配置快照在Config.version变化时才重新加载；请求失败（超时、连接错误、5xx）时按指数退避重试，
+    所有重试都在deadline秒内完成
+    """
+
+    def __init__(self, session, config):
+        self.session = session
+        self.config = config
+        self.intent_matcher = HAIntentMatcher()
+        self.state_cache = None  # HAStateCache，由websocket事件流维护的实体状态表
+        self._snapshot = None
+        self._version = None
+        self.deadline = 10.0
+        self.attempt_timeout = 5.0
+        self.max_retries = 3
+        self.retry_delay = 0.5
+
+    def snapshot(self):
+        """
+        返回HomeAssistant配置快照，配置保存后自动刷新
+        """
+        version = getattr(self.config, "version", 0)
+        if self._snapshot is None or version != self._version:
+            self._snapshot = dict(load_ha_config(self.config))
+            policy = self.config.get("ha_client", {}) or {}
+            self.deadline = float(policy.get("deadline", 10))
+            self.attempt_timeout = float(policy.get("attempt_timeout", 5))
+            self.max_retries = int(policy.get("max_retries", 3))
+            self.retry_delay = float(policy.get("retry_delay", 0.5))
+            self._version = version
+        return self._snapshot
+
+    async def request(self, method, path, payload=None, deadline=None, label="请求"):
+        """
+        向HomeAssistant发送请求并返回JSON结果，失败时在时限内重试
+        """
+        ha_config = self.snapshot()
+        loop = asyncio.get_running_loop()
+        deadline_at = loop.time() + (deadline or self.deadline)
+        delay = self.retry_delay
+        retry = 0
+        while True:
+            timeout = max(0.1, min(self.attempt_timeout, deadline_at - loop.time()))
+            try:
+                async with self.session.request(
+                    method,
+                    f"{ha_config['url']}{path}",
+                    headers={"Authorization": f"Bearer {ha_config['token']}"},
+                    json=payload,
+                    timeout=aiohttp.ClientTimeout(total=timeout),
+                ) as response:
+                    response.raise_for_status()
+                    return await response.json(content_type=None)
+            except (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientResponseError) as e:
+                if isinstance(e, aiohttp.ClientResponseError) and e.status < 500:
+                    raise
+                retry += 1
+                if retry > self.max_retries or loop.time() + delay >= deadline_at:
+                    raise
+                reason = "超时" if isinstance(e, asyncio.TimeoutError) else f"错误({e})"
+                print(f"HomeAssistant{label}{reason}，{delay:g}秒后重试... ({retry}/{self.max_retries})")
+                await asyncio.sleep(delay)
+                delay *= 2
+
+    async def try_local_intent(self, text):
+        """本地识别常见指令并直接调用服务，无法识别或调用失败时返回None"""
+        intent_config = self.config.get("ha_intent", {})
+        if not intent_config.get("enabled", True):
+            return None
+        ha_config = self.snapshot()
+        if not ha_config.get("url") or not ha_config.get("token"):
+            return None
+
+        try:
+            matcher = self.intent_matcher
+            matcher.aliases = intent_config.get("aliases", {})
+            live = self.state_cache is not None and self.state_cache.ready
+            if not live and time.time() - matcher.updated_at >= intent_config.get("entity_refresh", 300):
+                states = await self.request("GET", "/api/states", deadline=5, label="实体列表请求")
+                matcher.update_entities(states, time.time())
+            intent = matcher.match(text)
+            if intent is None:
+                return None
+
+            await self.request(
+                "POST", f"/api/services/{intent.domain}/{intent.service}", intent.data, deadline=5, label="服务调用"
+            )
+            return intent.speech
+        except Exception as e:
+            print(f"本地执行HomeAssistant指令失败，交给对话代理处理: {str(e)}")
+            return None
+
+    async def send_command(self, command):
+        """向HomeAssistant发送文本指令"""
+        ha_config = self.snapshot()
+        if not ha_config.get('url'):
+            return "错误：HomeAssistant URL未配置"
+        if not ha_config.get('token'):
+            return "错误：HomeAssistant Token未配置"
+        if not ha_config.get('text_entity_id'):
+            return "错误：文本实体ID未配置"
+
+        try:
+            result_list = await self.request(
+                "POST",
+                "/api/services/text/set_value",
+                {"entity_id": ha_config["text_entity_id"], "value": command},
+            )
+            if isinstance(result_list, list) and len(result_list) > 0:
+                return f"执行成功：{result_list[0].get('state', '操作完成')}".replace("{lv=stt}", command)
+            return "指令已执行"
+        except asyncio.TimeoutError:
+            return "请求HomeAssistant超时，请检查网络连接"
+        except aiohttp.ClientConnectionError:
+            return "无法连接到HomeAssistant，请检查网络连接和服务器地址"
+        except Exception as e:
+            return f"操作异常: {str(e)}"
+
+    async def send_voice_command(self, text):
+        """向HomeAssistant发送语音指令，状态查询和常见指令先在本地回答或直接执行"""
+        ha_config = self.snapshot()
+        if not ha_config.get("url"):
+            return "语音指令失败: 缺少HomeAssistant服务器URL配置"
+        if not ha_config.get("token"):
+            return "语音指令失败: 缺少HomeAssistant Token配置"
+
+        # 先匹配控制指令，能识别的指令总是执行，不会被当作状态查询
+        answer = await self.try_local_intent(text)
+        if answer is None and self.state_cache is not None:
+            answer = self.state_cache.answer_query(text)
+        if answer is not None:
+            return answer
+
+        if not ha_config.get("voice_agent_id"):
+            return "语音指令失败: 缺少语音Agent ID配置"
+
+        try:
+            response_json = await self.request(
+                "POST",
+                "/api/conversation/process",
+                {"agent_id": ha_config["voice_agent_id"], "text": text, "language": "zh-CN"},
+                label="语音请求",
+            )
+        except asyncio.TimeoutError:
+            return "请求HomeAssistant语音接口超时，请检查网络连接"
+        except aiohttp.ClientConnectionError:
+            return "无法连接到HomeAssistant语音接口，请检查网络连接和服务器地址"
+        except Exception as e:
+            return f"语音指令失败: {str(e)}"
+
+        try:
+            return response_json['response']['speech']['plain']['speech']
+        except (KeyError, TypeError):
+            return "处理成功，但返回格式不符合预期"
+
+
+# MiGPT运行时登记的客户端和它所在的事件循环
+_shared = None
+
+
+def share_client(client, loop):
+    """
+    登记同一进程中其他线程（如API服务器）共用的客户端，传入None取消登记
+    """
+    global _shared
+    _shared = (client, loop) if client is not None else None
+
+
+class HomeAssistantBridge:
+    """
+    供API服务器等同步线程调用HomeAssistantClient
+    MiGPT在同一进程中运行时使用它登记的客户端，共用实体列表、状态缓存和重试策略；
+    否则在自己的后台事件循环中创建一个客户端
+    """
+
+    def __init__(self, config, timeout=60):
+        self.config = config
+        self.timeout = timeout  # 等待结果的最长时间，客户端自己的时限通常更短
+        self.client = None
+        self.loop = None
+        self._lock = threading.Lock()
+
+    def _target(self):
+        shared = _shared
+        if shared is not None and shared[1].is_running():
+            return shared
+        with self._lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="ha-bridge", daemon=True).start()
+                session = asyncio.run_coroutine_threadsafe(self._create_session(), loop).result()
+                self.client = HomeAssistantClient(session, self.config)
+                self.loop = loop
+            return self.client, self.loop
+
+    @staticmethod
+    async def _create_session():
+        return aiohttp.ClientSession()
+
+    def call(self, method, *args):
+        """
+        在客户端的事件循环中调用它的异步方法并等待结果
+        """
+        client, loop = self._target()
+        future = asyncio.run_coroutine_threadsafe(getattr(client, method)(*args), loop)
+        try:
+            return future.result(self.timeout)
+        except Exception:
+            future.cancel()
+            raise
+
+    def close(self):
+        """
+        关闭自己创建的会话并停止后台事件循环，不影响MiGPT登记的客户端
+        """
+        with self._lock:
+            loop, self.loop = self.loop, None
+            client, self.client = self.client, None
+            if loop is None:
+                return
+            try:
+                asyncio.run_coroutine_threadsafe(client.session.close(), loop).result(timeout=5)
+            except Exception as e:
+                print(f"关闭HomeAssistant会话失败: {e}")
+            loop.call_soon_threadsafe(loop.stop)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+HomeAssistant本地意图匹配模块 - 根据实体列表直接识别常见的开关、亮度、温度和场景指令
+识别成功时直接调用/api/services/<domain>/<service>，无需经过HomeAssistant的对话代理
+"""
+import re
+import threading
+
+from keyword_router import AhoCorasick
+
+# 支持开关指令的实体类型
+SWITCHABLE_DOMAINS = ("light", "switch", "fan", "input_boolean", "media_player", "climate", "humidifier")
+# 可以直接启动的实体类型
+ACTIVATABLE_DOMAINS = ("scene", "script")
+# 窗帘等使用打开/关闭服务的实体类型
+COVER_DOMAINS = ("cover",)
+
+# 指令中可以忽略的客套词和语气词
+FILLER_WORDS = ("请", "帮我", "麻烦", "给我", "一下", "把", "将", "吧", "呢", "啊", "了", "的")
+ON_WORDS = ("打开", "开启", "启动", "开开", "开")
+OFF_WORDS = ("关闭", "关掉", "关上", "关")
+ACTIVATE_WORDS = ("启动", "执行", "激活", "打开", "开启", "运行", "切换到", "切换")
+
+NUMBER_PATTERN = r"([0-9]+|[零一二两三四五六七八九十百]+)"
+SET_WORDS = r"(?:调|调到|调整|调整到|设置|设置为|设置成|设为|设成|设|改成|改为|调成|调为|到|为|成)?"
+BRIGHTNESS_PATTERN = re.compile(rf"^(?:亮度)?{SET_WORDS}(?:亮度)?{SET_WORDS}{NUMBER_PATTERN}(?:%|％|度)?(?:亮度)?$")
+TEMPERATURE_PATTERN = re.compile(rf"^(?:温度)?{SET_WORDS}(?:温度)?{SET_WORDS}{NUMBER_PATTERN}度$")
+BRIGHTER_WORDS = ("调亮", "调亮点", "亮一点", "亮一些", "调亮一点", "调亮一些")
+DIMMER_WORDS = ("调暗", "调暗点", "暗一点", "暗一些", "调暗一点", "调暗一些")
+
+CHINESE_DIGITS = {"零": 0, "一": 1, "二": 2, "两": 2, "三": 3, "四": 4, "五": 5, "六": 6, "七": 7, "八": 8, "九": 9}
+
+
+def parse_number(text):
+    """
+    解析阿拉伯数字或一百以内的中文数字，无法解析时返回None
+    """
+    if text.isdigit():
+        return int(text)
+    if text == "一百" or text == "百":
+        return 100
+    if "百" in text:
+        return None
+    if "十" in text:
+        tens, _, ones = text.partition("十")
+        tens_value = CHINESE_DIGITS.get(tens, None) if tens else 1
+        ones_value = CHINESE_DIGITS.get(ones, None) if ones else 0
+        if tens_value is None or ones_value is None:
+            return None
+        return tens_value * 10 + ones_value
+    if len(text) == 1:
+        return CHINESE_DIGITS.get(text)
+    return None
+
+
+def strip_fillers(text):
+    for word in FILLER_WORDS:
+        text = text.replace(word, "")
+    return text.strip()
+
+
+class HAIntent:
+    """
+    识别出的HomeAssistant服务调用
+    """
+
+    def __init__(self, domain, service, data, speech):
+        self.domain = domain
+        self.service = service
+        self.data = data      # 服务调用参数，包含entity_id
+        self.speech = speech  # 执行成功后的回复
+
+    def __repr__(self):
+        return f"HAIntent({self.domain}.{self.service}, {self.data!r})"
+
+
+class HAIntentMatcher:
+    """
+    基于HomeAssistant实体列表的本地意图匹配
+    实体名称（friendly_name及配置的别名）编译为Aho-Corasick自动机，取文本中最长的实体名称，
+    再按剩余文本匹配开关、亮度、温度和场景模板
+    """
+
+    def __init__(self, aliases=None):
+        self.aliases = aliases or {}  # 别名 -> 实体ID或实体ID列表
+        self.entities = {}            # 实体ID -> 状态
+        self.automaton = None
+        self.updated_at = 0.0
+        self._lock = threading.Lock()
+
+    def update_entities(self, states, updated_at=0.0):
+        """
+        用/api/states返回的状态列表重建实体名称索引
+        """
+        entities = {}
+        names = {}  # 小写名称 -> (显示名称, 实体ID列表)
+        for state in states:
+            entity_id = state.get("entity_id", "")
+            domain = entity_id.split(".", 1)[0]
+            if domain not in SWITCHABLE_DOMAINS + ACTIVATABLE_DOMAINS + COVER_DOMAINS:
+                continue
+            entities[entity_id] = state
+            name = (state.get("attributes") or {}).get("friendly_name")
+            if name:
+                name = name.replace(" ", "")
+                names.setdefault(name.lower(), (name, []))[1].append(entity_id)
+        for alias, entity_ids in self.aliases.items():
+            if isinstance(entity_ids, str):
+                entity_ids = [entity_ids]
+            names.setdefault(alias.lower(), (alias, []))[1].extend(e for e in entity_ids if e in entities)
+        automaton = AhoCorasick({key: (name, tuple(ids)) for key, (name, ids) in names.items() if ids})
+        with self._lock:
+            self.entities = entities
+            self.automaton = automaton
+            self.updated_at = updated_at
+
+    def match(self, text):
+        """
+        返回识别出的HAIntent，无法确定时返回None
+        """
+        automaton = self.automaton
+        if automaton is None:
+            return None
+        text = text.replace(" ", "").lower()
+        matches = automaton.find_all(text)
+        if not matches:
+            return None
+        # 取最长的实体名称，如"客厅灯带"优先于"客厅灯"
+        start, end, _, (name, entity_ids) = max(matches, key=lambda m: (m[1] - m[0], -m[0]))
+        rest = strip_fillers(text[:start] + text[end:])
+        domain = entity_ids[0].split(".", 1)[0]
+        if any(e.split(".", 1)[0] != domain for e in entity_ids):
+            return None
+        data = {"entity_id": list(entity_ids) if len(entity_ids) > 1 else entity_ids[0]}
+
+        if domain in ACTIVATABLE_DOMAINS:
+            if rest == "" or rest in ACTIVATE_WORDS or rest in ("场景", "模式") or \
+                    any(rest == word + suffix for word in ACTIVATE_WORDS for suffix in ("场景", "模式")):
+                return HAIntent(domain, "turn_on", data, f"已启动{name}")
+            return None
+
+        if rest in OFF_WORDS:
+            if domain in COVER_DOMAINS:
+                return HAIntent(domain, "close_cover", data, f"已关闭{name}")
+            return HAIntent(domain, "turn_off", data, f"已关闭{name}")
+        if rest in ON_WORDS:
+            if domain in COVER_DOMAINS:
+                return HAIntent(domain, "open_cover", data, f"已打开{name}")
+            return HAIntent(domain, "turn_on", data, f"已打开{name}")
+
+        if domain == "light":
+            if rest in BRIGHTER_WORDS or rest in DIMMER_WORDS:
+                step = 20 if rest in BRIGHTER_WORDS else -20
+                return HAIntent(domain, "turn_on", dict(data, brightness_step_pct=step),
+                                f"已将{name}调{'亮' if step > 0 else '暗'}")
+            found = BRIGHTNESS_PATTERN.match(rest)
+            if found:
+                value = parse_number(found.group(1))
+                if value is not None and 0 <= value <= 100:
+                    return HAIntent(domain, "turn_on", dict(data, brightness_pct=value),
+                                    f"已将{name}亮度调到{value}%")
+            return None
+
+        if domain == "climate":
+            found = TEMPERATURE_PATTERN.match(rest)
+            if found:
+                value = parse_number(found.group(1))
+                if value is not None and 5 <= value <= 40:
+                    return HAIntent(domain, "set_temperature", dict(data, temperature=value),
+                                    f"已将{name}温度设置为{value}度")
+            return None
+
+        return None
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+HomeAssistant状态缓存模块 - 通过websocket订阅state_changed事件，在内存中维护实体状态表
+"温度多少""门锁了吗"这类状态查询直接在本地回答，同时为本地意图匹配提供实时的实体列表
+"""
+import asyncio
+import time
+
+import aiohttp
+
+from ha_intent import ON_WORDS, OFF_WORDS
+from keyword_router import AhoCorasick
+
+# 表示查询状态的词（"现在""没有"单独出现时不算查询，如"现在把灯关了"）
+QUERY_WORDS = ("多少", "几度", "吗", "了没", "状态", "怎么样", "是不是", "是否", "有没有", "查询", "查一下")
+# 表示控制设备的词，包含这些词的句子一般不作为状态查询
+CONTROL_WORDS = ON_WORDS + OFF_WORDS + ("调", "设置", "设为", "执行", "切换")
+# 描述状态的词，其中的"开""关"不是控制词
+STATE_WORDS = ("开着", "关着")
+# 以这些词结尾的句子即使含有控制词也是查询，如"客厅灯关了吗"
+QUESTION_ENDINGS = ("吗", "了没", "没有")
+
+ON_OFF_TEXT = {"on": "开着", "off": "关着"}
+LOCK_TEXT = {"locked": "已上锁", "unlocked": "没有上锁", "locking": "正在上锁", "unlocking": "正在开锁", "jammed": "卡住了"}
+COVER_TEXT = {"open": "开着", "closed": "关着", "opening": "正在打开", "closing": "正在关闭"}
+HVAC_TEXT = {"off": "关着", "cool": "正在制冷", "heat": "正在制热", "auto": "处于自动模式",
+             "heat_cool": "处于自动模式", "dry": "正在除湿", "fan_only": "正在送风"}
+PRESENCE_CLASSES = ("motion", "occupancy", "presence")
+UNIT_TEXT = {"°C": "度", "℃": "度", "°F": "华氏度"}
+
+
+def describe_state(name, state):
+    """
+    把实体状态转换为可以直接播报的文本
+    """
+    value = state.get("state")
+    attributes = state.get("attributes") or {}
+    domain = state.get("entity_id", "").split(".", 1)[0]
+    if value in ("unavailable", "unknown", None):
+        return f"{name}当前不可用"
+    if domain == "lock":
+        return f"{name}{LOCK_TEXT.get(value, value)}"
+    if domain == "cover":
+        return f"{name}{COVER_TEXT.get(value, value)}"
+    if domain == "climate":
+        parts = [f"{name}{HVAC_TEXT.get(value, value)}"]
+        if value != "off" and attributes.get("temperature") is not None:
+            parts.append(f"设定温度{attributes['temperature']}度")
+        if attributes.get("current_temperature") is not None:
+            parts.append(f"室内温度{attributes['current_temperature']}度")
+        return "，".join(parts)
+    if domain == "binary_sensor" and attributes.get("device_class") in PRESENCE_CLASSES:
+        return f"{name}{'有人' if value == 'on' else '没有人'}"
+    if value in ON_OFF_TEXT:
+        return f"{name}{ON_OFF_TEXT[value]}"
+    unit = attributes.get("unit_of_measurement") or ""
+    return f"{name}是{value}{UNIT_TEXT.get(unit, unit)}"
+
+
+class HAStateCache:
+    """
+    HomeAssistant实体状态表，由websocket事件流实时更新
+    连接断开后按指数退避自动重连，重连后重新获取全部状态
+    """
+
+    def __init__(self, intent_matcher=None):
+        self.intent_matcher = intent_matcher  # 实体列表变化时同步更新的本地意图匹配
+        self.states = {}       # 实体ID -> 状态
+        self.automaton = None  # 实体名称 -> 实体ID
+        self.ready = False     # 已获取全部状态且连接正常
+        self.updated_at = 0.0
+        self.events = 0
+        self._next_id = 0
+
+    def _rebuild_index(self):
+        names = {}
+        for entity_id, state in self.states.items():
+            name = (state.get("attributes") or {}).get("friendly_name")
+            if name:
+                names.setdefault(name.replace(" ", "").lower(), (name, entity_id))
+        self.automaton = AhoCorasick(names)
+        if self.intent_matcher is not None:
+            self.intent_matcher.update_entities(list(self.states.values()), time.time())
+
+    def set_states(self, states):
+        """
+        用完整的状态列表替换状态表
+        """
+        self.states = {state["entity_id"]: state for state in states if state.get("entity_id")}
+        self.updated_at = time.time()
+        self._rebuild_index()
+
+    def apply_event(self, data):
+        """
+        应用一个state_changed事件，实体新增、删除或改名时重建名称索引
+        """
+        entity_id = data.get("entity_id")
+        if not entity_id:
+            return
+        new_state = data.get("new_state")
+        old_state = self.states.get(entity_id)
+        if new_state is None:
+            self.states.pop(entity_id, None)
+            rebuild = old_state is not None
+        else:
+            self.states[entity_id] = new_state
+            old_name = ((old_state or {}).get("attributes") or {}).get("friendly_name")
+            rebuild = old_state is None or old_name != (new_state.get("attributes") or {}).get("friendly_name")
+        self.updated_at = time.time()
+        self.events += 1
+        if rebuild:
+            self._rebuild_index()
+
+    def get(self, entity_id):
+        return self.states.get(entity_id)
+
+    def answer_query(self, text):
+        """
+        回答实体状态查询，不是状态查询或找不到实体时返回None
+        """
+        automaton = self.automaton
+        if not self.ready or automaton is None:
+            return None
+        text = text.replace(" ", "").lower()
+        matches = automaton.find_all(text)
+        if not matches:
+            return None
+        start, end, _, (name, entity_id) = max(matches, key=lambda m: (m[1] - m[0], -m[0]))
+        # 只看实体名称以外的部分，避免"空调"中的"调"被当作控制词
+        rest = text[:start] + text[end:]
+        if not self.is_query(rest):
+            return None
+        state = self.states.get(entity_id)
+        if state is None:
+            return None
+        return describe_state(name, state)
+
+    @staticmethod
+    def is_query(rest):
+        """
+        判断去掉实体名称后的文本是否为状态查询，含有控制词的句子只有以疑问词结尾时才算查询
+        """
+        rest = rest.rstrip("?？。!！")
+        if not any(word in rest for word in QUERY_WORDS):
+            return False
+        for word in STATE_WORDS:
+            rest = rest.replace(word, "")
+        if any(word in rest for word in CONTROL_WORDS):
+            return rest.endswith(QUESTION_ENDINGS)
+        return True
+
+    def _command(self, payload):
+        self._next_id += 1
+        payload["id"] = self._next_id
+        return payload
+
+    async def run(self, session, ha_client):
+        """
+        保持websocket连接并消费事件，直到任务被取消
+        """
+        delay = 1
+        while True:
+            ha_config = ha_client.snapshot()
+            url, token = ha_config.get("url"), ha_config.get("token")
+            if not url or not token:
+                await asyncio.sleep(60)
+                continue
+            ws_url = url.rstrip("/").replace("https://", "wss://", 1).replace("http://", "ws://", 1) + "/api/websocket"
+            try:
+                await self._consume(session, ws_url, token)
+                delay = 1
+            except asyncio.CancelledError:
+                raise
+            except PermissionError as e:
+                print(f"HomeAssistant状态订阅失败: {e}")
+                return
+            except Exception as e:
+                print(f"HomeAssistant状态订阅断开({e})，{delay}秒后重连")
+            finally:
+                self.ready = False
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+
+    async def _consume(self, session, ws_url, token):
+        async with session.ws_connect(ws_url, heartbeat=30) as ws:
+            message = await ws.receive_json(timeout=10)
+            if message.get("type") == "auth_required":
+                await ws.send_json({"type": "auth", "access_token": token})
+                message = await ws.receive_json(timeout=10)
+            if message.get("type") != "auth_ok":
+                raise PermissionError("HomeAssistant Token无效")
+
+            self._next_id = 0
+            subscribe = self._command({"type": "subscribe_events", "event_type": "state_changed"})
+            await ws.send_json(subscribe)
+            get_states = self._command({"type": "get_states"})
+            await ws.send_json(get_states)
+
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    if msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                        break
+                    continue
+                message = msg.json()
+                if message.get("type") == "event" and message.get("id") == subscribe["id"]:
+                    event = message.get("event", {})
+                    if event.get("event_type") == "state_changed":
+                        self.apply_event(event.get("data", {}))
+                elif message.get("type") == "result" and message.get("id") == get_states["id"]:
+                    if not message.get("success"):
+                        raise RuntimeError(f"获取实体状态失败: {message.get('error')}")
+                    self.set_states(message.get("result") or [])
+                    self.ready = True
+            raise ConnectionError("连接已关闭")
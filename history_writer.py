@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+聊天记录写入模块 - 在后台线程中批量写入JSONL格式的聊天记录
+请求线程只把记录放入有界队列，文件达到大小上限时轮转，轮转出的旧文件可以压缩
+"""
+import gzip
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+
+import metrics
+
+HISTORY_DROPPED = metrics.counter(
+    "migpt_history_dropped_total", "Chat history records dropped because the write queue was full")
+
+
+class HistoryWriter:
+    """
+    后台批量写入的JSONL聊天记录
+    队列满时丢弃新记录（只计数），不让磁盘延迟影响请求；
+    攒够batch_size条或距上次写入超过flush_interval秒时写入一次
+    """
+    _STOP = object()
+
+    def __init__(self, path, queue_size=1000, batch_size=100, flush_interval=1.0,
+                 max_bytes=10 * 1024 * 1024, backups=5, compress=True):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.written = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        """
+        提交一条记录（dict），不等待写入
+        """
+        self._ensure_started()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            HISTORY_DROPPED.inc()
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            # 第一条记录到达后，最多再等flush_interval秒凑成一批
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if batch:
+                self._flush(batch)
+
+    def _flush(self, batch):
+        lines = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in batch)
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(lines)
+                size = f.tell()
+            self.written += len(batch)
+            if self.max_bytes and size >= self.max_bytes:
+                self._rotate()
+        except Exception as e:
+            print(f"保存聊天记录失败: {e}")
+
+    def _rotated_name(self, index):
+        return f"{self.path}.{index}" + (".gz" if self.compress else "")
+
+    def _rotate(self):
+        """
+        当前文件改名为.1（压缩为.1.gz），已有的旧文件依次后移，超出backups个的删除
+        """
+        if self.backups <= 0:
+            os.remove(self.path)
+            return
+        oldest = self._rotated_name(self.backups)
+        if os.path.exists(oldest):
+            os.remove(oldest)
+        for index in range(self.backups - 1, 0, -1):
+            name = self._rotated_name(index)
+            if os.path.exists(name):
+                os.replace(name, self._rotated_name(index + 1))
+        if not self.compress:
+            os.replace(self.path, self._rotated_name(1))
+            return
+        tmp_path = self.path + ".rotating"
+        os.replace(self.path, tmp_path)
+        with open(tmp_path, "rb") as src, gzip.open(self._rotated_name(1), "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(tmp_path)
+
+    def close(self, timeout=5):
+        """
+        写入队列中剩余的记录并停止后台线程
+        """
+        thread = self._thread
+        if thread is None:
+            return
+        try:
+            self.queue.put(self._STOP, timeout=timeout)
+        except queue.Full:
+            pass
+        thread.join(timeout)
+        self._thread = None
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+关键词路由模块 - 用Aho-Corasick自动机一次扫描用户输入，得到处理方式、命中的关键词和去掉关键词后的文本
+"""
+from collections import deque
+
+# 处理方式
+ROUTE_HA_VOICE = "ha_voice"  # HomeAssistant语音指令
+ROUTE_HA_TEXT = "ha_text"    # HomeAssistant文本指令
+ROUTE_AI = "ai"              # AI助手回答
+ROUTE_XIAOAI = None          # 交给小爱自己处理
+
+# 关键词分组，对应配置中的关键词列表
+GROUP_AI = "ai"
+GROUP_HA_AI = "ha_ai"
+GROUP_HA_TEXT = "ha_text"
+
+
+class AhoCorasick:
+    """
+    多关键词匹配自动机，构建一次后每次匹配只需扫描一遍文本
+    """
+
+    def __init__(self, patterns):
+        # patterns: 关键词 -> 附加数据
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for pattern, payload in patterns.items():
+            if pattern:
+                self._add(pattern, payload)
+        self._build()
+
+    def _add(self, pattern, payload):
+        state = 0
+        for ch in pattern:
+            next_state = self.goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][ch] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+            state = next_state
+        self.output[state].append((pattern, payload))
+
+    def _build(self):
+        # 按层次遍历计算失败指针，并合并失败路径上的输出
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and ch not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(ch, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def find_all(self, text):
+        """
+        返回所有命中，每项为(起始位置, 结束位置, 关键词, 附加数据)
+        """
+        goto, fail, output = self.goto, self.fail, self.output
+        matches = []
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for pattern, payload in output[state]:
+                matches.append((i + 1 - len(pattern), i + 1, pattern, payload))
+        return matches
+
+
+def strip_matches(text, matches):
+    """
+    从文本中去掉命中的关键词，重叠时保留最靠前、最长的一个
+    """
+    parts = []
+    pos = 0
+    for start, end, _, _ in sorted(matches, key=lambda m: (m[0], m[0] - m[1])):
+        if start < pos:
+            continue
+        parts.append(text[pos:start])
+        pos = end
+    parts.append(text[pos:])
+    return "".join(parts).strip()
+
+
+class RouteResult:
+    """
+    一次路由的结果
+    """
+
+    def __init__(self, route, matched, cleaned):
+        self.route = route      # 处理方式，见ROUTE_*
+        self.matched = matched  # 决定处理方式的命中关键词，按出现顺序
+        self.cleaned = cleaned  # 去掉这些关键词后的文本
+
+    def __repr__(self):
+        return f"RouteResult(route={self.route!r}, matched={self.matched!r}, cleaned={self.cleaned!r})"
+
+
+class KeywordRouter:
+    """
+    根据ai_keywords和homeassistant关键词决定用户输入的处理方式
+    配置保存后（Config.version变化）自动重建自动机
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.version = None
+        self.automaton = None
+
+    def _ensure_automaton(self):
+        version = getattr(self.config, "version", 0)
+        if self.automaton is not None and version == self.version:
+            return self.automaton
+        ha_config = self.config.get("homeassistant", {}) or {}
+        groups = {}
+        for group, keywords in (
+            (GROUP_AI, self.config.get("ai_keywords", ["请", "帮我", "问一下", "AI"])),
+            (GROUP_HA_AI, ha_config.get("ai_keywords", [])),
+            (GROUP_HA_TEXT, ha_config.get("text_keywords", [])),
+        ):
+            for keyword in keywords or []:
+                groups.setdefault(keyword, set()).add(group)
+        self.automaton = AhoCorasick({keyword: frozenset(g) for keyword, g in groups.items()})
+        self.version = version
+        return self.automaton
+
+    def route(self, text, allow_ha=True):
+        """
+        扫描一遍文本，返回RouteResult
+        HomeAssistant关键词优先，其中HAAI关键词使用语音指令，否则使用文本指令；其次是AI关键词
+        """
+        matches = self._ensure_automaton().find_all(text)
+        ha_matches = [m for m in matches if m[3] & {GROUP_HA_AI, GROUP_HA_TEXT}] if allow_ha else []
+        if ha_matches:
+            voice = any(GROUP_HA_AI in m[3] for m in ha_matches)
+            return RouteResult(
+                ROUTE_HA_VOICE if voice else ROUTE_HA_TEXT,
+                [m[2] for m in ha_matches],
+                strip_matches(text, ha_matches),
+            )
+        ai_matches = [m for m in matches if GROUP_AI in m[3]]
+        if ai_matches:
+            return RouteResult(ROUTE_AI, [m[2] for m in ai_matches], strip_matches(text, ai_matches))
+        return RouteResult(ROUTE_XIAOAI, [], text)
+
+    def matches(self, text, group):
+        """
+        返回文本中命中的某一组关键词
+        """
+        return [m for m in self._ensure_automaton().find_all(text) if group in m[3]]
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+AI网关模块 - 供API服务器的工作线程调用聊天机器人
+聊天机器人运行在一个后台事件循环中，所有请求共用一个aiohttp会话，回答片段边生成边交给请求线程
+"""
+import asyncio
+import queue
+import threading
+
+import aiohttp
+
+from answer_cache import AnswerCache
+from V3 import Chatbot, ChatResult
+
+
+def build_chatbot(config, api_key, engine, api_base, api_type, echo_stream=False):
+    """
+    创建聊天机器人并应用配置中的流式时限、故障转移和竞速设置
+    """
+    chatbot = Chatbot(
+        api_key=api_key,
+        engine=engine,
+        api_base=api_base,
+        api_type=api_type,
+        echo_stream=echo_stream,
+    )
+
+    # 流式回答的连接、首个token、token间隔和总时长时限
+    deadlines = config.get("llm_deadlines", {})
+    chatbot.configure_deadlines(
+        deadlines.get("connect"),
+        deadlines.get("first_token"),
+        deadlines.get("inter_token"),
+        deadlines.get("total"),
+    )
+
+    # 服务商熔断与故障转移
+    failover_config = config.get("llm_failover", {})
+    chatbot.configure_failover(
+        config.get("api_presets", {}),
+        failover_config.get("presets", []),
+        int(failover_config.get("failure_threshold", 3)),
+        float(failover_config.get("cooldown", 30)),
+    )
+
+    # 多服务商竞速/对冲请求
+    race_config = config.get("llm_race", {})
+    if race_config.get("enabled") and race_config.get("presets"):
+        chatbot.configure_race(
+            config.get("api_presets", {}),
+            race_config.get("presets", []),
+            float(race_config.get("hedge_delay", 0)),
+        )
+    return chatbot
+
+
+class LLMGateway:
+    """
+    在后台事件循环中调用聊天机器人的同步接口
+    各应用共用的单轮提问回答缓存只保存在内存中，不写入MiGPT的缓存文件，避免两个进程互相覆盖
+    """
+    _DONE = object()
+
+    def __init__(self, config, api_key, engine, api_base, api_type):
+        self.config = config
+        self.settings = (api_key, engine, api_base, api_type)
+        self.chatbot = None
+        self.answer_cache = None
+        self.loop = None
+        self.session = None
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        return bool(self.settings[0])
+
+    @property
+    def model(self):
+        return self.settings[1]
+
+    def _ensure_started(self):
+        with self._lock:
+            if self.loop is not None:
+                return
+            self.chatbot = build_chatbot(self.config, *self.settings)
+            cache_config = self.config.get("answer_cache", {})
+            if cache_config.get("enabled", True):
+                self.answer_cache = AnswerCache(
+                    ttl=cache_config.get("ttl", 86400),
+                    max_entries=cache_config.get("max_entries", 500),
+                    max_bytes=cache_config.get("max_bytes", 1024 * 1024),
+                    ttl_rules=cache_config.get("ttl_rules"),
+                )
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="llm-gateway", daemon=True).start()
+            self.session = asyncio.run_coroutine_threadsafe(self._create_session(), loop).result()
+            self.loop = loop
+
+    @staticmethod
+    async def _create_session():
+        return aiohttp.ClientSession()
+
+    @staticmethod
+    def cache_query(messages):
+        """
+        只有一条用户消息（没有上下文）的提问才使用缓存，返回问题文本或None
+        """
+        user_messages = [msg for msg in messages if msg.get("role") == "user"]
+        if len(user_messages) != 1 or any(msg.get("role") == "assistant" for msg in messages):
+            return None
+        return user_messages[0].get("content") or None
+
+    def stream(self, messages):
+        """
+        返回回答片段的迭代器，在请求线程中迭代；迭代提前结束（如客户端断开）时停止生成
+        """
+        self._ensure_started()
+        chatbot = self.chatbot
+        system_prompt = next((m.get("content") for m in messages if m.get("role") == "system"), chatbot.system_prompt)
+        query = self.cache_query(messages)
+        if query is not None and self.answer_cache is not None:
+            answer = self.answer_cache.get(query, chatbot.engine, system_prompt)
+            if answer is not None:
+                yield answer
+                return
+
+        deltas = queue.Queue()
+        stop_event = threading.Event()
+        result = ChatResult()
+
+        async def produce():
+            try:
+                async for content in chatbot.ask_messages_async(messages, self.session, stop_event, result):
+                    deltas.put(content)
+            except Exception as e:
+                deltas.put(e)
+            finally:
+                deltas.put(self._DONE)
+
+        future = asyncio.run_coroutine_threadsafe(produce(), self.loop)
+        try:
+            while True:
+                item = deltas.get()
+                if item is self._DONE:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            if not future.done():
+                stop_event.set()
+                future.cancel()
+
+        if query is not None and self.answer_cache is not None and result.finished and not (result.stopped or result.deadline):
+            self.answer_cache.put(query, result.text, chatbot.engine, system_prompt)
+
+    def close(self):
+        """
+        关闭共用的会话并停止后台事件循环
+        """
+        with self._lock:
+            loop, self.loop = self.loop, None
+            if loop is None:
+                return
+            try:
+                asyncio.run_coroutine_threadsafe(self.session.close(), loop).result(timeout=5)
+            except Exception as e:
+                print(f"关闭AI网关会话失败: {e}")
+            loop.call_soon_threadsafe(loop.stop)
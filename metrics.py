@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+运行指标模块 - 进程内的计数器、直方图和仪表，按Prometheus文本格式导出
+计数和直方图写入各线程自己的单元格，记录时不加锁，导出时才把各线程的单元格相加；
+直方图的区间预先确定，每次记录只需一次二分查找
+"""
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# 默认的耗时区间（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class _ThreadCells:
+    """
+    每个线程一个固定长度的数值列表，只有所属线程写入
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._local = threading.local()
+        self._cells = []
+        self._lock = threading.Lock()  # 只在线程第一次记录时使用
+
+    def cell(self):
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = [0.0] * self.size
+            with self._lock:
+                self._cells.append(cell)
+            self._local.cell = cell
+            return cell
+
+    def totals(self):
+        totals = [0.0] * self.size
+        for cell in list(self._cells):
+            for i, value in enumerate(cell):
+                totals[i] += value
+        return totals
+
+
+class Counter:
+    """
+    只增不减的计数
+    """
+
+    def __init__(self):
+        self._cells = _ThreadCells(1)
+
+    def inc(self, amount=1):
+        self._cells.cell()[0] += amount
+
+    def value(self):
+        return self._cells.totals()[0]
+
+
+class Histogram:
+    """
+    预先分好区间的分布统计
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        # 每个区间一格，加上+Inf区间和总和
+        self._cells = _ThreadCells(len(self.buckets) + 2)
+
+    def observe(self, value):
+        cell = self._cells.cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    @contextmanager
+    def time(self):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started)
+
+    def snapshot(self):
+        """
+        返回(各区间的累计计数, 总和)，最后一个区间为+Inf
+        """
+        totals = self._cells.totals()
+        cumulative = []
+        running = 0
+        for count in totals[:-1]:
+            running += count
+            cumulative.append(running)
+        return cumulative, totals[-1]
+
+
+class Gauge:
+    """
+    可增可减的当前值，也可以在导出时通过函数读取
+    """
+
+    def __init__(self):
+        self._value = 0.0
+        self._function = None
+
+    def set(self, value):
+        self._value = value
+
+    def set_function(self, function):
+        self._function = function
+
+    def value(self):
+        return self._function() if self._function is not None else self._value
+
+
+class MetricFamily:
+    """
+    同名的一组指标，按标签值区分
+    """
+
+    def __init__(self, kind, name, documentation, labelnames, factory):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._factory = factory
+        self._children = {}
+        self._lock = threading.Lock()
+        self._function = None  # 仪表：导出时调用，返回{标签值元组: 值}
+
+    def labels(self, *values):
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name}需要标签{self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(key, self._factory())
+        return child
+
+    # 没有标签的指标直接使用以下方法
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, function):
+        """
+        导出时调用function取值；有标签时function返回{标签值元组: 值}
+        """
+        if self.labelnames:
+            self._function = function
+        else:
+            self.labels().set_function(function)
+
+    def samples(self):
+        """
+        返回[(标签值元组, 指标对象或值)]
+        """
+        if self._function is not None:
+            try:
+                return sorted(self._function().items())
+            except Exception as e:
+                print(f"读取指标{self.name}失败: {e}")
+                return []
+        return sorted(self._children.items())
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Registry:
+    """
+    指标注册表，同名指标只创建一次
+    """
+
+    def __init__(self):
+        self._families = {}
+        self._lock = threading.Lock()
+
+    def _register(self, kind, name, documentation, labelnames, factory):
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = MetricFamily(kind, name, documentation, labelnames, factory)
+            return family
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register("counter", name, documentation, labelnames, Counter)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register("histogram", name, documentation, labelnames, lambda: Histogram(buckets))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register("gauge", name, documentation, labelnames, Gauge)
+
+    def expose(self):
+        """
+        按Prometheus文本格式（0.0.4）导出所有指标
+        """
+        lines = []
+        with self._lock:
+            families = list(self._families.values())
+        for family in families:
+            lines.append(f"# HELP {family.name} {_escape(family.documentation)}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            for values, metric in family.samples():
+                if family.kind == "histogram":
+                    cumulative, total = metric.snapshot()
+                    bounds = [_format_value(b) for b in metric.buckets] + ["+Inf"]
+                    for bound, count in zip(bounds, cumulative):
+                        labels = _format_labels(family.labelnames, values, ("le", bound))
+                        lines.append(f"{family.name}_bucket{labels} {_format_value(count)}")
+                    labels = _format_labels(family.labelnames, values)
+                    lines.append(f"{family.name}_sum{labels} {_format_value(total)}")
+                    lines.append(f"{family.name}_count{labels} {_format_value(cumulative[-1])}")
+                else:
+                    value = metric.value() if hasattr(metric, "value") else metric
+                    labels = _format_labels(family.labelnames, values)
+                    lines.append(f"{family.name}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# 进程内共用的注册表
+REGISTRY = Registry()
+counter = REGISTRY.counter
+histogram = REGISTRY.histogram
+gauge = REGISTRY.gauge
@@ -10,8 +10,15 @@ import asyncio
 from urllib import parse
 from aiohttp import ClientSession
 
+import metrics
+
 _LOGGER = logging.getLogger(__package__)
 
+MI_LOGINS = metrics.counter(
+    "migpt_mi_logins_total", "Xiaomi account logins by service and result", ["sid", "result"])
+MI_REQUEST_RETRIES = metrics.counter(
+    "migpt_mi_request_retries_total", "Xiaomi API requests retried, by reason", ["reason"])
+
 
 def get_random(length):
     return "".join(random.sample(string.ascii_letters + string.digits, length))
@@ -101,9 +108,11 @@ class MiAccount:
                         if self.token_store:
                             self.token_store.save_token(None)  # 这会删除token文件
                             
+                        MI_LOGINS.labels(sid, "captcha").inc()
                         return False
                     else:
                         _LOGGER.error(f"登录失败，错误码: {resp['code']}, 描述: {resp.get('desc', '未知错误')}")
+                        MI_LOGINS.labels(sid, "failure").inc()
                         return False
 
             _LOGGER.debug(f"登录成功，获取userId和passToken")
@@ -121,6 +130,7 @@ class MiAccount:
                 self.token_store.save_token(self.token)
             
             _LOGGER.info(f"小米账号 {self.username} 登录成功")
+            MI_LOGINS.labels(sid, "success").inc()
             return True
 
         except Exception as e:
@@ -128,6 +138,7 @@ class MiAccount:
             if self.token_store:
                 self.token_store.save_token()
             _LOGGER.exception(f"登录异常: {e}")
+            MI_LOGINS.labels(sid, "error").inc()
             return False
 
     async def _serviceLogin(self, uri, data=None):
@@ -254,6 +265,7 @@ class MiAccount:
                                     self.token = None  # 重置token
                                     if retry_count < max_retries:
                                         retry_count += 1
+                                        MI_REQUEST_RETRIES.labels("relogin").inc()
                                         await self.login(sid)
                                         continue
                                         
@@ -271,6 +283,7 @@ class MiAccount:
                         self.token = None  # 重置token
                         if retry_count < max_retries:
                             retry_count += 1
+                            MI_REQUEST_RETRIES.labels("relogin").inc()
                             continue
                         else:
                             raise Exception(f"重新登录尝试{max_retries}次后仍然失败")
@@ -281,6 +294,7 @@ class MiAccount:
                         self.token = None  # 重置token
                         if retry_count < max_retries:
                             retry_count += 1
+                            MI_REQUEST_RETRIES.labels("relogin").inc()
                             continue
                     
                     # 如果是其他类型的错误，直接抛出
@@ -293,12 +307,14 @@ class MiAccount:
                 else:
                     if retry_count < max_retries:
                         retry_count += 1
+                        MI_REQUEST_RETRIES.labels("login_failed").inc()
                         _LOGGER.warn("登录失败，重试中... (尝试 %d/%d)", retry_count, max_retries)
                         continue
                     resp = "Login failed after multiple attempts"
             except Exception as e:
                 if retry_count < max_retries:
                     retry_count += 1
+                    MI_REQUEST_RETRIES.labels("error").inc()
                     _LOGGER.warn("请求发生错误，重试中... (尝试 %d/%d): %s", retry_count, max_retries, e)
                     continue
                 raise e
@@ -344,6 +360,7 @@ class MiAccount:
                                     self.token = None  # 重置token
                                     if retry_count < max_retries:
                                         retry_count += 1
+                                        MI_REQUEST_RETRIES.labels("relogin").inc()
                                         await self.login(sid)
                                         continue
                                     
@@ -359,6 +376,7 @@ class MiAccount:
                         self.token = None  # 重置token
                         if retry_count < max_retries:
                             retry_count += 1
+                            MI_REQUEST_RETRIES.labels("relogin").inc()
                             continue
                         else:
                             return False
@@ -368,6 +386,7 @@ class MiAccount:
                         self.token = None  # 重置token
                         if retry_count < max_retries:
                             retry_count += 1
+                            MI_REQUEST_RETRIES.labels("relogin").inc()
                             continue
                     
                     # 如果是其他类型的错误，直接返回False
@@ -378,12 +397,14 @@ class MiAccount:
                 else:
                     if retry_count < max_retries:
                         retry_count += 1
+                        MI_REQUEST_RETRIES.labels("login_failed").inc()
                         continue
                     else:
                         return False
             except Exception:
                 if retry_count < max_retries:
                     retry_count += 1
+                    MI_REQUEST_RETRIES.labels("error").inc()
                     continue
                 else:
                     return False
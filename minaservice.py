@@ -1,11 +1,17 @@
 import json
 import asyncio
 from miaccount import MiAccount, get_random
+import metrics
 
 import logging
 
 _LOGGER = logging.getLogger(__package__)
 
+MINA_REQUEST_SECONDS = metrics.histogram(
+    "migpt_mina_request_seconds", "Latency of requests to the Mina (xiaoai) API", ["path"])
+MINA_RETRIES = metrics.counter(
+    "migpt_mina_retries_total", "Mina API calls retried because the speaker did not respond", ["method"])
+
 
 class MiNAService:
     def __init__(self, account: MiAccount):
@@ -22,9 +28,10 @@ class MiNAService:
         headers = {
             "User-Agent": "MiHome/6.0.103 (com.xiaomi.mihome; build:6.0.103.1; iOS 14.4.0) Alamofire/6.0.103 MICO/iOSApp/appStore/6.0.103"
         }
-        return await self.account.mi_request(
-            "micoapi", "https://api2.mina.mi.com" + uri, data, headers
-        )
+        with MINA_REQUEST_SECONDS.labels(uri.split("?", 1)[0]).time():
+            return await self.account.mi_request(
+                "micoapi", "https://api2.mina.mi.com" + uri, data, headers
+            )
 
     async def device_list(self, master=0):
         result = await self.mina_request("/admin/v2/device_list?master=" + str(master))
@@ -57,6 +64,7 @@ class MiNAService:
                 if "ROM端未响应" in error_str and "3012" in error_str:
                     retries += 1
                     if retries <= self.max_retries:
+                        MINA_RETRIES.labels("text_to_speech").inc()
                         # 指数退避策略
                         wait_time = delay * (2 ** (retries - 1))
                         print(f"设备 {deviceId} ROM端未响应，{wait_time}秒后重试 ({retries}/{self.max_retries})...")
@@ -136,6 +144,22 @@ class MiNAService:
             {"media": "app_ios"},
         )
 
+    async def get_play_status(self, deviceId):
+        """
+        静默获取设备播放状态
+        返回1表示正在播放，其他值表示空闲或暂停，获取失败时返回None
+        """
+        result = await self.ubus_request_silent(
+            deviceId, "player_get_play_status", "mediaplayer", {"media": "app_ios"}
+        )
+        try:
+            info = result["data"]["info"]
+            if isinstance(info, str):
+                info = json.loads(info)
+            return info.get("status")
+        except (TypeError, KeyError, ValueError, AttributeError):
+            return None
+
     async def play_by_url(self, deviceId, url):
         return await self.ubus_request(
             deviceId,
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+速率限制模块 - 按客户端IP等键分别计数的令牌桶
+桶按键的哈希分散到多个分片，每个分片一把锁，并发请求很少争用同一把锁
+"""
+import math
+import threading
+import time
+
+
+class TokenBucketLimiter:
+    """
+    令牌桶速率限制：每个键以rate/分钟的速度补充令牌，最多积累burst个
+    """
+
+    def __init__(self, rate, burst=None, shards=16):
+        self.rate = rate / 60.0  # 每秒补充的令牌数
+        self.burst = float(burst or rate)
+        self.shards = [({}, threading.Lock()) for _ in range(shards)]
+        # 桶从空到满所需的时间，超过这个时间没有请求的桶等同于新桶，可以删除
+        self.idle_after = self.burst / self.rate if self.rate > 0 else 0
+        self.limited = 0
+
+    def acquire(self, key, now=None):
+        """
+        为键取一个令牌，成功返回0，否则返回需要等待的秒数
+        """
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic() if now is None else now
+        buckets, lock = self.shards[hash(key) % len(self.shards)]
+        with lock:
+            bucket = buckets.get(key)
+            if bucket is None:
+                if len(buckets) >= 1024:
+                    self._prune(buckets, now)
+                bucket = buckets[key] = [self.burst, now]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return 0
+            bucket[0] = tokens
+        self.limited += 1
+        return (1 - tokens) / self.rate
+
+    def _prune(self, buckets, now):
+        for key in [k for k, (_, last) in buckets.items() if now - last >= self.idle_after]:
+            del buckets[key]
+
+    @staticmethod
+    def retry_after(wait):
+        """
+        Retry-After响应头的值（整数秒，至少为1）
+        """
+        return str(max(1, math.ceil(wait)))
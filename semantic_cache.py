@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+语义回答缓存模块 - 用字符n-gram哈希向量匹配换了说法的重复问题
+如"帮我讲个笑话"和"讲个笑话吧"，向量保存在连续的NumPy矩阵中，按余弦相似度查找最相近的问题
+"""
+import os
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from answer_cache import is_follow_up, normalize_query, resolve_ttl
+
+# n-gram长度及其权重，单字权重较低，避免只是用字相同的问题过于相似
+NGRAM_WEIGHTS = {1: 0.5, 2: 1.0}
+
+# 每次查找检查的最相似候选数，哈希冲突使无关条目排在前面时仍能找到真正相近的问题
+TOP_K = 4
+
+# 去掉这些字后相同的两个问题视为同一个问题，差别在其他字上（如"北京天气"和"上海天气"）则不命中
+FILLER_CHARS = frozenset("帮我请问一下个吧呢吗啊呀嘛哦的了给你说讲是什么")
+
+
+def embed_query(query, dim=128):
+    """
+    把规范化后的问题按字符n-gram哈希到dim维向量（带符号哈希），返回单位向量
+    """
+    text = normalize_query(query)
+    vector = np.zeros(dim, dtype=np.float32)
+    for n, weight in NGRAM_WEIGHTS.items():
+        for i in range(len(text) - n + 1):
+            h = zlib.crc32(text[i:i + n].encode("utf-8"))
+            vector[h % dim] += weight if h & 0x80000000 else -weight
+    norm = np.linalg.norm(vector)
+    if norm:
+        vector /= norm
+    return vector
+
+
+def strip_filler(query):
+    """
+    规范化问题并去掉语气词、客套词，保留其余字的顺序
+    """
+    return "".join(ch for ch in normalize_query(query) if ch not in FILLER_CHARS)
+
+
+def same_content(a, b):
+    """
+    两个问题去掉语气词、客套词之后完全相同
+    按顺序比较，"狗咬人"和"人咬狗"、"3减5"和"5减3"这类用字相同但意思不同的问题不算相同
+    """
+    return strip_filler(a) == strip_filler(b)
+
+
+class SemanticCache:
+    """
+    按语义相似度匹配的回答缓存
+    向量预先分配在capacity x dim的矩阵中，查找时一次矩阵乘法得到所有相似度，
+    满了以后替换最久未使用的条目
+    """
+
+    def __init__(self, capacity=10000, dim=128, threshold=0.7, ttl=86400, ttl_rules=None, path=None):
+        self.capacity = capacity
+        self.dim = dim
+        self.threshold = threshold
+        self.ttl = ttl
+        self.ttl_rules = ttl_rules or []
+        self.path = path
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.expires = np.zeros(capacity, dtype=np.float64)  # 0表示空位
+        self.last_used = np.zeros(capacity, dtype=np.int64)
+        self.namespaces = np.zeros(capacity, dtype=np.uint32)
+        self.scores = np.empty(capacity, dtype=np.float32)  # 相似度缓冲区，避免每次查找分配内存
+        self.queries = [None] * capacity
+        self.answers = [None] * capacity
+        self.count = 0  # 已使用过的位置数，查找只扫描这一部分
+        self.free = []  # 过期后空出的位置
+        self.clock = 0
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def namespace_id(model="", prompt=""):
+        return zlib.crc32("\0".join((model or "", prompt or "")).encode("utf-8"))
+
+    def cacheable(self, query):
+        return (
+            bool(normalize_query(query))
+            and not is_follow_up(query)
+            and resolve_ttl(query, self.ttl, self.ttl_rules) > 0
+        )
+
+    def _search(self, vector, namespace):
+        """
+        返回同一命名空间中最相似的几个条目，按相似度从高到低排列为[(位置, 相似度)]
+        """
+        n = self.count
+        if n == 0:
+            return []
+        scores = np.dot(self.vectors[:n], vector, out=self.scores[:n])
+        # 先排除其他命名空间的条目，避免它们占满前TOP_K个位置
+        scores[self.namespaces[:n] != namespace] = -np.inf
+        if n > TOP_K:
+            top = np.argpartition(scores, -TOP_K)[-TOP_K:]
+        else:
+            top = np.arange(n)
+        candidates = [(int(i), float(scores[i])) for i in top if self.namespaces[i] == namespace]
+        candidates.sort(key=lambda c: c[1], reverse=True)
+        return candidates
+
+    def _release(self, idx):
+        self.vectors[idx] = 0
+        self.expires[idx] = 0
+        self.queries[idx] = None
+        self.answers[idx] = None
+        self.free.append(idx)
+        self.dirty = True
+
+    def get(self, query, model="", prompt=""):
+        """
+        返回语义相近问题的缓存回答，未命中时返回None
+        """
+        if not self.cacheable(query):
+            with self._lock:
+                self.bypassed += 1
+            return None
+        vector = embed_query(query, self.dim)
+        namespace = self.namespace_id(model, prompt)
+        with self._lock:
+            now = time.time()
+            for idx, score in self._search(vector, namespace):
+                if score < self.threshold:
+                    break
+                if self.expires[idx] <= now:
+                    if self.expires[idx] > 0:
+                        self._release(idx)
+                    continue
+                if not same_content(query, self.queries[idx]):
+                    continue
+                self.clock += 1
+                self.last_used[idx] = self.clock
+                self.hits += 1
+                return self.answers[idx]
+            self.misses += 1
+            return None
+
+    def put(self, query, answer, model="", prompt=""):
+        """
+        缓存问题的回答，几乎相同的问题覆盖原有条目
+        """
+        if not answer or not self.cacheable(query):
+            return
+        vector = embed_query(query, self.dim)
+        if not vector.any():
+            return
+        namespace = self.namespace_id(model, prompt)
+        with self._lock:
+            candidates = self._search(vector, namespace)
+            if candidates and candidates[0][1] >= 0.999 and self.expires[candidates[0][0]] > 0:
+                idx = candidates[0][0]
+            else:
+                idx = self._allocate()
+            self.vectors[idx] = vector
+            self.expires[idx] = time.time() + resolve_ttl(query, self.ttl, self.ttl_rules)
+            self.namespaces[idx] = namespace
+            self.queries[idx] = query
+            self.answers[idx] = answer
+            self.clock += 1
+            self.last_used[idx] = self.clock
+            self.dirty = True
+
+    def _allocate(self):
+        if self.free:
+            return self.free.pop()
+        if self.count < self.capacity:
+            self.count += 1
+            return self.count - 1
+        # 已满，替换最久未使用的条目
+        self.evictions += 1
+        return int(np.argmin(self.last_used[:self.count]))
+
+    def __len__(self):
+        return self.count - len(self.free)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": self.count - len(self.free),
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def load(self):
+        """
+        从文件加载缓存，向量维度不同或已过期的条目会被丢弃
+        """
+        if not self.path or not os.path.exists(self.path):
+            return False
+        try:
+            with np.load(self.path) as data:
+                vectors = data["vectors"]
+                expires = data["expires"]
+                namespaces = data["namespaces"]
+                queries = data["queries"].tolist()
+                answers = data["answers"].tolist()
+        except Exception as e:
+            print(f"加载语义缓存失败: {e}")
+            return False
+        if vectors.ndim != 2 or vectors.shape[1] != self.dim:
+            print("语义缓存的向量维度与当前配置不同，已忽略")
+            return False
+        now = time.time()
+        keep = np.nonzero(expires > now)[0][-self.capacity:]
+        n = len(keep)
+        with self._lock:
+            self.vectors[:n] = vectors[keep]
+            self.expires[:n] = expires[keep]
+            self.namespaces[:n] = namespaces[keep]
+            self.last_used[:n] = np.arange(1, n + 1)
+            for slot, idx in enumerate(keep):
+                self.queries[slot] = queries[idx]
+                self.answers[slot] = answers[idx]
+            self.count = n
+            self.free = []
+            self.clock = n
+            self.dirty = False
+        return True
+
+    def save(self):
+        """
+        有改动时保存缓存到文件，先写临时文件再替换
+        """
+        if not self.path:
+            return False
+        with self._lock:
+            if not self.dirty:
+                return True
+            used = [i for i in range(self.count) if self.expires[i] > 0]
+            # 按最近使用排序，加载时超出容量的旧条目先被丢弃
+            used.sort(key=lambda i: self.last_used[i])
+            arrays = {
+                "vectors": self.vectors[used],
+                "expires": self.expires[used],
+                "namespaces": self.namespaces[used],
+                "queries": np.array([self.queries[i] for i in used], dtype=str),
+                "answers": np.array([self.answers[i] for i in used], dtype=str),
+            }
+            self.dirty = False
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, self.path)
+            return True
+        except Exception as e:
+            print(f"保存语义缓存失败: {e}")
+            return False
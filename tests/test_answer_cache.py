@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""
+回答缓存测试 - 只有指向之前对话的追问不使用缓存，独立问题正常缓存
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from answer_cache import AnswerCache, is_follow_up  # noqa: E402
+
+
+class FollowUpTest(unittest.TestCase):
+    def test_standalone_questions_are_cached(self):
+        cache = AnswerCache()
+        for query in ("为什么天是蓝的", "这个周末天气怎么样", "详细介绍一下长城", "他是谁写的诗"):
+            with self.subTest(query=query):
+                self.assertFalse(is_follow_up(query))
+                cache.put(query, "回答", "model", "prompt")
+                self.assertEqual(cache.get(query, "model", "prompt"), "回答")
+        self.assertEqual(cache.bypassed, 0)
+
+    def test_back_references_bypass_cache(self):
+        cache = AnswerCache()
+        for query in ("刚才说的是什么意思", "继续", "然后呢", "换一个", "上一个问题再讲讲"):
+            with self.subTest(query=query):
+                self.assertTrue(is_follow_up(query))
+                cache.put(query, "回答", "model", "prompt")
+                self.assertIsNone(cache.get(query, "model", "prompt"))
+        self.assertEqual(len(cache.entries), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
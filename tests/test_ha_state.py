@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+HomeAssistant状态缓存测试 - 状态查询与控制指令的区分，以及对websocket事件流的处理
+"""
+import asyncio
+import os
+import sys
+import unittest
+
+import aiohttp
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ha_client import HomeAssistantClient  # noqa: E402
+from ha_state import HAStateCache  # noqa: E402
+
+STATES = [
+    {"entity_id": "light.living", "state": "on", "attributes": {"friendly_name": "客厅灯"}},
+    {"entity_id": "climate.ac", "state": "cool",
+     "attributes": {"friendly_name": "空调", "temperature": 24, "current_temperature": 27}},
+    {"entity_id": "sensor.bedroom", "state": "23.5",
+     "attributes": {"friendly_name": "卧室温度", "unit_of_measurement": "°C"}},
+    {"entity_id": "lock.door", "state": "locked", "attributes": {"friendly_name": "门锁"}},
+]
+
+
+def ready_cache(states=STATES):
+    cache = HAStateCache()
+    cache.set_states(states)
+    cache.ready = True
+    return cache
+
+
+class AnswerQueryTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = ready_cache()
+
+    def test_control_phrasings_are_not_answered(self):
+        for text in ("现在把客厅灯关了", "空调现在关上", "现在开客厅灯", "打开客厅灯", "把客厅灯关掉",
+                     "客厅灯关了", "空调调到26度", "现在关空调"):
+            with self.subTest(text=text):
+                self.assertIsNone(self.cache.answer_query(text))
+
+    def test_query_phrasings_are_answered(self):
+        cases = {
+            "客厅灯开着吗": "客厅灯开着",
+            "客厅灯是不是开着": "客厅灯开着",
+            "客厅灯关了吗": "客厅灯开着",
+            "客厅灯关了没有": "客厅灯开着",
+            "空调现在怎么样": "空调正在制冷，设定温度24度，室内温度27度",
+            "卧室温度现在多少度？": "卧室温度是23.5度",
+            "门锁了吗": "门锁已上锁",
+        }
+        for text, answer in cases.items():
+            with self.subTest(text=text):
+                self.assertEqual(self.cache.answer_query(text), answer)
+
+    def test_now_or_not_alone_is_not_a_query(self):
+        self.assertIsNone(self.cache.answer_query("客厅灯现在"))
+        self.assertIsNone(self.cache.answer_query("客厅灯没有"))
+
+    def test_not_ready_or_unknown_entity(self):
+        self.assertIsNone(self.cache.answer_query("厨房灯开着吗"))
+        self.cache.ready = False
+        self.assertIsNone(self.cache.answer_query("客厅灯开着吗"))
+
+    def test_events_update_states_and_names(self):
+        self.cache.apply_event({"entity_id": "light.living", "new_state": {
+            "entity_id": "light.living", "state": "off", "attributes": {"friendly_name": "客厅灯"}}})
+        self.assertEqual(self.cache.answer_query("客厅灯开着吗"), "客厅灯关着")
+        self.cache.apply_event({"entity_id": "light.living", "new_state": {
+            "entity_id": "light.living", "state": "off", "attributes": {"friendly_name": "大厅灯"}}})
+        self.assertEqual(self.cache.answer_query("大厅灯开着吗"), "大厅灯关着")
+        self.cache.apply_event({"entity_id": "light.living", "new_state": None})
+        self.assertIsNone(self.cache.answer_query("大厅灯开着吗"))
+
+    def test_event_for_state_without_attributes(self):
+        self.cache.set_states(STATES + [{"entity_id": "sensor.raw", "state": "1", "attributes": None}])
+        self.cache.apply_event({"entity_id": "sensor.raw", "new_state": {
+            "entity_id": "sensor.raw", "state": "2", "attributes": {"friendly_name": "水表"}}})
+        self.assertEqual(self.cache.get("sensor.raw")["state"], "2")
+        self.assertEqual(self.cache.answer_query("水表现在多少"), "水表是2")
+
+
+class VoiceCommandTest(unittest.IsolatedAsyncioTestCase):
+    """
+    状态缓存就绪时，控制指令仍然要执行，只有状态查询在本地回答
+    """
+
+    def setUp(self):
+        self.client = HomeAssistantClient(None, {})
+        self.client._snapshot = {"url": "http://ha", "token": "tok", "voice_agent_id": "agent"}
+        self.client._version = 0
+        self.client.state_cache = ready_cache()
+        self.client.intent_matcher.update_entities(STATES, 0)
+        self.calls = []
+
+        async def request(method, path, payload=None, deadline=None, label="请求"):
+            self.calls.append((path, payload))
+            if path == "/api/conversation/process":
+                return {"response": {"speech": {"plain": {"speech": "好的"}}}}
+            return []
+        self.client.request = request
+
+    async def test_local_intent_is_executed(self):
+        self.assertEqual(await self.client.send_voice_command("关闭客厅灯"), "已关闭客厅灯")
+        self.assertEqual(self.calls[0][0], "/api/services/light/turn_off")
+
+    async def test_unmatched_control_goes_to_agent(self):
+        for text in ("现在把客厅灯关了", "空调现在关上", "现在开客厅灯"):
+            with self.subTest(text=text):
+                self.calls.clear()
+                await self.client.send_voice_command(text)
+                self.assertEqual(self.calls[-1][0], "/api/conversation/process")
+
+    async def test_query_is_answered_locally(self):
+        self.assertEqual(await self.client.send_voice_command("客厅灯开着吗"), "客厅灯开着")
+        self.assertEqual(self.calls, [])
+
+
+class FakeHomeAssistant:
+    """
+    模拟HomeAssistant的websocket接口：认证、订阅事件、获取全部状态，并可以推送state_changed事件
+    """
+
+    def __init__(self, token="tok"):
+        self.token = token
+        self.sockets = []
+        self.subscription = None
+
+    async def handle(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets.append(ws)
+        await ws.send_json({"type": "auth_required"})
+        async for msg in ws:
+            data = msg.json()
+            if data["type"] == "auth":
+                ok = data["access_token"] == self.token
+                await ws.send_json({"type": "auth_ok" if ok else "auth_invalid"})
+                if not ok:
+                    await ws.close()
+            elif data["type"] == "subscribe_events":
+                self.subscription = data["id"]
+                await ws.send_json({"id": data["id"], "type": "result", "success": True, "result": None})
+            elif data["type"] == "get_states":
+                await ws.send_json({"id": data["id"], "type": "result", "success": True, "result": STATES})
+        return ws
+
+    async def push(self, new_state):
+        for ws in self.sockets:
+            await ws.send_json({"id": self.subscription, "type": "event", "event": {
+                "event_type": "state_changed",
+                "data": {"entity_id": new_state["entity_id"], "new_state": new_state}}})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/api/websocket", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f"ws://127.0.0.1:{port}/api/websocket"
+
+
+async def wait_for(condition, timeout=5):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        if loop.time() > deadline:
+            raise AssertionError("等待超时")
+        await asyncio.sleep(0.01)
+
+
+class WebsocketTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.ha = FakeHomeAssistant()
+        self.url = await self.ha.start()
+        self.session = aiohttp.ClientSession()
+
+    async def asyncTearDown(self):
+        await self.session.close()
+        await self.ha.runner.cleanup()
+
+    async def test_loads_states_and_applies_events(self):
+        cache = HAStateCache()
+        task = asyncio.create_task(cache._consume(self.session, self.url, "tok"))
+        try:
+            await wait_for(lambda: cache.ready)
+            self.assertEqual(cache.answer_query("客厅灯开着吗"), "客厅灯开着")
+            await self.ha.push({"entity_id": "light.living", "state": "off",
+                                "attributes": {"friendly_name": "客厅灯"}})
+            await wait_for(lambda: cache.events == 1)
+            self.assertEqual(cache.answer_query("客厅灯开着吗"), "客厅灯关着")
+        finally:
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+    async def test_invalid_token(self):
+        cache = HAStateCache()
+        with self.assertRaises(PermissionError):
+            await cache._consume(self.session, self.url, "wrong")
+        self.assertFalse(cache.ready)
+
+
+if __name__ == "__main__":
+    unittest.main()
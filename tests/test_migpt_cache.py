@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+MiGPT回答缓存测试 - 上下文有效时间内的连续提问不使用缓存，空闲之后的独立问题重新使用缓存
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import MIGPT  # noqa: E402
+from answer_cache import AnswerCache  # noqa: E402
+from semantic_cache import SemanticCache  # noqa: E402
+
+
+class FakeChatbot:
+    engine = "test-model"
+
+    def __init__(self):
+        self.conversation = {}
+        self.exchanges = []
+
+    def record_exchange(self, prompt, answer, convo_id="default"):
+        self.conversation.setdefault(convo_id, []).append(answer)
+        self.exchanges.append((convo_id, answer))
+
+    def reset(self, convo_id="default", system_prompt=None):
+        self.conversation[convo_id] = []
+
+
+class ConversationCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.migpt = MIGPT.MiGPT()
+        self.migpt.chatbot = FakeChatbot()
+        self.migpt.answer_cache = AnswerCache()
+        self.migpt.semantic_cache = None
+        self.migpt.conversation_idle_timeout = 120
+        self.convo_id = "device:test"
+
+    def ask(self, query):
+        """
+        按MiGPT处理设备提问的顺序记录问题并查找缓存，返回(缓存使用的问题, 缓存回答)
+        """
+        prompt = self.migpt.build_ai_prompt(self.convo_id, query)
+        cache_query = self.migpt.cache_query_for(self.convo_id, query)
+        answer = self.migpt.get_cached_answer(self.convo_id, cache_query, prompt)
+        self.migpt.conversation_history[self.convo_id].append({"role": "assistant", "content": answer or "回答"})
+        return cache_query, answer
+
+    def idle(self, seconds):
+        self.migpt.conversation_times[self.convo_id] -= seconds
+
+    def test_first_question_uses_cache(self):
+        self.migpt.answer_cache.put("讲个笑话", "笑话", FakeChatbot.engine, MIGPT.PROMPT)
+        self.assertEqual(self.ask("讲个笑话"), ("讲个笑话", "笑话"))
+
+    def test_question_within_context_skips_cache(self):
+        self.migpt.answer_cache.put("那明天呢", "缓存的回答", FakeChatbot.engine, MIGPT.PROMPT)
+        self.ask("今天天气怎么样")
+        self.assertEqual(self.ask("那明天呢"), (None, None))
+
+    def test_unrelated_question_after_idle_hits_cache(self):
+        self.migpt.answer_cache.put("讲个笑话", "笑话", FakeChatbot.engine, MIGPT.PROMPT)
+        self.ask("今天天气怎么样")
+        self.idle(121)
+        self.assertEqual(self.ask("讲个笑话"), ("讲个笑话", "笑话"))
+        # 对话历史和聊天机器人的会话都从新话题开始
+        self.assertEqual(len(self.migpt.conversation_history[self.convo_id]), 2)
+        self.assertEqual(self.migpt.chatbot.conversation[self.convo_id], ["笑话"])
+
+    def test_semantic_cache_used_after_idle(self):
+        self.migpt.answer_cache = None
+        self.migpt.semantic_cache = SemanticCache(capacity=16)
+        self.migpt.semantic_cache.put("讲个笑话吧", "笑话", FakeChatbot.engine, MIGPT.PROMPT)
+        self.ask("今天天气怎么样")
+        self.idle(121)
+        self.assertEqual(self.ask("帮我讲个笑话")[1], "笑话")
+
+    def test_other_devices_are_independent(self):
+        self.migpt.answer_cache.put("讲个笑话", "笑话", FakeChatbot.engine, MIGPT.PROMPT)
+        self.ask("今天天气怎么样")
+        self.convo_id = "device:other"
+        self.assertEqual(self.ask("讲个笑话")[1], "笑话")
+
+
+if __name__ == "__main__":
+    unittest.main()
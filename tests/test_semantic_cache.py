@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+语义回答缓存测试 - 按命名空间查找相近问题，只复用去掉语气词后内容相同的问题
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from semantic_cache import TOP_K, SemanticCache, same_content  # noqa: E402
+
+
+class NamespaceTest(unittest.TestCase):
+    def test_other_namespaces_do_not_crowd_out_matches(self):
+        cache = SemanticCache(capacity=64)
+        cache.put("讲个笑话吧", "笑话", "model", "prompt")
+        # 其他模型下完全相同的问题比本命名空间的条目更相似，数量超过TOP_K
+        for i in range(TOP_K * 2):
+            cache.put("帮我讲个笑话", f"其他回答{i}", f"model-{i}", "prompt")
+        self.assertEqual(cache.get("帮我讲个笑话", "model", "prompt"), "笑话")
+        self.assertEqual(cache.get("帮我讲个笑话", "model-0", "prompt"), "其他回答0")
+        self.assertIsNone(cache.get("帮我讲个笑话", "model-x", "prompt"))
+
+
+class SameContentTest(unittest.TestCase):
+    def test_filler_words_are_ignored(self):
+        self.assertTrue(same_content("帮我讲个笑话", "讲个笑话吧"))
+        self.assertTrue(same_content("请问北京天气", "北京天气呢？"))
+
+    def test_order_matters(self):
+        for a, b in (("狗咬人", "人咬狗"), ("3减5", "5减3"), ("北京天气", "上海天气")):
+            with self.subTest(a=a, b=b):
+                self.assertFalse(same_content(a, b))
+
+    def test_reordered_question_is_not_reused(self):
+        cache = SemanticCache(capacity=16, threshold=0.0)
+        cache.put("3减5等于多少", "-2", "model", "prompt")
+        self.assertIsNone(cache.get("5减3等于多少", "model", "prompt"))
+        self.assertEqual(cache.get("请问3减5等于多少呢", "model", "prompt"), "-2")
+
+
+if __name__ == "__main__":
+    unittest.main()